@@ -0,0 +1,87 @@
+''' Compare two benchmark result files written by benchmarks.run
+
+Cases are matched by backend, build mode and network, and every phase of the new results is
+shown relative to the old ones. Exits with status 1 if any phase got slower (or used more
+memory) by more than the threshold, so it can gate a CI job.
+
+    python -m benchmarks.compare old.json new.json --threshold 0.1
+'''
+
+import argparse
+import json
+import sys
+import typing as tp
+
+METRICS = ['build_s', 'create_s', 'compile_s', 'run_s', 'run_peak_rss_mb']
+
+def case_key(result: tp.Dict) -> tp.Tuple:
+    ''' Key identifying the same benchmark case across result files '''
+
+    return (result['backend'], result['vectorized'], result['fixture'], result['query'],
+            result['n_neurons'] if result['fixture'] == None else None,
+            result['synapses_per_neuron'], result['seed'], result['duration'], result['dt'], result['codegen'])
+
+def compare(old: tp.Dict,
+            new: tp.Dict,
+            threshold: float=0.1,
+            min_value: float=0.01) -> tp.Tuple[tp.List[tp.Dict], bool]:
+    ''' Ratios of the metrics of matching cases in two result files
+
+    :param old: results to compare against
+    :param new: results to compare
+    :param threshold: relative increase above which a metric counts as a regression
+    :param min_value: metrics below this in the old results are too noisy to flag as regressions
+    :return: one row per matched case and metric, and whether any of them regressed
+    '''
+
+    old_results = {case_key(result): result for result in old['results'] if 'error' not in result}
+
+    rows = []
+    regressed = False
+    for result in new['results']:
+        key = case_key(result)
+        if ('error' in result or key not in old_results):
+            continue
+
+        for metric in METRICS:
+            before = old_results[key].get(metric)
+            after = result.get(metric)
+            if (before == None or after == None or before <= 0):
+                continue
+
+            ratio = after / before
+            regression = ratio > 1 + threshold and before >= min_value
+            rows.append({'case': key, 'metric': metric, 'old': before, 'new': after, 'ratio': ratio,
+                         'regression': regression})
+            regressed = regressed or regression
+
+    return rows, regressed
+
+def main(argv: tp.List[str]=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--min-value', type=float, default=0.01,
+                        help="don't flag metrics smaller than this in the old results")
+    args = parser.parse_args(argv)
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    rows, regressed = compare(old, new, args.threshold, args.min_value)
+
+    print('old: ' + str(old['meta']['commit']) + '\nnew: ' + str(new['meta']['commit']))
+    for row in rows:
+        backend, vectorized, fixture, query, n_neurons = row['case'][:5]
+        case = '{} {} {}'.format(backend, 'vectorized' if vectorized else 'legacy',
+                                 query if fixture != None else n_neurons)
+        print('{:<40} {:<16} {:>12.4g} {:>12.4g} {:>8.2f}x{}'.format(case, row['metric'], row['old'], row['new'],
+                                                                    row['ratio'], '  REGRESSION' if row['regression'] else ''))
+
+    sys.exit(1 if regressed else 0)
+
+if __name__ == '__main__':
+    main()
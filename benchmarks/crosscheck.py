@@ -0,0 +1,208 @@
+''' Simulate the same networks with both backends and compare their results
+
+Every network is built once per backend, in a freshly spawned process like benchmarks.run,
+and simulated headless with the spikes of every neuron and the traces of the recorded ones
+kept. The two results are then aligned and compared with comparison.compare_results(): rate
+differences, spike matching, trace errors, and the time and peak memory of every phase of each
+backend side by side. Run from the repository root, e.g.
+
+    python -m benchmarks.crosscheck --sizes 28 56 112 --output crosscheck.json
+    python -m benchmarks.crosscheck --fixture medulla.pkl.gz --queries "show column C" "show column A and column C"
+
+Reports are written as they finish, so a sweep can be left running unattended.
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import os.path
+import sys
+import tempfile
+import typing as tp
+
+from . import models
+from .fake_client import FakeClient
+from .run import ROOT, metadata
+from .synthetic import medulla_like
+
+BACKENDS = ['netpyne', 'brian2']
+
+def simulate_case(case: tp.Dict, path: str) -> tp.Dict:
+    ''' Build and simulate a network with one backend, meant to be called in a fresh process
+
+    :param case: case description, see main()
+    :param path: file to save the SimulationResults to
+    :return: the ProfileReport of the build and simulation, as a dict
+    '''
+
+    sys.path.insert(0, ROOT)
+    from src.NeuroNLP_to_Brian_Netpyne.network_ir import network_from_query
+    from src.NeuroNLP_to_Brian_Netpyne.profiling import Profiler
+
+    if (case['fixture'] != None):
+        client = FakeClient.from_fixture(case['fixture'])
+        query = case['query']
+    else:
+        client, query = medulla_like(case['n_neurons'], synapses_per_neuron=case['synapses_per_neuron'],
+                                     seed=case['seed'])
+    res = client.executeNLPquery(query)
+
+    profiler = Profiler(trace_memory=False)
+    output = open(os.devnull, 'w') if case['quiet'] else sys.stdout
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        with profiler.phase('build'):
+            network = network_from_query(client=client,
+                                         res=res,
+                                         stims=models.stims(case['backend'], case['stim']),
+                                         record_names=case['record'])
+
+        if (case['backend'] == 'netpyne'):
+            results = _simulate_netpyne(case, network, profiler)
+        else:
+            results = _simulate_brian2(case, network, profiler)
+    profiler.close()
+
+    results.save(path)
+    return profiler.report().to_dict()
+
+def _simulate_netpyne(case: tp.Dict, network, profiler):
+    from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+    with tempfile.TemporaryDirectory() as directory:
+        networkParams, simConfig = nlpToNetpyne.model_gen(client=None,
+                                                          res=None,
+                                                          filename=os.path.join(directory, 'crosscheck'),
+                                                          network=network,
+                                                          default_mech=models.NETPYNE_DEFAULT_MECH,
+                                                          default_cell=models.NETPYNE_DEFAULT_CELL,
+                                                          stim_sources=models.NETPYNE_STIM_SOURCES,
+                                                          record_names=case['record'],
+                                                          sim_duration=case['duration'],
+                                                          dt=case['dt'],
+                                                          vectorized=case['vectorized'],
+                                                          profiler=profiler,
+                                                          headless=True)
+        simConfig.recordStep = case['record_step']
+
+        return nlpToNetpyne.simulate(networkParams, simConfig, profiler=profiler, headless=True)
+
+def _simulate_brian2(case: tp.Dict, network, profiler):
+    from brian2 import defaultclock, ms, prefs
+    from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+
+    if (case['codegen'] != None):
+        prefs.codegen.target = case['codegen']
+    defaultclock.dt = case['dt'] * ms
+
+    networkParams = nlptoBrian2.model_gen(client=None,
+                                          res=None,
+                                          network=network,
+                                          default_mech=models.BRIAN2_DEFAULT_MECH,
+                                          default_cell=models.BRIAN2_DEFAULT_CELL,
+                                          stim_sources=models.BRIAN2_STIM_SOURCES,
+                                          vectorized=case['vectorized'],
+                                          profiler=profiler,
+                                          record_spikes=True)
+
+    return nlptoBrian2.simulate(networkParams, case['duration'], models.brian2_namespace(), profiler=profiler,
+                                headless=True)
+
+def crosscheck(case: tp.Dict, context) -> tp.Dict:
+    ''' Simulate a case with both backends, each in a fresh process, and compare the results
+
+    :param case: case description without a backend, see main()
+    :param context: multiprocessing context to spawn the simulations in
+    :return: the case, with the report of comparison.compare_results() or the 'error' of the
+             backend that failed
+    '''
+
+    sys.path.insert(0, ROOT)
+    from src.NeuroNLP_to_Brian_Netpyne.analysis import SimulationResults
+    from src.NeuroNLP_to_Brian_Netpyne.comparison import compare_results
+    from src.NeuroNLP_to_Brian_Netpyne.profiling import ProfileReport
+
+    results = {}
+    profiles = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in BACKENDS:
+            path = os.path.join(directory, backend + '.npz')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    profile = pool.submit(simulate_case, {**case, 'backend': backend}, path).result()
+                except Exception as e:
+                    return {**case, 'error': backend + ': ' + repr(e)}
+            results[backend] = SimulationResults.load(path)
+            profiles[backend] = ProfileReport(**profile)
+
+    return {**case, 'report': compare_results(results['netpyne'], results['brian2'], labels=tuple(BACKENDS),
+                                              profiles=profiles, window=case['window'])}
+
+def main(argv: tp.List[str]=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[28, 56],
+                        help='numbers of neurons of the synthetic networks to compare')
+    parser.add_argument('--fixture', help='fixture recorded with benchmarks.record to replay instead')
+    parser.add_argument('--queries', nargs='+', help='queries of the fixture to compare')
+    parser.add_argument('--mode', choices=['vectorized', 'legacy'], default='vectorized')
+    parser.add_argument('--stim', nargs='+', help='names of the neurons to stimulate')
+    parser.add_argument('--record', nargs='+', help='names of the neurons to record')
+    parser.add_argument('--synapses-per-neuron', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=100, help='simulated time, in ms')
+    parser.add_argument('--dt', type=float, default=0.025, help='integration timestep, in ms')
+    parser.add_argument('--record-step', type=float, default=0.1, help='NetPyNE trace sampling step, in ms')
+    parser.add_argument('--window', type=float, default=1.0, help='spike matching window, in ms')
+    parser.add_argument('--codegen', help='brian2 code generation target, e.g. numpy or cython')
+    parser.add_argument('--verbose', action='store_true', help="don't silence simulator output")
+    parser.add_argument('--output', default='crosscheck_results.json')
+    args = parser.parse_args(argv)
+
+    if (args.fixture != None and args.queries == None):
+        parser.error('--fixture requires --queries')
+
+    sys.path.insert(0, ROOT)
+    from src.NeuroNLP_to_Brian_Netpyne.comparison import format_comparison
+
+    if (args.fixture != None):
+        networks = [{'fixture': args.fixture, 'query': query, 'n_neurons': None} for query in args.queries]
+        stim = args.stim if args.stim != None else ['Mi4-C']
+        record = args.record if args.record != None else ['L2-C', 'C2-C', 'Mi4-C']
+    else:
+        networks = [{'fixture': None, 'query': None, 'n_neurons': n} for n in args.sizes]
+        stim = args.stim if args.stim != None else ['L1-A', 'L2-A']
+        record = args.record if args.record != None else ['L1-A', 'L2-A', 'Mi4-A']
+
+    results = {'meta': metadata(), 'results': []}
+    context = multiprocessing.get_context('spawn')
+    for network in networks:
+        case = {**network,
+                'vectorized': args.mode == 'vectorized',
+                'stim': stim,
+                'record': record,
+                'synapses_per_neuron': args.synapses_per_neuron,
+                'seed': args.seed,
+                'duration': args.duration,
+                'dt': args.dt,
+                'record_step': args.record_step,
+                'window': args.window,
+                'codegen': args.codegen,
+                'quiet': not args.verbose}
+        print('Comparing ' + (case['query'] if case['fixture'] != None else str(case['n_neurons']) + ' neurons'),
+              flush=True)
+
+        result = crosscheck(case, context)
+        results['results'].append(result)
+        if 'error' in result:
+            print('    failed: ' + result['error'], flush=True)
+        else:
+            print(format_comparison(result['report']), flush=True)
+
+        # Write as we go, so an interrupted sweep still leaves its results behind
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import gzip
+import pickle
+import time
+import typing as tp
+
+class FakeQueryResult:
+    ''' Offline stand-in for an FBL NAqueryResult
+
+    Exposes the same graph, neurons and synapses attributes that the model builders use.
+    '''
+
+    def __init__(self, graph, neurons: tp.Dict=None, synapses: tp.Dict=None):
+        self.graph = graph
+        self.neurons = {} if neurons is None else neurons
+        self.synapses = {} if synapses is None else synapses
+
+class FakeClient:
+    ''' Offline stand-in for an FBL Client, answering queries and connectivity lookups locally
+
+    .. note::
+
+        Connectivity can either be a dictionary of rids and the 'connectivity' entry of their
+        client info, or a callable that builds that entry for a rid on demand, which keeps
+        synthetic networks of 100k neurons from having to hold every lookup in memory.
+
+    :param queries: dictionary of neuroNLP query strings and their results
+    :param connectivity: connectivity of every neuron, or a callable returning it for a rid
+    :param latency: seconds every getInfo() call sleeps for, to emulate the round trip to a
+                    live server
+    '''
+
+    def __init__(self,
+                 queries: tp.Dict[str, FakeQueryResult],
+                 connectivity: tp.Union[tp.Dict[str, tp.Dict], tp.Callable[[str], tp.Dict]],
+                 latency: float=0):
+        self.queries = queries
+        self.connectivity = connectivity
+        self.latency = latency
+        self.calls = 0
+
+    def executeNLPquery(self, query: str) -> FakeQueryResult:
+        return self.queries[query]
+
+    def getInfo(self, rid: str) -> tp.Dict:
+        self.calls += 1
+        if (self.latency > 0):
+            time.sleep(self.latency)
+
+        if callable(self.connectivity):
+            connectivity = self.connectivity(rid)
+        else:
+            connectivity = self.connectivity[rid]
+
+        return {'data': {'connectivity': connectivity}}
+
+    @classmethod
+    def from_fixture(cls, path: str, latency: float=0) -> 'FakeClient':
+        ''' Load a client that replays a fixture written by RecordingClient.save() '''
+
+        with gzip.open(path, 'rb') as f:
+            fixture = pickle.load(f)
+
+        queries = {query: FakeQueryResult(**res) for query, res in fixture['queries'].items()}
+        return cls(queries, fixture['connectivity'], latency=latency)
+
+class RecordingClient:
+    ''' Wrapper around a live FBL Client that records everything it answers, to be replayed
+    offline by FakeClient.from_fixture()
+
+    :param client: pointer to FBL client
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.queries = {}
+        self.connectivity = {}
+
+    def executeNLPquery(self, query: str):
+        res = self.client.executeNLPquery(query)
+        self.queries[query] = {'graph': res.graph,
+                               'neurons': dict(res.neurons),
+                               'synapses': dict(res.synapses)}
+        return res
+
+    def getInfo(self, rid: str) -> tp.Dict:
+        info = self.client.getInfo(rid)
+        self.connectivity[rid] = info['data']['connectivity']
+        return info
+
+    def save(self, path: str):
+        ''' Write everything recorded so far to a gzipped pickle fixture '''
+
+        with gzip.open(path, 'wb') as f:
+            pickle.dump({'queries': self.queries, 'connectivity': self.connectivity},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,93 @@
+''' Benchmark how long importing every module of the package takes
+
+Every module is imported in a freshly started interpreter, a few times over, and the fastest
+import is kept along with the heavy dependencies (simulators, flybrainlab, plotting) it pulled
+in. None of the modules should pull in any: simulators and plotting are imported by the
+functions that use them, so building, caching and saving networks only costs NumPy and
+networkx. Run from the repository root, e.g.
+
+    python -m benchmarks.imports --output imports.json
+
+Exits with status 1 if any module fails to import or imports a heavy dependency, so it can
+gate a CI job.
+'''
+
+import argparse
+import json
+import subprocess
+import sys
+import typing as tp
+
+from .run import ROOT, metadata
+
+PACKAGE = 'src.NeuroNLP_to_Brian_Netpyne'
+
+MODULES = ['analysis', 'batch', 'cache', 'checkpoint', 'comparison', 'connectivity', 'incremental', 'integration',
+           'morphology', 'mpi', 'network_ir', 'neuroml', 'nlpToNetpyne', 'nlptoBrian2', 'partition', 'profiling',
+           'recording', 'snapshot', 'sweep']
+
+HEAVY = ['flybrainlab', 'brian2', 'brian2tools', 'netpyne', 'neuron', 'matplotlib', 'h5py', 'scipy', 'sympy']
+
+# Imports a module and reports the time it took and the heavy modules it left behind
+SCRIPT = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{'import_s': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+def measure(module: str, repeat: int=3) -> tp.Dict:
+    ''' Import time of a module in a fresh interpreter, the fastest of repeat imports
+
+    :param module: name of the module within the package
+    :param repeat: number of interpreters to import it in
+    :return: dictionary of the 'module', its 'import_s', and the 'heavy' modules it imported,
+             or the 'error' importing it raised
+    '''
+
+    best = None
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', SCRIPT.format(module=PACKAGE + '.' + module, heavy=HEAVY)],
+                                 cwd=ROOT, capture_output=True, text=True)
+        if (process.returncode != 0):
+            # A killed interpreter may not leave anything on stderr
+            lines = process.stderr.strip().splitlines()
+            error = lines[-1] if len(lines) > 0 else 'exited with status ' + str(process.returncode)
+            return {'module': module, 'error': error}
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        if (best == None or result['import_s'] < best['import_s']):
+            best = result
+
+    return {'module': module, **best}
+
+def main(argv: tp.List[str]=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', choices=MODULES, default=MODULES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='import_results.json')
+    args = parser.parse_args(argv)
+
+    results = {'meta': metadata(), 'results': []}
+    failed = False
+    for module in args.modules:
+        result = measure(module, args.repeat)
+        results['results'].append(result)
+
+        if 'error' in result:
+            print('{:<14} failed: {}'.format(module, result['error']), flush=True)
+            failed = True
+            continue
+        print('{:<14} {:.3f}s{}'.format(module, result['import_s'],
+                                         '  imports ' + ', '.join(result['heavy']) if result['heavy'] else ''),
+              flush=True)
+        failed = failed or len(result['heavy']) > 0
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+''' Cell, synapse and stimulation definitions used by the benchmarks, taken from
+run_simulations.ipynb so results stay comparable with the numbers measured there '''
+
+import typing as tp
+
+# NetPyNE
+NETPYNE_STIM_SOURCES = {'bkg': {'type': 'NetStim', 'rate': 10, 'noise': 0}}
+NETPYNE_DEFAULT_MECH = {'mod': 'Exp2Syn', 'tau1': 0.1, 'tau2': 5.0, 'e': 0}
+NETPYNE_DEFAULT_CELL = {'secs': {'soma': {'geom': {'diam': 18.8, 'L': 18.8, 'Ra': 123.0},
+                                          'mechs': {'hh': {'gnabar': 0.12, 'gkbar': 0.036,
+                                                           'gl': 0.003, 'el': -70}}}}}
+
+# Brian2. Quantities are kept as strings here so this module doesn't have to import brian2;
+# see brian2_namespace().
+BRIAN2_NEURON_EQS = '''
+dv/dt = (gl*(El-v) - g_na*(m*m*m)*h*(v-ENa) - g_kd*(n*n*n*n)*(v-EK) + I)/Cm : volt
+dm/dt = 0.32*(mV**-1)*4*mV/exprel((13.*mV-v+VT)/(4*mV))/ms*(1-m)-0.28*(mV**-1)*5*mV/exprel((v-VT-40.*mV)/(5*mV))/ms*m : 1
+dn/dt = 0.032*(mV**-1)*5*mV/exprel((15.*mV-v+VT)/(5*mV))/ms*(1.-n)-.5*exp((10.*mV-v+VT)/(40.*mV))/ms*n : 1
+dh/dt = 0.128*exp((17.*mV-v+VT)/(18.*mV))/ms*(1.-h)-4./(1+exp((40.*mV-v+VT)/(5.*mV)))/ms*h : 1
+I : amp
+'''
+BRIAN2_STIM_SOURCES = {'bkg': {'model': 'rates = 10*Hz : Hz', 'threshold': 'rand()<rates*dt'}}
+# Scaled by the synapse weight w, which is 1 unless parallel synapses were aggregated
+BRIAN2_DEFAULT_MECH = {'on_pre': 'v += w*10*mV'}
+BRIAN2_DEFAULT_CELL = {'model': BRIAN2_NEURON_EQS,
+                       'threshold': 'v > -40*mV',
+                       'refractory': 'v > -40*mV',
+                       'method': 'exponential_euler'}
+
+def brian2_namespace() -> tp.Dict:
+    ''' Namespace of the constants used by BRIAN2_DEFAULT_CELL '''
+
+    from brian2 import cm, mV, ms, msiemens, siemens, ufarad, umetre
+
+    # run_simulations.ipynb has a negative area, but BRIAN2_NEURON_EQS never uses it: the
+    # constants below are already scaled by the (positive) area
+    return {'area': 20000*umetre**2,
+            'Cm': 1*ufarad*cm**-2 * 20000*umetre**2,
+            'gl': 5e-5*siemens*cm**-2 * 20000*umetre**2,
+            'El': -65*mV,
+            'EK': -90*mV,
+            'ENa': 50*mV,
+            'g_na': 100*msiemens*cm**-2 * 20000*umetre**2,
+            'g_kd': 30*msiemens*cm**-2 * 20000*umetre**2,
+            'VT': -63*mV,
+            'tau1': 0.1*ms,
+            'tau2': 0.2*ms,
+            'e': 0}
+
+def stims(backend: str, targets: tp.List[str]) -> tp.List[tp.Dict]:
+    ''' NetworkIR stimulation specs driving every target from the 'bkg' source '''
+
+    if (backend == 'netpyne'):
+        return [{'source': 'bkg', 'target': target, 'weight': 0.5, 'delay': 1, 'mech': 'exc'}
+                for target in targets]
+    return [{'source': 'bkg', 'target': target} for target in targets]
@@ -0,0 +1,35 @@
+''' Record neuroNLP queries and their connectivity from a live FlyBrainLab client into a fixture
+that benchmarks.run can replay offline
+
+Has to be run in a flybrainlab Medulla client, e.g.
+
+    python -m benchmarks.record medulla.pkl.gz "show column C" "show column A and column C"
+'''
+
+import argparse
+import sys
+import typing as tp
+
+from .fake_client import RecordingClient
+
+def main(argv: tp.List[str]=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='fixture file to write')
+    parser.add_argument('queries', nargs='+')
+    parser.add_argument('--max-workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    import flybrainlab as fbl
+    from .run import ROOT
+    sys.path.insert(0, ROOT)
+    from src.NeuroNLP_to_Brian_Netpyne.connectivity import fetch_synapse_table
+
+    client = RecordingClient(fbl.get_client())
+    for query in args.queries:
+        res = client.executeNLPquery(query)
+        fetch_synapse_table(client, res.graph, max_workers=args.max_workers)
+
+    client.save(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+''' Benchmark both backends against synthetic networks or recorded fixtures
+
+Every case (backend, build mode, network) runs in a freshly spawned process, so peak memory
+and simulator global state don't leak between cases. For every case the following phases are
+timed, with the peak resident set size of the process after each:
+
+    build    fetch connectivity through the (fake) client and build the NetworkIR
+    create   emit simulator objects from the NetworkIR, and for NetPyNE instantiate the cells,
+             connections, stimulation and recordings in NEURON
+    compile  Brian2 code generation and compilation, measured as a run of zero duration. NEURON
+             mechanisms are compiled ahead of time, so this is null for NetPyNE.
+    run      simulate for the requested duration
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run --sizes 10 100 1000 10000 --output results.json
+    python -m benchmarks.run --fixture medulla.pkl.gz --query "show column C"
+
+and compare two result files with benchmarks.compare.
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import importlib.metadata
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import subprocess
+import sys
+import tempfile
+import typing as tp
+
+from . import models
+from .fake_client import FakeClient
+from .synthetic import medulla_like
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_case(case: tp.Dict) -> tp.Dict:
+    ''' Run a single benchmark case, meant to be called in a fresh process
+
+    :param case: case description, see cases()
+    :return: the case description, updated with network sizes and phase measurements
+    '''
+
+    sys.path.insert(0, ROOT)
+    from src.NeuroNLP_to_Brian_Netpyne.network_ir import network_from_query
+    from src.NeuroNLP_to_Brian_Netpyne.profiling import Profiler
+
+    if (case['fixture'] != None):
+        client = FakeClient.from_fixture(case['fixture'], latency=case['latency'])
+        query = case['query']
+    else:
+        client, query = medulla_like(case['n_neurons'],
+                                     synapses_per_neuron=case['synapses_per_neuron'],
+                                     latency=case['latency'],
+                                     seed=case['seed'])
+    res = client.executeNLPquery(query)
+
+    profiler = Profiler(trace_memory=case['trace_memory'])
+    output = open(os.devnull, 'w') if case['quiet'] else sys.stdout
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        with profiler.phase('build'):
+            network = network_from_query(client=client,
+                                         res=res,
+                                         stims=models.stims(case['backend'], case['stim']),
+                                         record_names=case['record'],
+                                         max_workers=case['max_workers'])
+
+        if (case['backend'] == 'netpyne'):
+            _run_netpyne(case, network, profiler)
+        else:
+            _run_brian2(case, network, profiler)
+    profiler.close()
+
+    # NEURON mechanisms are compiled ahead of time
+    results = {'compile_s': None}
+    for phase, total in profiler.report().totals().items():
+        results[phase + '_s'] = total['wall_s']
+        results[phase + '_cpu_s'] = total['cpu_s']
+        results[phase + '_peak_rss_mb'] = total['max_rss_mb']
+        if case['trace_memory']:
+            results[phase + '_peak_traced_mb'] = total['peak_mb']
+
+    return {**case,
+            'n_neurons': network.n_neurons,
+            'n_synapses': network.n_synapses,
+            'client_calls': client.calls,
+            **profiler.report().counts,
+            **results}
+
+def _run_netpyne(case: tp.Dict, network, profiler):
+    from netpyne import sim
+    from src.NeuroNLP_to_Brian_Netpyne.nlpToNetpyne import generate_simconfig, netparams_from_network
+
+    with tempfile.TemporaryDirectory() as directory:
+        with profiler.phase('create'):
+            networkParams = netparams_from_network(network=network,
+                                                   default_mech=models.NETPYNE_DEFAULT_MECH,
+                                                   default_cell=models.NETPYNE_DEFAULT_CELL,
+                                                   stim_sources=models.NETPYNE_STIM_SOURCES,
+                                                   vectorized=case['vectorized'])
+            simConfig = generate_simconfig(duration=case['duration'],
+                                           dt=case['dt'],
+                                           filename=os.path.join(directory, 'benchmark'),
+                                           cells=[networkParams.neuron_index[name] for name in case['record']
+                                                  if name in networkParams.neuron_index],
+                                           headless=True)
+
+            sim.initialize(netParams=networkParams, simConfig=simConfig)
+            sim.net.createPops()
+            sim.net.createCells()
+            sim.net.connectCells()
+            sim.net.addStims()
+            sim.setupRecording()
+
+        with profiler.phase('run'):
+            sim.runSim()
+            sim.gatherData()
+
+def _run_brian2(case: tp.Dict, network, profiler):
+    from brian2 import defaultclock, ms, prefs
+    from src.NeuroNLP_to_Brian_Netpyne.nlptoBrian2 import model_from_network
+
+    if (case['codegen'] != None):
+        prefs.codegen.target = case['codegen']
+    defaultclock.dt = case['dt'] * ms
+    namespace = models.brian2_namespace()
+
+    with profiler.phase('create'):
+        networkParams = model_from_network(network=network,
+                                           default_mech=models.BRIAN2_DEFAULT_MECH,
+                                           default_cell=models.BRIAN2_DEFAULT_CELL,
+                                           stim_sources=models.BRIAN2_STIM_SOURCES,
+                                           vectorized=case['vectorized'])
+
+    with profiler.phase('compile'):
+        networkParams.run(0 * ms, namespace=namespace)
+
+    with profiler.phase('run'):
+        networkParams.run(case['duration'] * ms, namespace=namespace)
+
+    profiler.count('code_objects', sum(len(getattr(o, 'code_objects', ())) for o in networkParams.sorted_objects))
+
+def cases(args: argparse.Namespace) -> tp.List[tp.Dict]:
+    ''' Expand command line arguments into a list of benchmark cases '''
+
+    if (args.fixture != None):
+        networks = [{'fixture': args.fixture, 'query': args.query, 'n_neurons': None}]
+        stim = args.stim if args.stim != None else ['Mi4-C']
+        record = args.record if args.record != None else ['L2-C', 'C2-C', 'Mi4-C']
+    else:
+        networks = [{'fixture': None, 'query': None, 'n_neurons': n} for n in args.sizes]
+        stim = args.stim if args.stim != None else ['L1-A', 'L2-A']
+        record = args.record if args.record != None else ['L1-A', 'L2-A', 'Mi4-A']
+
+    expanded = []
+    for network in networks:
+        for backend in args.backends:
+            for mode in args.modes:
+                # Legacy mode creates an object per neuron and per synapse, don't wait on it forever
+                if (mode == 'legacy' and network['n_neurons'] != None and network['n_neurons'] > args.max_legacy):
+                    continue
+
+                expanded.append({**network,
+                                 'backend': backend,
+                                 'vectorized': mode == 'vectorized',
+                                 'stim': stim,
+                                 'record': record,
+                                 'synapses_per_neuron': args.synapses_per_neuron,
+                                 'latency': args.latency,
+                                 'seed': args.seed,
+                                 'max_workers': args.max_workers,
+                                 'duration': args.duration,
+                                 'dt': args.dt,
+                                 'codegen': args.codegen,
+                                 'trace_memory': args.trace_memory,
+                                 'quiet': not args.verbose})
+
+    return expanded
+
+def metadata() -> tp.Dict:
+    ''' Commit, platform and package versions the benchmarks ran with '''
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    versions = {}
+    for package in ['numpy', 'networkx', 'brian2', 'netpyne', 'NEURON']:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+
+    return {'commit': commit,
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'versions': versions}
+
+def main(argv: tp.List[str]=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=['netpyne', 'brian2'], default=['netpyne', 'brian2'])
+    parser.add_argument('--modes', nargs='+', choices=['vectorized', 'legacy'], default=['vectorized', 'legacy'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000],
+                        help='numbers of neurons of the synthetic networks to benchmark')
+    parser.add_argument('--max-legacy', type=int, default=100,
+                        help='largest synthetic network to benchmark in legacy mode')
+    parser.add_argument('--fixture', help='fixture recorded with benchmarks.record to replay instead')
+    parser.add_argument('--query', help='query of the fixture to benchmark')
+    parser.add_argument('--stim', nargs='+', help='names of the neurons to stimulate')
+    parser.add_argument('--record', nargs='+', help='names of the neurons to record')
+    parser.add_argument('--synapses-per-neuron', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0, help='seconds every client lookup takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=100, help='simulated time, in ms')
+    parser.add_argument('--dt', type=float, default=0.025, help='integration timestep, in ms')
+    parser.add_argument('--codegen', help='brian2 code generation target, e.g. numpy or cython')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also measure peak Python allocations with tracemalloc (slow)')
+    parser.add_argument('--verbose', action='store_true', help="don't silence simulator output")
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args(argv)
+
+    if (args.fixture != None and args.query == None):
+        parser.error('--fixture requires --query')
+
+    results = {'meta': metadata(), 'results': []}
+    context = multiprocessing.get_context('spawn')
+    for case in cases(args):
+        label = '{} {} {}'.format(case['backend'], 'vectorized' if case['vectorized'] else 'legacy',
+                                  case['query'] if case['fixture'] != None else case['n_neurons'])
+        print('Running ' + label, flush=True)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                result = pool.submit(run_case, case).result()
+            except Exception as e:
+                result = {**case, 'error': repr(e)}
+        results['results'].append(result)
+
+        if 'error' in result:
+            print('    failed: ' + result['error'], flush=True)
+        else:
+            print('    ' + ', '.join('{} {:.3f}s'.format(phase, result[phase + '_s'])
+                                     for phase in ['build', 'create', 'compile', 'run']
+                                     if result[phase + '_s'] != None), flush=True)
+
+        # Write as we go, so an interrupted sweep still leaves its results behind
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
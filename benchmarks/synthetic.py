@@ -0,0 +1,144 @@
+import math
+import typing as tp
+
+import networkx as nx
+import numpy as np
+
+from .fake_client import FakeClient, FakeQueryResult
+
+# Cell types repeated in every synthetic column, loosely following the columnar cell types of
+# the medulla dataset
+CELL_TYPES = ['L1', 'L2', 'L3', 'L4', 'L5', 'C2', 'C3', 'T1', 'Mi1', 'Mi4', 'Mi9', 'Mi15',
+              'Tm1', 'Tm2', 'Tm3', 'Tm4', 'Tm9', 'Tm20', 'T4a', 'T4b', 'T4c', 'T4d', 'Dm8',
+              'R7', 'R8', 'Lawf2', 'TmY5a', 'Pm1']
+
+def column_name(index: int) -> str:
+    ''' Spreadsheet-style name of a column: A, B, ..., Z, AA, AB, ... '''
+
+    name = ''
+    index += 1
+    while (index > 0):
+        index, rest = divmod(index - 1, 26)
+        name = chr(ord('A') + rest) + name
+
+    return name
+
+def medulla_like(n_neurons: int,
+                 synapses_per_neuron: int=20,
+                 p_local: float=0.8,
+                 p_external: float=0.1,
+                 max_number: int=10,
+                 morphology: bool=False,
+                 latency: float=0,
+                 seed: int=0) -> tp.Tuple[FakeClient, str]:
+    ''' Generate a synthetic medulla-like network and a FakeClient that serves it
+
+    .. note::
+
+        Neurons are laid out in columns of CELL_TYPES, named like the real dataset ('Mi4-C'),
+        and columns are placed on a square grid. Every neuron receives synapses_per_neuron
+        synapses: a fraction p_local from its own column, the rest from one of the (up to
+        eight) neighbouring columns. A fraction p_external of the presynaptic partners lies
+        outside the query result, like partners outside the queried columns do for real
+        queries, and gets filtered out by the model builders. Every synapse has a random
+        'number' of 1 to max_number contacts.
+
+        Connectivity is stored as arrays and turned into client info only when it is looked
+        up, so 100k neuron networks fit in memory.
+
+    :param n_neurons: number of neurons in the network
+    :param synapses_per_neuron: number of presynaptic partners of every neuron
+    :param p_local: fraction of presynaptic partners in the same column
+    :param p_external: fraction of presynaptic partners that aren't part of the query result
+    :param max_number: maximum number of contacts of a synapse
+    :param morphology: whether to give neurons SWC morphologies, shared by every cell type
+    :param latency: seconds every lookup on the returned client sleeps for
+    :param seed: seed of the random generator, equal seeds generate equal networks
+    :return: the client, and the query string that returns the network from it
+    '''
+
+    rng = np.random.default_rng(seed)
+    n_types = len(CELL_TYPES)
+    n_columns = max(1, math.ceil(n_neurons / n_types))
+    side = math.ceil(math.sqrt(n_columns))
+
+    column = np.arange(n_neurons) // n_types
+    cell_type = np.arange(n_neurons) % n_types
+    unames = [CELL_TYPES[t] + '-' + column_name(c) for t, c in zip(cell_type.tolist(), column.tolist())]
+
+    # Presynaptic partners: same column, or a neighbouring one on the grid
+    post = np.repeat(np.arange(n_neurons), synapses_per_neuron)
+    row, col = np.divmod(column[post], side)
+    local = rng.random(len(post)) < p_local
+    row = np.where(local, row, np.clip(row + rng.integers(-1, 2, len(post)), 0, side - 1))
+    col = np.where(local, col, np.clip(col + rng.integers(-1, 2, len(post)), 0, side - 1))
+    pre_column = row * side + col
+    pre = pre_column * n_types + rng.integers(0, n_types, len(post))
+
+    # Partners past the last neuron don't exist in the query result either, like external ones
+    external = (rng.random(len(post)) < p_external) | (pre >= n_neurons)
+    pre[external] = -1 - rng.integers(0, 1000, np.count_nonzero(external))
+    number = rng.integers(1, max_number + 1, len(post))
+
+    # Reverse index, so outgoing synapses can be looked up as well
+    outgoing = np.argsort(np.where(pre >= 0, pre, n_neurons), kind='stable')
+    out_ptr = np.concatenate([[0], np.cumsum(np.bincount(pre[pre >= 0], minlength=n_neurons))])
+
+    def name(i: int) -> str:
+        if (i >= 0):
+            return unames[i]
+        return 'Tm5-X' + str(-i)
+
+    def detail(n: int) -> tp.Dict:
+        syn_uname = name(int(pre[n])) + '--' + unames[post[n]]
+        return {'syn_rid': '#syn' + str(n), 'syn_uname': syn_uname, 'number': int(number[n])}
+
+    def connectivity(rid: str) -> tp.Dict:
+        i = int(rid[2:])
+        incoming = range(i * synapses_per_neuron, (i + 1) * synapses_per_neuron)
+        return {'pre': {'details': [detail(n) for n in incoming]},
+                'post': {'details': [detail(n) for n in outgoing[out_ptr[i]:out_ptr[i + 1]]]}}
+
+    # Neuron and MorphologyData nodes, like a query result graph
+    G = nx.MultiDiGraph()
+    neurons = {}
+    shapes = [_swc(rng) for _ in range(n_types)] if morphology else None
+    for i, uname in enumerate(unames):
+        neurons['#n' + str(i)] = {'uname': uname, 'name': uname, 'class': 'Neuron'}
+        G.add_node('#n' + str(i), **neurons['#n' + str(i)])
+
+        data = {'uname': uname, 'class': 'MorphologyData'}
+        if morphology:
+            data.update(shapes[cell_type[i]])
+        G.add_node('#m' + str(i), **data)
+        G.add_edge('#n' + str(i), '#m' + str(i))
+
+    query = 'show ' + str(n_neurons) + ' synthetic neurons'
+    client = FakeClient({query: FakeQueryResult(G, neurons, {})}, connectivity, latency=latency)
+
+    return client, query
+
+def _swc(rng: np.random.Generator, n_dendrites: int=3, length: int=20) -> tp.Dict[str, tp.List]:
+    ''' Small random morphology: a soma with a few dendrites that branch once '''
+
+    rows = [[1, 1, 0, 0, 0, 5, -1]]
+    for d in range(n_dendrites):
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        parent = 1
+        for k in range(length):
+            position = direction * (5 + 2 * k)
+            rows.append([len(rows) + 1, 3, *position, 1 - 0.03 * k, parent])
+            parent = len(rows)
+
+            # Branch off halfway down the dendrite
+            if (k == length // 2):
+                side = rng.normal(size=3)
+                branch = parent
+                for b in range(length // 2):
+                    rows.append([len(rows) + 1, 3, *(position + side * 2 * (b + 1)), 0.5, branch])
+                    branch = len(rows)
+
+    rows = np.array(rows, dtype=np.float64)
+    return {column: rows[:, i].tolist() for i, column in
+            enumerate(['sample', 'identifier', 'x', 'y', 'z', 'r', 'parent'])}
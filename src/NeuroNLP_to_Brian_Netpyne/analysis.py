@@ -0,0 +1,227 @@
+import typing as tp
+
+import numpy as np
+
+from .network_ir import NetworkIR
+
+class SimulationResults:
+    ''' Spikes and traces of a simulation as NumPy arrays, in the same form for both backends
+
+    .. note::
+
+        Neurons are referred to by their index into names, which holds their unames. Spikes are
+        stored as two parallel arrays sorted by time, and traces as one (neurons, samples) array
+        per recorded variable.
+
+    :param names: uname of every neuron the results refer to
+    :param spike_times: time of every spike, in ms
+    :param spike_neurons: neuron index of every spike
+    :param t: sample times of the traces, in ms
+    :param traces: dictionary of recorded variables and their (neurons, samples) arrays, in mV
+                   for voltages
+    :param trace_neurons: neuron index of every row of the traces
+    :param duration: simulated time, in ms
+    '''
+
+    def __init__(self,
+                 names: tp.List[str],
+                 spike_times: np.ndarray,
+                 spike_neurons: np.ndarray,
+                 t: np.ndarray=None,
+                 traces: tp.Dict[str, np.ndarray]=None,
+                 trace_neurons: np.ndarray=None,
+                 duration: float=None):
+        order = np.argsort(spike_times, kind='stable')
+
+        self.names = np.asarray(names, dtype=str)
+        self.spike_times = np.asarray(spike_times, dtype=np.float64)[order]
+        self.spike_neurons = np.asarray(spike_neurons, dtype=np.int64)[order]
+        self.t = np.zeros(0) if t is None else np.asarray(t, dtype=np.float64)
+        self.traces = {} if traces is None else {var: np.asarray(trace) for var, trace in traces.items()}
+        self.trace_neurons = np.zeros(0, dtype=np.int64) if trace_neurons is None else np.asarray(trace_neurons, dtype=np.int64)
+        self.duration = duration
+
+    @property
+    def n_neurons(self) -> int:
+        return len(self.names)
+
+    def spikes_of(self, name: str) -> np.ndarray:
+        ''' Spike times of a single neuron, in ms '''
+
+        return self.spike_times[self.spike_neurons == self._index(name)]
+
+    def trace_of(self, name: str, var: str='v') -> np.ndarray:
+        ''' Recorded trace of a single neuron '''
+
+        rows = np.flatnonzero(self.trace_neurons == self._index(name))
+        if (len(rows) == 0):
+            raise KeyError(name + ' was not recorded')
+        return self.traces[var][rows[0]]
+
+    def save(self, path: str):
+        ''' Save the results to a compressed .npz file, see load() '''
+
+        np.savez_compressed(path,
+                            names=self.names,
+                            spike_times=self.spike_times,
+                            spike_neurons=self.spike_neurons,
+                            t=self.t,
+                            trace_neurons=self.trace_neurons,
+                            duration=np.array(np.nan if self.duration is None else self.duration),
+                            **{'trace_' + var: trace for var, trace in self.traces.items()})
+
+    @classmethod
+    def load(cls, path: str) -> 'SimulationResults':
+        ''' Load results saved with save() '''
+
+        with np.load(path) as f:
+            duration = float(f['duration'])
+            return cls(names=f['names'].tolist(),
+                       spike_times=f['spike_times'],
+                       spike_neurons=f['spike_neurons'],
+                       t=f['t'],
+                       traces={key[len('trace_'):]: f[key] for key in f.files if key.startswith('trace_')},
+                       trace_neurons=f['trace_neurons'],
+                       duration=None if np.isnan(duration) else duration)
+
+    def _index(self, name: str) -> int:
+        found = np.flatnonzero(self.names == name)
+        if (len(found) == 0):
+            raise KeyError(name)
+        return int(found[0])
+
+def firing_rates(results: SimulationResults, duration: float=None) -> np.ndarray:
+    ''' Mean firing rate of every neuron, in Hz
+
+    :param results: simulation results
+    :param duration: time the rates are averaged over, in ms. Defaults to the simulated time.
+    '''
+
+    if duration is None: duration = results.duration
+    if duration is None:
+        raise ValueError('duration is unknown, pass it in explicitly')
+
+    return np.bincount(results.spike_neurons, minlength=results.n_neurons) / (duration / 1000)
+
+def isi_stats(results: SimulationResults) -> tp.Dict[str, np.ndarray]:
+    ''' Interspike interval statistics of every neuron
+
+    :param results: simulation results
+    :return: dictionary of arrays with one entry per neuron: 'count' (number of intervals),
+             'mean' and 'std' of the intervals in ms, and their coefficient of variation 'cv'.
+             Statistics of neurons with fewer than two spikes are NaN.
+    '''
+
+    order = np.lexsort((results.spike_times, results.spike_neurons))
+    neurons = results.spike_neurons[order]
+    times = results.spike_times[order]
+
+    # Intervals between consecutive spikes of the same neuron
+    same = neurons[1:] == neurons[:-1]
+    isi = np.diff(times)[same]
+    owner = neurons[1:][same]
+
+    count = np.bincount(owner, minlength=results.n_neurons)
+    total = np.bincount(owner, weights=isi, minlength=results.n_neurons)
+    total_sq = np.bincount(owner, weights=isi**2, minlength=results.n_neurons)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean**2, 0))
+        cv = std / mean
+
+    return {'count': count, 'mean': mean, 'std': std, 'cv': cv}
+
+def connectivity_matrix(network: NetworkIR,
+                        labels: tp.Sequence[str]=None,
+                        weight: bool=False) -> tp.Tuple[tp.List[str], np.ndarray]:
+    ''' Number of synapses between every pair of populations of a network
+
+    .. note::
+
+        Synapses are counted by their syn_count, so a network gives the same matrix before
+        and after network_ir.aggregate_synapses() merged its parallel synapses.
+
+    :param network: network to summarize
+    :param labels: population label of every neuron. Defaults to the cell type, i.e. the part of
+                   the uname before the column ('Mi4' for 'Mi4-C').
+    :param weight: sum the syn_weight of the synapses instead of counting them
+    :return: sorted population labels, and a (populations, populations) matrix whose [a, b]
+             entry is the number (or total weight) of synapses from population a onto
+             population b
+    '''
+
+    if labels is None:
+        labels = [uname.split('-')[0] for uname in network.unames.tolist()]
+
+    populations, population = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    n = len(populations)
+
+    pre = population[network.synapse_pre()]
+    post = population[network.syn_post]
+    if weight:
+        matrix = np.bincount(pre * n + post, weights=network.syn_weight, minlength=n * n).reshape(n, n)
+    else:
+        matrix = np.bincount(pre * n + post, weights=network.syn_count, minlength=n * n).astype(np.int64).reshape(n, n)
+
+    return populations.tolist(), matrix
+
+def plot_raster(results: SimulationResults, ax=None):
+    ''' Plot the spikes of a simulation, one row per neuron
+
+    :param results: simulation results
+    :param ax: matplotlib axes to draw on, a new figure is created if not provided
+    '''
+
+    import matplotlib.pyplot as plt
+
+    if ax is None: ax = plt.figure().gca()
+    ax.scatter(results.spike_times, results.spike_neurons, s=2, marker='|')
+    ax.set_xlabel('Time (ms)')
+    ax.set_ylabel('Neuron')
+
+    return ax
+
+def plot_traces(results: SimulationResults, var: str='v', names: tp.List[str]=None, ax=None):
+    ''' Plot recorded traces of a simulation
+
+    :param results: simulation results
+    :param var: recorded variable to plot
+    :param names: neurons to plot, defaults to every recorded neuron
+    :param ax: matplotlib axes to draw on, a new figure is created if not provided
+    '''
+
+    import matplotlib.pyplot as plt
+
+    if ax is None: ax = plt.figure().gca()
+    if names is None:
+        names = results.names[results.trace_neurons].tolist()
+    for name in names:
+        ax.plot(results.t, results.trace_of(name, var), label=name)
+    ax.set_xlabel('Time (ms)')
+    ax.set_ylabel(var)
+    ax.legend()
+
+    return ax
+
+def plot_connectivity(populations: tp.List[str], matrix: np.ndarray, ax=None):
+    ''' Plot a population connectivity matrix (see connectivity_matrix())
+
+    :param populations: population labels
+    :param matrix: connectivity matrix, presynaptic populations along the rows
+    :param ax: matplotlib axes to draw on, a new figure is created if not provided
+    '''
+
+    import matplotlib.pyplot as plt
+
+    if ax is None: ax = plt.figure().gca()
+    image = ax.imshow(matrix, cmap='viridis')
+    ax.set_xticks(range(len(populations)))
+    ax.set_xticklabels(populations, rotation=90)
+    ax.set_yticks(range(len(populations)))
+    ax.set_yticklabels(populations)
+    ax.set_xlabel('Postsynaptic population')
+    ax.set_ylabel('Presynaptic population')
+    ax.figure.colorbar(image, ax=ax, label='Synapses')
+
+    return ax
@@ -0,0 +1,200 @@
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import os.path
+import sys
+import tempfile
+import time
+import traceback
+import typing as tp
+
+from .cache import QueryCache, execute_query
+from .network_ir import NetworkIR
+from .profiling import Profiler
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where memory limits are ignored
+    resource = None
+
+def run_batch(jobs: tp.List[tp.Dict],
+              client_factory: tp.Callable[[], tp.Any]=None,
+              cache_path: str=None,
+              max_workers: int=None,
+              timeout: float=None,
+              memory_limit_mb: float=None,
+              quiet: bool=True) -> tp.Iterator[tp.Dict]:
+    ''' Build and simulate many networks in parallel, each in a process of its own
+
+    .. note::
+
+        Every job runs in a freshly spawned process, so NetPyNE's global sim state and brian2's
+        device never leak from one job into another, and up to max_workers of them run at once.
+        Results are yielded in the order jobs finish, as soon as they do.
+
+        A job is a dict with the keys:
+
+            - 'backend': 'netpyne' or 'brian2'
+            - 'query': neuroNLP query string to build the network from, or
+            - 'network': NetworkIR, or path of one saved with NetworkIR.save(), to simulate
+              without any client lookups
+            - 'model': keyword arguments of the backend's model_gen(), e.g. definitions,
+              stimulation and recordings. filename defaults to a temporary file for netpyne.
+            - 'simulate': keyword arguments of the backend's simulate(), e.g. t and
+              internal_vars for brian2
+            - 'output': path to save the SimulationResults of the job to, instead of sending
+              them back (optional)
+            - 'label': anything identifying the job in its result (optional)
+
+        Jobs are simulated headless. Each yields a dict with the job's 'index' in jobs, its
+        'label', 'backend' and 'query', the 'results' (a SimulationResults, or None when
+        written to 'output'), the 'profile' of its phases (see Profiler), its total 'wall_s',
+        and an 'error' message, None if it succeeded. Jobs that run out of time are killed,
+        and jobs that run out of memory fail with a MemoryError or get killed by the system;
+        either way the rest of the batch carries on.
+
+    :param jobs: list of jobs, see above
+    :param client_factory: function returning an FBL client, called once in every process
+                           that runs a query. It has to be picklable, i.e. defined at the top
+                           level of a module. Not needed if every query and its connectivity
+                           are in the cache.
+    :param cache_path: path of a QueryCache to look queries and connectivity up in, shared by
+                       all processes
+    :param max_workers: maximum number of jobs to run at once, defaults to the number of CPUs
+    :param timeout: seconds after which a running job is killed
+    :param memory_limit_mb: address space limit of every job, in MB. Compilers run by a job
+                            (brian2 code generation) inherit it.
+    :param quiet: whether to silence the output of the simulators
+    '''
+
+    if max_workers == None: max_workers = os.cpu_count()
+
+    context = multiprocessing.get_context('spawn')
+    pending = list(enumerate(jobs))[::-1]
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_workers:
+            index, job = pending.pop()
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_worker,
+                                      args=(index, job, sender, client_factory, cache_path, memory_limit_mb, quiet),
+                                      daemon=True)
+            process.start()
+            sender.close()
+            running[index] = (job, process, receiver, time.perf_counter())
+
+        # Wake up as soon as a job finishes or dies, or the earliest timeout expires
+        wait = None
+        if (timeout != None):
+            wait = max(0, min(start + timeout for _, _, _, start in running.values()) - time.perf_counter())
+        ready = multiprocessing.connection.wait([r for _, _, r, _ in running.values()] +
+                                                [p.sentinel for _, p, _, _ in running.values()], wait)
+
+        for index, (job, process, receiver, start) in list(running.items()):
+            result = None
+            if (receiver in ready or process.sentinel in ready):
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    process.join()
+                    result = _failed(index, job, start, 'worker died with exit code ' + str(process.exitcode))
+            elif (timeout != None and time.perf_counter() - start > timeout):
+                process.kill()
+                result = _failed(index, job, start, 'timed out after ' + str(timeout) + ' s')
+
+            if (result != None):
+                process.join()
+                receiver.close()
+                del running[index]
+                yield result
+
+def run_job(job: tp.Dict,
+            client=None,
+            cache: QueryCache=None) -> tp.Tuple:
+    ''' Build and simulate a single job of run_batch() in this process
+
+    :param job: job description, see run_batch()
+    :param client: pointer to FBL client, only needed for queries that aren't cached
+    :param cache: QueryCache to look the query and its connectivity up in
+    :return: SimulationResults of the job, and the ProfileReport of its phases
+    '''
+
+    profiler = Profiler(trace_memory=False)
+    model = dict(job.get('model', {}))
+    sim_args = dict(job.get('simulate', {}))
+
+    res = None
+    network = job.get('network')
+    if isinstance(network, str):
+        network = NetworkIR.load(network)
+    if (network == None):
+        with profiler.phase('query'):
+            res = execute_query(client, job['query'], cache)
+
+    if (job['backend'] == 'netpyne'):
+        from . import nlpToNetpyne
+
+        with tempfile.TemporaryDirectory() as directory:
+            model.setdefault('filename', os.path.join(directory, 'batch'))
+            networkParams, simConfig = nlpToNetpyne.model_gen(client, res, network=network, cache=cache,
+                                                              profiler=profiler, headless=True, **model)
+            results = nlpToNetpyne.simulate(networkParams, simConfig, profiler=profiler, headless=True,
+                                            **sim_args)
+    elif (job['backend'] == 'brian2'):
+        from . import nlptoBrian2
+
+        model.setdefault('record_spikes', True)
+        networkParams = nlptoBrian2.model_gen(client, res, network=network, cache=cache,
+                                              profiler=profiler, **model)
+        results = nlptoBrian2.simulate(networkParams, profiler=profiler, headless=True, **sim_args)
+    else:
+        raise ValueError("backend must be 'netpyne' or 'brian2'")
+
+    profiler.close()
+
+    return results, profiler.report()
+
+def _worker(index: int,
+            job: tp.Dict,
+            sender,
+            client_factory: tp.Callable[[], tp.Any],
+            cache_path: str,
+            memory_limit_mb: float,
+            quiet: bool):
+    ''' Entry point of the processes spawned by run_batch() '''
+
+    start = time.perf_counter()
+    if (memory_limit_mb != None and resource != None):
+        limit = int(memory_limit_mb * 1024**2)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    try:
+        output = open(os.devnull, 'w') if quiet else sys.stdout
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            client = client_factory() if (client_factory != None and 'network' not in job) else None
+            cache = QueryCache(cache_path) if cache_path != None else None
+            results, report = run_job(job, client, cache)
+
+        if (job.get('output') != None):
+            results.save(job['output'])
+            results = None
+
+        result = {**_result(index, job, start), 'results': results, 'profile': report.to_dict(), 'error': None}
+    except BaseException as e:
+        result = _failed(index, job, start, ''.join(traceback.format_exception_only(type(e), e)).strip())
+
+    sender.send(result)
+    sender.close()
+
+def _result(index: int, job: tp.Dict, start: float) -> tp.Dict:
+    return {'index': index,
+            'label': job.get('label'),
+            'backend': job.get('backend'),
+            'query': job.get('query'),
+            'output': job.get('output'),
+            'wall_s': time.perf_counter() - start}
+
+def _failed(index: int, job: tp.Dict, start: float, error: str) -> tp.Dict:
+    return {**_result(index, job, start), 'results': None, 'profile': None, 'error': error}
@@ -0,0 +1,206 @@
+import os
+import os.path
+import pickle
+import sqlite3
+import threading
+import time
+import typing as tp
+import zlib
+
+class CachedQueryResult:
+    ''' Stand-in for an FBL NAqueryResult that was loaded from a QueryCache
+
+    Exposes the same graph, neurons and synapses attributes that the model builders use.
+    '''
+
+    def __init__(self, query: str, graph, neurons: tp.Dict, synapses: tp.Dict):
+        self.query = query
+        self.graph = graph
+        self.neurons = neurons
+        self.synapses = synapses
+
+class QueryCache:
+    ''' Persistent on-disk cache of neuroNLP query results and per-neuron connectivity
+
+    .. note::
+
+        Entries are pickled, zlib-compressed and stored in a single SQLite file. Once the
+        total size of the stored entries goes over max_bytes, the least recently used entries
+        are evicted. Every entry is tagged with the dataset version it was fetched from;
+        opening the cache with a different dataset_version drops all entries from other
+        versions, since rids and connectivity aren't stable across database releases.
+
+    :param path: path to the SQLite file to store the cache in, created if it doesn't exist
+    :param max_bytes: maximum total size of the stored entries, in bytes
+    :param dataset_version: version of the NeuroNLP dataset the entries belong to
+    :param compression: zlib compression level used for stored entries
+    '''
+
+    def __init__(self,
+                 path: str,
+                 max_bytes: int=1024**3,
+                 dataset_version: str="",
+                 compression: int=6):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dataset_version = str(dataset_version)
+        self.compression = compression
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'kind TEXT NOT NULL, '
+                         'key TEXT NOT NULL, '
+                         'version TEXT NOT NULL, '
+                         'data BLOB NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'last_used REAL NOT NULL, '
+                         'PRIMARY KEY (kind, key))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self.invalidate()
+
+    def get_query(self, query: str) -> tp.Optional[CachedQueryResult]:
+        ''' Look up the result of a neuroNLP query, or None if it isn't cached
+
+        :param query: neuroNLP query string
+        '''
+
+        entries = self._get('query', [query])
+        if query not in entries:
+            return None
+        return CachedQueryResult(query=query, **entries[query])
+
+    def put_query(self, query: str, res):
+        ''' Store the result of a neuroNLP query
+
+        :param query: neuroNLP query string
+        :param res: FBL NAqueryResult object returned for the query
+        '''
+
+        self._put('query', {query: {'graph': res.graph,
+                                    'neurons': dict(res.neurons),
+                                    'synapses': dict(res.synapses)}})
+
+    def get_connectivity(self, rids: tp.Iterable[str]) -> tp.Dict[str, tp.Dict]:
+        ''' Look up the stored connectivity of several neurons
+
+        :param rids: morphology rids of the neurons to look up
+        :return: dictionary of the rids that were found and their connectivity. Only the
+                 'pre' and 'post' details are stored: the model builders use the former, and
+                 incremental.grow_network() the latter.
+        '''
+
+        return self._get('connectivity', rids)
+
+    def put_connectivity(self, connectivity: tp.Dict[str, tp.Dict]):
+        ''' Store the connectivity of several neurons
+
+        :param connectivity: dictionary of rids and the 'connectivity' entry of their client info
+        '''
+
+        self._put('connectivity', {rid: {side: {'details': con[side]['details']} for side in ['pre', 'post'] if side in con}
+                                   for rid, con in connectivity.items()})
+
+    def invalidate(self, dataset_version: str=None):
+        ''' Drop every entry that doesn't belong to a dataset version
+
+        :param dataset_version: version to keep, defaults to the version the cache was opened with
+        '''
+
+        if dataset_version is not None:
+            self.dataset_version = str(dataset_version)
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM entries WHERE version != ?', (self.dataset_version,))
+
+    def clear(self):
+        ''' Drop every entry in the cache '''
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM entries')
+
+    def size(self) -> int:
+        ''' Total size of the stored entries, in bytes '''
+
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def close(self):
+        ''' Close the underlying database connection '''
+
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get(self, kind: str, keys: tp.Iterable[str]) -> tp.Dict[str, tp.Any]:
+        keys = list(keys)
+        found = {}
+
+        with self._lock, self._db:
+            # Stay well below SQLite's limit on the number of bound parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute('SELECT key, data FROM entries WHERE kind = ? AND version = ? '
+                                        'AND key IN (' + ','.join('?' * len(chunk)) + ')',
+                                        [kind, self.dataset_version] + chunk).fetchall()
+                for key, data in rows:
+                    found[key] = pickle.loads(zlib.decompress(data))
+
+            now = time.time()
+            self._db.executemany('UPDATE entries SET last_used = ? WHERE kind = ? AND key = ?',
+                                 [(now, kind, key) for key in found])
+
+        return found
+
+    def _put(self, kind: str, entries: tp.Dict[str, tp.Any]):
+        now = time.time()
+        rows = []
+        for key, value in entries.items():
+            data = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), self.compression)
+            rows.append((kind, key, self.dataset_version, data, len(data), now))
+
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until we fit in max_bytes again
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evict = []
+        for kind, key, size in self._db.execute('SELECT kind, key, size FROM entries ORDER BY last_used ASC'):
+            if total <= self.max_bytes:
+                break
+            evict.append((kind, key))
+            total -= size
+        self._db.executemany('DELETE FROM entries WHERE kind = ? AND key = ?', evict)
+
+def execute_query(client,
+                  query: str,
+                  cache: QueryCache=None):
+    ''' Run a neuroNLP query, reusing a cached result when there is one
+
+    :param client: pointer to FBL client
+    :param query: neuroNLP query string
+    :param cache: QueryCache to look the result up in and store it to
+    :return: FBL NAqueryResult, or a CachedQueryResult on a cache hit
+    '''
+
+    if cache is None:
+        return client.executeNLPquery(query)
+
+    res = cache.get_query(query)
+    if res is None:
+        res = client.executeNLPquery(query)
+        cache.put_query(query, res)
+
+    return res
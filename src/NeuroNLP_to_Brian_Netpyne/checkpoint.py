@@ -0,0 +1,358 @@
+import json
+import os
+import os.path
+import typing as tp
+
+import numpy as np
+
+from .analysis import SimulationResults
+from .profiling import Profiler
+from .snapshot import load_model, save_model
+
+class Checkpoint:
+    ''' Periodic checkpoints of the state of a simulation, written to a directory while it runs
+
+    .. note::
+
+        Pass one to simulate() of either backend, and the state of the simulation is written
+        every every ms of simulated time and once more when the run ends, each checkpoint
+        replacing the previous one. A snapshot of the model itself (see snapshot.save_model())
+        is written when the run starts, so resume() and fork() can rebuild the network in a
+        fresh process, e.g. after a crash, without the query or the definitions it was
+        generated from.
+
+        Brian2 states are written with Network.store(), undelivered spikes and the state of
+        the random number generator included, and brian2 networks are run in every ms chunks
+        to write them. NEURON states are written with SaveState, which holds every state
+        variable and the event queue, along with the spikes and traces netpyne recorded so
+        far, so resumed runs return the results of the whole simulation. Networks generated
+        with execution='cpp_standalone' can't be checkpointed.
+
+        Every file is written next to its final name first and moved over it, so a run that
+        dies while checkpointing leaves the previous checkpoint intact.
+
+    :param directory: directory to write checkpoints to, created if it doesn't exist
+    :param every: interval between checkpoints, in ms of simulated time
+    '''
+
+    def __init__(self, directory: str, every: float=1000.0):
+        self.directory = directory
+        self.every = every
+
+        self._next = None
+
+    @property
+    def t(self) -> tp.Optional[float]:
+        ''' Simulated time of the last checkpoint written, in ms, or None if there is none '''
+
+        meta = self.meta()
+        return meta.get('t') if meta != None else None
+
+    def meta(self) -> tp.Optional[tp.Dict]:
+        ''' Backend, duration and time of the checkpoint, or None if nothing was written yet '''
+
+        path = os.path.join(self.directory, 'checkpoint.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def begin(self, networkParams, duration: float, simConfig=None):
+        ''' Write the model about to be run, before its first checkpoint
+
+        :param networkParams: network about to be simulated, as generated by either backend
+        :param duration: simulated time the run ends at, in ms
+        :param simConfig: netpyne SimConfig object the network is simulated with
+        '''
+
+        if (getattr(networkParams, 'standalone', None) != None):
+            raise ValueError("cpp_standalone simulations can't be checkpointed")
+
+        os.makedirs(self.directory, exist_ok=True)
+        _replace(os.path.join(self.directory, 'model.snapshot'),
+                 lambda path: save_model(path, networkParams, simConfig))
+        self._write_meta({'backend': _backend(networkParams), 'duration': duration, 'every': self.every, 't': None})
+        self._next = None
+
+    def due(self, t: float) -> bool:
+        ''' Whether a checkpoint is due at simulated time t, in ms '''
+
+        if self._next == None:
+            self._next = self.every
+        return t >= self._next - 1e-9
+
+    def save(self, networkParams, t: float):
+        ''' Write a checkpoint of the state of a running network
+
+        :param networkParams: network being simulated
+        :param t: current simulated time, in ms
+        '''
+
+        if (_backend(networkParams) == 'netpyne'):
+            _replace(os.path.join(self.directory, 'state.dat'), _save_neuron_state)
+            _replace(os.path.join(self.directory, 'recorded.npz'), _save_sim_data)
+        else:
+            _replace(os.path.join(self.directory, 'state.pkl'),
+                     lambda path: networkParams.store('checkpoint', filename=path))
+
+        self._write_meta({**self.meta(), 't': t})
+        self._next = (np.floor(t / self.every + 1e-9) + 1) * self.every
+
+    def restore(self, networkParams):
+        ''' Restore the state of the last checkpoint into a network built from its model
+
+        NetPyNE networks have to be created and initialized first (see resume()).
+        '''
+
+        if (_backend(networkParams) == 'netpyne'):
+            _restore_neuron_state(os.path.join(self.directory, 'state.dat'))
+            _restore_sim_data(os.path.join(self.directory, 'recorded.npz'))
+        else:
+            networkParams.restore('checkpoint', filename=os.path.join(self.directory, 'state.pkl'),
+                                  restore_random_state=True)
+        self._next = None
+
+    def load(self):
+        ''' The model of the checkpoint, see snapshot.load_model() '''
+
+        return load_model(os.path.join(self.directory, 'model.snapshot'), mmap=False)
+
+    def _write_meta(self, meta: tp.Dict):
+        def write(path: str):
+            with open(path, 'w') as f:
+                json.dump(meta, f)
+
+        _replace(os.path.join(self.directory, 'checkpoint.json'), write)
+
+def run_brian2(networkParams, t: float, internal_vars: tp.Dict, checkpoint: Checkpoint):
+    ''' Run a brian2 network for t ms, in chunks ending at every multiple of checkpoint.every ms,
+    with a checkpoint after each. The checkpoint has to be begun already. '''
+
+    from brian2 import defaultclock, ms
+
+    stop = float(networkParams.t / ms) + t
+    while (stop - float(networkParams.t / ms) > float(defaultclock.dt / ms) / 2):
+        now = float(networkParams.t / ms)
+        networkParams.run((min(checkpoint.every * (np.floor(now / checkpoint.every + 1e-9) + 1), stop) - now) * ms,
+                          namespace=internal_vars)
+        checkpoint.save(networkParams, float(networkParams.t / ms))
+
+def resume(directory: str,
+           duration: float=None,
+           internal_vars: tp.Dict=None,
+           every: float=None,
+           profiler: Profiler=None) -> tp.Tuple[tp.Any, SimulationResults]:
+    ''' Continue a checkpointed simulation from its last checkpoint, in this process
+
+    .. note::
+
+        The network is rebuilt from the model of the checkpoint, its state is restored, and
+        it is simulated until the end of the original run (or duration), writing checkpoints
+        to the same directory as it goes. Brian2 runs continue exactly where they left off,
+        random numbers included. NetPyNE runs continue from the state of every NEURON object,
+        though NetStims with noise draw different random numbers than the original run would
+        have.
+
+    :param directory: directory of the checkpoint
+    :param duration: simulated time to end the run at, in ms. Defaults to that of the
+                     original run.
+    :param internal_vars: predefined network variables, for brian2 networks
+    :param every: interval between checkpoints, defaults to the interval they were written at
+    :param profiler: Profiler to record the 'create', 'run' and 'analysis' phases in
+    :return: the network, and the results of the whole simulation
+    '''
+
+    if profiler == None: profiler = Profiler(enabled=False)
+
+    checkpoint = Checkpoint(directory)
+    meta = checkpoint.meta()
+    if meta == None or meta['t'] == None:
+        raise FileNotFoundError('no checkpoint in ' + directory)
+    if duration == None: duration = meta['duration']
+    checkpoint.every = every if every != None else meta['every']
+
+    if (meta['backend'] == 'brian2'):
+        from .nlptoBrian2 import simulation_results
+
+        with profiler.phase('create'):
+            networkParams = checkpoint.load()
+            checkpoint.restore(networkParams)
+        with profiler.phase('run'):
+            run_brian2(networkParams, duration - meta['t'], internal_vars if internal_vars != None else {},
+                       checkpoint)
+        with profiler.phase('analysis'):
+            return networkParams, simulation_results(networkParams)
+
+    from neuron import h
+    from netpyne import sim
+    from .nlpToNetpyne import simulation_results
+
+    with profiler.phase('create'):
+        networkParams, simConfig = checkpoint.load()
+        simConfig.duration = duration
+        sim.create(netParams=networkParams, simConfig=simConfig)
+        sim.preRun()
+        h.finitialize(float(sim.cfg.hParams['v_init']))
+        checkpoint.restore(networkParams)
+
+    with profiler.phase('run'):
+        sim.timing('start', 'runTime')
+        while (h.t < duration - sim.cfg.dt / 2):
+            sim.pc.psolve(min(duration, checkpoint.every * (np.floor(h.t / checkpoint.every + 1e-9) + 1)))
+            checkpoint.save(networkParams, h.t)
+        sim.timing('stop', 'runTime')
+        sim.gatherData()
+
+    with profiler.phase('analysis'):
+        return networkParams, simulation_results(networkParams)
+
+def fork(directory: str,
+         points: tp.List[tp.Dict],
+         duration: float,
+         internal_vars: tp.Dict=None,
+         profiler: Profiler=None) -> tp.Iterator[tp.Tuple[tp.Dict, SimulationResults]]:
+    ''' Continue a checkpointed simulation several times from the same state
+
+    .. note::
+
+        Warm a network up once, checkpointing it, then branch any number of protocols off its
+        state: the network is built once, and every point restores the checkpoint, changes
+        the parameters of the point, and runs for duration ms. Points are keyed like those of
+        sweep.sweep(): '<object name>.<variable>' for brian2 networks, and '<label>.<parameter>'
+        for netpyne networks. The results of every point are yielded as soon as it has run,
+        and hold the warm-up along with the continuation.
+
+    :param directory: directory of the checkpoint
+    :param points: list of parameter points, see sweep.grid()
+    :param duration: simulated time to run every point for, after the checkpoint, in ms
+    :param internal_vars: predefined network variables, for brian2 networks
+    :param profiler: Profiler to record the 'create', 'run' and 'analysis' phases in
+    '''
+
+    if profiler == None: profiler = Profiler(enabled=False)
+
+    checkpoint = Checkpoint(directory)
+    meta = checkpoint.meta()
+    if meta == None or meta['t'] == None:
+        raise FileNotFoundError('no checkpoint in ' + directory)
+
+    if (meta['backend'] == 'brian2'):
+        return _fork_brian2(checkpoint, meta, points, duration, internal_vars, profiler)
+    return _fork_netpyne(checkpoint, meta, points, duration, profiler)
+
+def _fork_brian2(checkpoint: Checkpoint, meta: tp.Dict, points: tp.List[tp.Dict], duration: float,
+                 internal_vars: tp.Dict, profiler: Profiler):
+    from brian2 import ms
+    from .nlptoBrian2 import _run_args, simulation_results
+
+    if internal_vars == None: internal_vars = {}
+
+    with profiler.phase('create'):
+        networkParams = checkpoint.load()
+
+    for point in points:
+        namespace = dict(internal_vars)
+        with profiler.phase('run'):
+            checkpoint.restore(networkParams)
+            for variable, value in _run_args(networkParams, {k: v for k, v in point.items() if '.' in k}).items():
+                variable[:] = value
+            namespace.update({key: value for key, value in point.items() if '.' not in key})
+
+            networkParams.run(duration * ms, namespace=namespace)
+
+        with profiler.phase('analysis'):
+            results = simulation_results(networkParams)
+
+        yield point, results
+
+def _fork_netpyne(checkpoint: Checkpoint, meta: tp.Dict, points: tp.List[tp.Dict], duration: float,
+                  profiler: Profiler):
+    from neuron import h
+    from netpyne import sim
+    from .nlpToNetpyne import simulation_results
+    from .sweep import _set_netpyne
+
+    with profiler.phase('create'):
+        networkParams, simConfig = checkpoint.load()
+        simConfig.duration = meta['t'] + duration
+        sim.create(netParams=networkParams, simConfig=simConfig)
+        sim.preRun()
+
+    for point in points:
+        with profiler.phase('run'):
+            h.finitialize(float(sim.cfg.hParams['v_init']))
+            checkpoint.restore(networkParams)
+            for key, value in point.items():
+                label, parameter = key.rsplit('.', 1)
+                _set_netpyne(sim, label, parameter, value)
+
+            sim.timing('start', 'runTime')
+            sim.pc.psolve(sim.cfg.duration)
+            sim.timing('stop', 'runTime')
+            sim.gatherData()
+
+        with profiler.phase('analysis'):
+            results = simulation_results(networkParams)
+
+        yield point, results
+
+def _backend(networkParams) -> str:
+    return 'netpyne' if hasattr(networkParams, 'popParams') else 'brian2'
+
+def _replace(path: str, write: tp.Callable[[str], None]):
+    ''' Write a file through a temporary file next to it, then move it over path '''
+
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    write(partial)
+    os.replace(partial, path)
+
+def _save_neuron_state(path: str):
+    from neuron import h
+
+    state = h.SaveState()
+    state.save()
+    f = h.File()
+    f.wopen(path)
+    state.fwrite(f)
+    f.close()
+
+def _restore_neuron_state(path: str):
+    from neuron import h
+
+    state = h.SaveState()
+    f = h.File()
+    f.ropen(path)
+    state.fread(f)
+    f.close()
+    state.restore()
+
+def _save_sim_data(path: str):
+    ''' Save the spikes and traces netpyne has recorded so far, NEURON doesn't keep them in its state '''
+
+    from netpyne import sim
+    from neuron import h
+
+    # netpyne's Dict answers any attribute, so look for the vectors by type
+    vector_type = type(h.Vector())
+    arrays = {}
+    for key, value in sim.simData.items():
+        if isinstance(value, vector_type):
+            arrays[key] = value.as_numpy().copy()
+        elif isinstance(value, dict):
+            arrays.update({key + '/' + cell: vector.as_numpy().copy() for cell, vector in value.items()
+                           if isinstance(vector, vector_type)})
+
+    # np.savez adds .npz to names without it
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+def _restore_sim_data(path: str):
+    from netpyne import sim
+
+    with np.load(path) as f:
+        for name in f.files:
+            key, _, cell = name.partition('/')
+            vector = sim.simData[key][cell] if cell else sim.simData[key]
+            vector.from_python(f[name])
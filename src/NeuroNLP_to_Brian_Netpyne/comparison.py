@@ -0,0 +1,320 @@
+import typing as tp
+
+import numpy as np
+
+from .analysis import SimulationResults, firing_rates
+from .profiling import ProfileReport
+
+def align_traces(a: SimulationResults,
+                 b: SimulationResults,
+                 var: str='v',
+                 dt: float=None) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    ''' Traces of the neurons recorded by both simulations, resampled onto a shared time grid
+
+    .. note::
+
+        NetPyNE samples traces every recordStep and Brian2 every dt, and the first sample of
+        either can be at 0 or after the first step. Both are linearly interpolated onto a grid
+        covering the time recorded by both, every dt ms, which defaults to the coarser of
+        their sampling steps, so neither is compared at a resolution it wasn't recorded at.
+
+    :param a: results of one simulation
+    :param b: results of the other simulation, e.g. of the other backend
+    :param var: recorded variable to align
+    :param dt: step of the shared time grid, in ms
+    :return: unames of the neurons recorded by both, the times of the grid, and the traces of
+             a and of b as (neurons, samples) arrays in the same neuron order
+    '''
+
+    names_a = a.names[a.trace_neurons] if var in a.traces else np.zeros(0, dtype=str)
+    names_b = b.names[b.trace_neurons] if var in b.traces else np.zeros(0, dtype=str)
+    names, rows_a, rows_b = np.intersect1d(names_a, names_b, return_indices=True)
+    if (len(names) == 0 or a.traces[var].shape[1] == 0 or b.traces[var].shape[1] == 0):
+        return names, np.zeros(0), np.zeros((len(names), 0)), np.zeros((len(names), 0))
+
+    if dt is None:
+        dt = max(_step(a.t), _step(b.t))
+    start = max(a.t[0], b.t[0])
+    stop = min(a.t[-1], b.t[-1])
+    t = start + dt * np.arange(max(int(np.floor((stop - start) / dt + 1e-9)) + 1, 0))
+
+    return (names, t,
+            _interpolate(a.t, a.traces[var][rows_a], t),
+            _interpolate(b.t, b.traces[var][rows_b], t))
+
+def trace_errors(a: SimulationResults,
+                 b: SimulationResults,
+                 var: str='v',
+                 dt: float=None) -> tp.Dict[str, np.ndarray]:
+    ''' Differences between the traces of the neurons recorded by both simulations
+
+    :param a: results of one simulation
+    :param b: results of the other simulation
+    :param var: recorded variable to compare
+    :param dt: step of the time grid the traces are compared on, see align_traces()
+    :return: dictionary of arrays with one entry per neuron recorded by both: their 'names',
+             the root mean square error 'rmse', the largest absolute difference 'max_abs', and
+             the Pearson 'correlation' of the traces (NaN if either is flat)
+    '''
+
+    names, _, traces_a, traces_b = align_traces(a, b, var, dt)
+    if (traces_a.shape[1] == 0):
+        nan = np.full(len(names), np.nan)
+        return {'names': names, 'rmse': nan, 'max_abs': nan, 'correlation': nan}
+
+    difference = traces_a - traces_b
+    centered_a = traces_a - traces_a.mean(axis=1, keepdims=True)
+    centered_b = traces_b - traces_b.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = (centered_a * centered_b).sum(axis=1) / np.sqrt((centered_a**2).sum(axis=1)
+                                                                      * (centered_b**2).sum(axis=1))
+
+    return {'names': names,
+            'rmse': np.sqrt(np.mean(difference**2, axis=1)),
+            'max_abs': np.max(np.abs(difference), axis=1),
+            'correlation': correlation}
+
+def match_spikes(a: SimulationResults,
+                 b: SimulationResults,
+                 window: float=1.0,
+                 duration: float=None) -> tp.Dict[str, np.ndarray]:
+    ''' Match the spikes of every neuron of one simulation to those of the other
+
+    .. note::
+
+        A spike is matched if the same neuron spiked in the other simulation within window ms
+        of it. Every spike is looked up with a single searchsorted over the spikes of the other
+        simulation, keyed by neuron and time so spikes of different neurons never match.
+
+        The coincidence factor of Kistler et al. (1997) corrects the number of matches for the
+        coincidences expected by chance at the firing rate of b: it is 1 for identical spike
+        trains, around 0 for unrelated ones, and NaN for neurons that didn't spike in either.
+
+    :param a: results of one simulation
+    :param b: results of the other simulation
+    :param window: largest difference between matching spike times, in ms
+    :param duration: simulated time, in ms. Defaults to that of the results.
+    :return: dictionary of arrays with one entry per neuron of both simulations: their 'names',
+             numbers of spikes ('spikes_a' and 'spikes_b') and of matched spikes ('matched_a'
+             and 'matched_b'), the 'mean_offset' of the matched spikes of a to their nearest
+             spike of b in ms, and the 'coincidence' factor
+    '''
+
+    if duration is None: duration = a.duration if a.duration is not None else b.duration
+    if duration is None:
+        duration = max(np.max(a.spike_times, initial=0), np.max(b.spike_times, initial=0))
+
+    names, index_a, index_b = np.intersect1d(a.names, b.names, return_indices=True)
+    neuron_a = _lookup(index_a, a.n_neurons)[a.spike_neurons]
+    neuron_b = _lookup(index_b, b.n_neurons)[b.spike_neurons]
+    times_a = a.spike_times[neuron_a >= 0]
+    times_b = b.spike_times[neuron_b >= 0]
+    neuron_a = neuron_a[neuron_a >= 0]
+    neuron_b = neuron_b[neuron_b >= 0]
+
+    # Neurons are spaced further apart than any two spike times can be
+    span = max(duration, np.max(times_a, initial=0), np.max(times_b, initial=0)) + 2 * window + 1
+    keys_a = np.sort(neuron_a * span + times_a)
+    keys_b = np.sort(neuron_b * span + times_b)
+    neuron_a = np.floor(keys_a / span).astype(np.int64)
+    neuron_b = np.floor(keys_b / span).astype(np.int64)
+
+    offset_a = _nearest(keys_a, keys_b)
+    offset_b = _nearest(keys_b, keys_a)
+    matched_a = np.abs(offset_a) <= window
+    matched_b = np.abs(offset_b) <= window
+
+    n = len(names)
+    spikes_a = np.bincount(neuron_a, minlength=n)
+    spikes_b = np.bincount(neuron_b, minlength=n)
+    coincidences = np.bincount(neuron_a[matched_a], minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_offset = np.bincount(neuron_a[matched_a], weights=np.abs(offset_a[matched_a]), minlength=n) / coincidences
+
+        rate_b = spikes_b / duration
+        expected = 2 * rate_b * window * spikes_a
+        coincidence = (coincidences - expected) / (0.5 * (spikes_a + spikes_b)) / (1 - 2 * rate_b * window)
+
+    return {'names': names,
+            'spikes_a': spikes_a,
+            'spikes_b': spikes_b,
+            'matched_a': coincidences,
+            'matched_b': np.bincount(neuron_b[matched_b], minlength=n),
+            'mean_offset': mean_offset,
+            'coincidence': coincidence}
+
+def rate_differences(a: SimulationResults,
+                     b: SimulationResults,
+                     duration: float=None) -> tp.Dict[str, np.ndarray]:
+    ''' Firing rates of every neuron of both simulations, side by side
+
+    :param a: results of one simulation
+    :param b: results of the other simulation
+    :param duration: time the rates are averaged over, in ms (see analysis.firing_rates())
+    :return: dictionary of arrays with one entry per neuron of both simulations: their 'names',
+             their rates in Hz ('rate_a' and 'rate_b'), and the 'difference' of b to a
+    '''
+
+    names, index_a, index_b = np.intersect1d(a.names, b.names, return_indices=True)
+    rate_a = firing_rates(a, duration)[index_a]
+    rate_b = firing_rates(b, duration)[index_b]
+
+    return {'names': names, 'rate_a': rate_a, 'rate_b': rate_b, 'difference': rate_b - rate_a}
+
+def compare_results(a: SimulationResults,
+                    b: SimulationResults,
+                    labels: tp.Tuple[str, str]=('netpyne', 'brian2'),
+                    profiles: tp.Dict[str, ProfileReport]=None,
+                    var: str='v',
+                    window: float=1.0,
+                    dt: float=None) -> tp.Dict:
+    ''' Compact report comparing two simulations of the same network, e.g. one per backend
+
+    .. note::
+
+        Everything is reduced to a few numbers per simulation, so the reports of a sweep over
+        many queries can be written to JSON and compared unattended, and print side by side
+        with format_comparison(). Use trace_errors(), match_spikes() and rate_differences()
+        for the numbers of every neuron.
+
+    :param a: results of one simulation
+    :param b: results of the other simulation
+    :param labels: names of the two simulations
+    :param profiles: ProfileReport of every simulation, keyed by label, to report the time of
+                     every phase and the peak memory of each
+    :param var: recorded variable whose traces to compare
+    :param window: largest difference between matching spike times, in ms
+    :param dt: step of the time grid traces are compared on, see align_traces()
+    :return: dictionary of the 'labels', the number of 'neurons' both simulations share, and
+             per simulation ('spikes', 'rate_hz', 'matched' fraction of spikes, and the 'phases'
+             times, 'total_s' and 'peak_rss_mb' of its profile), along with 'rates' (mean and
+             largest absolute difference), 'spike_matching' and 'traces' summaries
+    '''
+
+    if profiles is None: profiles = {}
+
+    rates = rate_differences(a, b, _duration(a, b))
+    spikes = match_spikes(a, b, window, _duration(a, b))
+    errors = trace_errors(a, b, var, dt)
+
+    simulations = {}
+    for label, n_spikes, matched, rate in [(labels[0], spikes['spikes_a'], spikes['matched_a'], rates['rate_a']),
+                                           (labels[1], spikes['spikes_b'], spikes['matched_b'], rates['rate_b'])]:
+        simulations[label] = {'spikes': int(n_spikes.sum()),
+                              'rate_hz': _mean(rate),
+                              'matched': float(matched.sum() / n_spikes.sum()) if n_spikes.sum() > 0 else None}
+        if label in profiles:
+            simulations[label].update(_profile_summary(profiles[label]))
+
+    return {'labels': list(labels),
+            'neurons': len(rates['names']),
+            'simulations': simulations,
+            'rates': {'mean_abs_difference_hz': _mean(np.abs(rates['difference'])),
+                      'max_abs_difference_hz': _max(np.abs(rates['difference']))},
+            'spike_matching': {'window_ms': window,
+                               'mean_offset_ms': _mean(spikes['mean_offset']),
+                               'coincidence': _mean(spikes['coincidence'])},
+            'traces': {'var': var,
+                       'neurons': len(errors['names']),
+                       'mean_rmse': _mean(errors['rmse']),
+                       'max_abs': _max(errors['max_abs']),
+                       'mean_correlation': _mean(errors['correlation'])}}
+
+def format_comparison(report: tp.Dict) -> str:
+    ''' A report of compare_results() as a table, with the two simulations side by side '''
+
+    labels = report['labels']
+    simulations = [report['simulations'][label] for label in labels]
+    phases = []
+    for simulation in simulations:
+        phases.extend(phase for phase in simulation.get('phases', {}) if phase not in phases)
+
+    rows = [('spikes', [s['spikes'] for s in simulations]),
+            ('rate (Hz)', [s['rate_hz'] for s in simulations]),
+            ('matched', [s['matched'] for s in simulations])]
+    rows += [(phase + ' (s)', [s.get('phases', {}).get(phase) for s in simulations]) for phase in phases]
+    rows += [('total (s)', [s.get('total_s') for s in simulations]),
+             ('peak rss (MB)', [s.get('peak_rss_mb') for s in simulations])]
+
+    lines = ['{:<16} {:>12} {:>12}'.format('', *labels)]
+    for name, values in rows:
+        lines.append('{:<16} {:>12} {:>12}'.format(name, *[_format(value) for value in values]))
+    lines.append('')
+    lines.append('{:<16} {}'.format('neurons', report['neurons']))
+    lines.append('{:<16} mean {} max {}'.format('rate diff (Hz)', _format(report['rates']['mean_abs_difference_hz']),
+                                                _format(report['rates']['max_abs_difference_hz'])))
+    lines.append('{:<16} {} (mean offset {} ms, window {} ms)'.format(
+        'coincidence', _format(report['spike_matching']['coincidence']),
+        _format(report['spike_matching']['mean_offset_ms']), report['spike_matching']['window_ms']))
+    lines.append('{:<16} {} traces: mean rmse {} max {} mean r {}'.format(
+        report['traces']['var'], report['traces']['neurons'], _format(report['traces']['mean_rmse']),
+        _format(report['traces']['max_abs']), _format(report['traces']['mean_correlation'])))
+
+    return '\n'.join(lines)
+
+def _step(t: np.ndarray) -> float:
+    ''' Sampling step of a trace, robust to a missing or duplicated first sample '''
+
+    return float(np.median(np.diff(t))) if len(t) > 1 else 0.0
+
+def _interpolate(t: np.ndarray, traces: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    ''' Linear interpolation of every row of traces sampled at t onto grid, all rows at once '''
+
+    if (len(t) == 1):
+        return np.repeat(traces[:, :1], len(grid), axis=1)
+
+    i = np.clip(np.searchsorted(t, grid, side='right') - 1, 0, len(t) - 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.nan_to_num((grid - t[i]) / (t[i + 1] - t[i]))
+
+    return traces[:, i] * (1 - fraction) + traces[:, i + 1] * fraction
+
+def _lookup(index: np.ndarray, n: int) -> np.ndarray:
+    ''' Array mapping neuron indices of a result to shared neuron indices, -1 if not shared '''
+
+    lookup = np.full(n, -1, dtype=np.int64)
+    lookup[index] = np.arange(len(index))
+    return lookup
+
+def _nearest(keys: np.ndarray, other: np.ndarray) -> np.ndarray:
+    ''' Signed distance from every key to the nearest key of a sorted other, inf if it is empty '''
+
+    if (len(other) == 0):
+        return np.full(len(keys), np.inf)
+
+    i = np.searchsorted(other, keys)
+    after = other[np.minimum(i, len(other) - 1)] - keys
+    before = other[np.maximum(i - 1, 0)] - keys
+    after[i == len(other)] = np.inf
+    before[i == 0] = -np.inf
+
+    return np.where(np.abs(before) <= np.abs(after), before, after)
+
+def _duration(a: SimulationResults, b: SimulationResults) -> tp.Optional[float]:
+    ''' Simulated time of both results, the shorter one if they differ '''
+
+    durations = [d for d in [a.duration, b.duration] if d is not None]
+    return min(durations) if len(durations) > 0 else None
+
+def _profile_summary(profile: ProfileReport) -> tp.Dict:
+    totals = profile.totals()
+    rss = [total['max_rss_mb'] for total in totals.values() if total['max_rss_mb'] != None]
+
+    return {'phases': {phase: total['wall_s'] for phase, total in totals.items()},
+            'total_s': sum(total['wall_s'] for total in totals.values()),
+            'peak_rss_mb': max(rss) if len(rss) > 0 else None}
+
+def _mean(values: np.ndarray) -> tp.Optional[float]:
+    values = values[np.isfinite(values)]
+    return float(np.mean(values)) if len(values) > 0 else None
+
+def _max(values: np.ndarray) -> tp.Optional[float]:
+    values = values[np.isfinite(values)]
+    return float(np.max(values)) if len(values) > 0 else None
+
+def _format(value) -> str:
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.3f}'.format(value)
+    return str(value)
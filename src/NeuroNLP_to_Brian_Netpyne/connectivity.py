@@ -0,0 +1,144 @@
+import concurrent.futures
+import time
+import typing as tp
+
+import networkx as nx
+
+def morphology_rids(G: nx.Graph) -> tp.Dict[str, str]:
+    ''' Map the rid of every MorphologyData node in a neuroNLP graph to its neuron's uname
+
+    :param G: neuron graph
+    '''
+
+    return {rid: v['uname'] for rid, v in G.nodes(data=True)
+            if 'uname' in v and v.get('class', None) == 'MorphologyData'}
+
+def neuron_unames(G: nx.Graph) -> tp.Dict[str, str]:
+    ''' Map the uname of every non-morphology node in a neuroNLP graph to its rid
+
+    :param G: neuron graph
+    '''
+
+    return {v['uname']: rid for rid, v in G.nodes(data=True)
+            if 'uname' in v and v.get('class', None) != 'MorphologyData'}
+
+def fetch_connectivity(client,
+                       rids: tp.Iterable[str],
+                       max_workers: int=8,
+                       retries: int=2,
+                       timeout: float=None,
+                       backoff: float=0.5) -> tp.Dict[str, tp.Dict]:
+    ''' Fetch the connectivity of many neurons from the client concurrently
+
+    .. note::
+
+        client.getInfo() is a blocking network round trip, so lookups are issued from a
+        bounded thread pool rather than one after another. Any object with a getInfo(rid)
+        method can be used as the client, which makes it easy to test this against a stub
+        that sleeps to inject latency.
+
+    :param client: pointer to FBL client
+    :param rids: rids of the neurons to look up
+    :param max_workers: maximum number of lookups in flight at once
+    :param retries: number of times a failed lookup is retried before giving up
+    :param timeout: maximum number of seconds to wait for all lookups to finish, or None to
+                    wait indefinitely. Lookups still running when it expires can't be
+                    interrupted: their threads are abandoned and exit once the client returns,
+                    without retrying.
+    :param backoff: seconds to wait before the first retry, doubled on every further retry
+    :return: dictionary of rids and the 'connectivity' entry of their client info
+    '''
+
+    rids = list(dict.fromkeys(rids))
+    if (len(rids) == 0):
+        return {}
+
+    connectivity = {}
+    deadline = time.monotonic() + timeout if timeout != None else None
+
+    # The pool is shut down by hand, since leaving a with block waits for every running lookup
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(rids))))
+    futures = {pool.submit(_get_connectivity, client, rid, retries, backoff, deadline): rid for rid in rids}
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=timeout):
+            connectivity[futures[future]] = future.result()
+    except BaseException:
+        # Drop the lookups that haven't started, and abandon the ones that have
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    return connectivity
+
+def fetch_synapse_table(client,
+                        G: nx.Graph,
+                        connectivity: tp.Dict[str, tp.Dict]=None,
+                        cache=None,
+                        **kwargs) -> tp.List[tp.Dict]:
+    ''' Build a single pre/post synapse table for every neuron in a neuroNLP graph
+
+    .. note::
+
+        Only synapses whose presynaptic neuron is also part of the graph are kept, since those
+        are the only ones that can be simulated.
+
+    :param client: pointer to FBL client
+    :param G: neuron graph
+    :param connectivity: previously fetched connectivity (see fetch_connectivity()). Neurons
+                         missing from it are fetched from the client.
+    :param cache: QueryCache to look connectivity up in before asking the client. Anything that
+                  has to be fetched is stored back into it.
+    :param kwargs: passed on to fetch_connectivity()
+    :return: list of synapse records with the keys 'rid' (morphology rid of the postsynaptic
+             neuron), 'syn_rid', 'syn_uname', 'pre', 'post' and 'number' (of contacts), in
+             graph order
+    '''
+
+    rid_to_uname_morph = morphology_rids(G)
+    uname_to_rid = neuron_unames(G)
+
+    if connectivity is None: connectivity = {}
+    missing = [rid for rid in rid_to_uname_morph.keys() if rid not in connectivity]
+    if (cache is not None and len(missing) > 0):
+        connectivity = {**connectivity, **cache.get_connectivity(missing)}
+        missing = [rid for rid in missing if rid not in connectivity]
+    if (len(missing) > 0):
+        fetched = fetch_connectivity(client, missing, **kwargs)
+        if cache is not None:
+            cache.put_connectivity(fetched)
+        connectivity = {**connectivity, **fetched}
+
+    table = []
+    for rid in rid_to_uname_morph.keys():
+        for con in connectivity[rid]['pre']['details']:
+            pre, post = con['syn_uname'].split('--')
+
+            # Only grab synapses to neurons that we actually care about
+            if (pre in uname_to_rid.keys()):
+                table.append({'rid': rid,
+                              'syn_rid': con['syn_rid'],
+                              'syn_uname': con['syn_uname'],
+                              'pre': pre,
+                              'post': post,
+                              'number': con.get('number', 1)})
+
+    return table
+
+def _get_connectivity(client, rid: str, retries: int, backoff: float, deadline: float=None) -> tp.Dict:
+    ''' Fetch the connectivity of a single neuron, retrying on failure
+
+    :param client: pointer to FBL client
+    :param rid: rid of the neuron to look up
+    :param retries: number of times a failed lookup is retried before giving up
+    :param backoff: seconds to wait before the first retry
+    :param deadline: time.monotonic() after which failures aren't retried anymore
+    '''
+
+    for attempt in range(retries + 1):
+        try:
+            return client.getInfo(rid)['data']['connectivity']
+        except Exception:
+            delay = backoff * 2**attempt
+            if (attempt == retries or (deadline != None and time.monotonic() + delay > deadline)):
+                raise
+            time.sleep(delay)
@@ -0,0 +1,293 @@
+import json
+import typing as tp
+
+import numpy as np
+
+from .connectivity import fetch_connectivity, morphology_rids
+from .network_ir import DEFAULT, NetworkIR, aggregate_synapses
+from .profiling import Profiler
+
+def grow_network(network: NetworkIR,
+                 client,
+                 res,
+                 custom_cells: tp.Iterable[str]=None,
+                 custom_mechs: tp.Iterable[str]=None,
+                 stims: tp.List[tp.Dict]=None,
+                 record_names: tp.List[str]=None,
+                 cache=None,
+                 max_workers: int=8,
+                 profiler: Profiler=None,
+                 aggregate: tp.Union[str, tp.Callable]=None) -> tp.Tuple[NetworkIR, tp.Dict]:
+    ''' Grow a NetworkIR to a larger query result, fetching the connectivity of new neurons only
+
+    .. note::
+
+        Queries are often grown step by step, e.g. column C, then columns A and C, and so on.
+        Instead of fetching the connectivity of every neuron again, only the neurons that aren't
+        part of the network yet are looked up: their 'pre' details hold the synapses they receive
+        from the network and from each other, and their 'post' details the synapses they make
+        onto neurons that were already part of it. Together that is every synapse the old
+        network didn't have yet.
+
+        Neurons of the old network keep their ids, and new neurons are appended after them,
+        as are new stimulation specs and recorded neurons. The returned changes tell the
+        backends which part of the network is new (see grow_model()). A query result that
+        lost neurons of the network can't be grown to, build it from scratch instead.
+
+        Networks whose parallel synapses were merged by network_ir.aggregate_synapses() get
+        their new synapses merged with the same weight mapping. Every new synapse involves a
+        new neuron, so none of them merges with a connection the network already had, and the
+        grown network equals the aggregated network of the grown query.
+
+    :param network: network to grow
+    :param client: pointer to FBL client
+    :param res: FBL NAqueryResult object of the grown query
+    :param custom_cells: unames of the neurons that have a custom cell definition
+    :param custom_mechs: synapse unames that have a custom mechanism definition
+    :param stims: stimulation specs of the grown query (see network_ir.build_network()). Specs
+                  the network already has are skipped.
+    :param record_names: names of the neurons to record. Neurons that are already recorded are
+                         skipped.
+    :param cache: QueryCache to look connectivity up in before asking the client
+    :param max_workers: maximum number of concurrent client lookups
+    :param profiler: Profiler to record the 'fetch' and 'build' phases in
+    :param aggregate: weight mapping to merge parallel synapses with, for networks whose model
+                      was generated with aggregate (see model_gen()). Defaults to the
+                      aggregation of the network.
+    :return: grown network, and a dictionary of changes with the unames of the
+             'added_neurons', the numbers of 'added_synapses', 'added_stims' and
+             'added_records', the number of client 'lookups', and the ids of the
+             'first_neuron', 'first_stim' and 'first_record' that were added
+    '''
+
+    custom_cells = set() if custom_cells is None else set(custom_cells)
+    custom_mechs = set() if custom_mechs is None else set(custom_mechs)
+    if profiler is None: profiler = Profiler(enabled=False)
+    if aggregate is None: aggregate = network.aggregation
+
+    rid_to_uname_morph = morphology_rids(res.graph)
+    unames = set(rid_to_uname_morph.values())
+    removed = [uname for uname in network.unames.tolist() if uname not in unames]
+    if (len(removed) > 0):
+        raise ValueError(str(len(removed)) + " neurons of the network aren't part of the query result, e.g. '"
+                         + removed[0] + "'. Build the network again instead")
+
+    added = {}
+    for rid, uname in rid_to_uname_morph.items():
+        if uname not in network and uname not in added:
+            added[uname] = rid
+    rids = list(added.values())
+
+    with profiler.phase('fetch'):
+        # Connectivity cached without its 'post' details has to be fetched again
+        connectivity = cache.get_connectivity(rids) if cache is not None else {}
+        connectivity = {rid: con for rid, con in connectivity.items() if 'post' in con}
+        fetched = fetch_connectivity(client, [rid for rid in rids if rid not in connectivity], max_workers=max_workers)
+        if cache is not None:
+            cache.put_connectivity(fetched)
+        connectivity.update(fetched)
+
+    with profiler.phase('build'):
+        first = network.n_neurons
+        new_ids = {uname: first + k for k, uname in enumerate(added.keys())}
+
+        def neuron_id(uname: str) -> tp.Optional[int]:
+            if uname in new_ids:
+                return new_ids[uname]
+            if uname in network:
+                return network.index(uname)
+            return None
+
+        cell_models = list(network.cell_models)
+        cell_model_ids = {label: i for i, label in enumerate(cell_models)}
+        for uname in sorted(custom_cells.intersection(new_ids.keys())):
+            if uname not in cell_model_ids:
+                cell_model_ids[uname] = len(cell_models)
+                cell_models.append(uname)
+        cell_model = [cell_model_ids.get(uname, 0) for uname in added.keys()]
+
+        # Only synapses to neurons that we actually care about, like connectivity.fetch_synapse_table()
+        mechs = list(network.mechs)
+        mech_ids = {label: m for m, label in enumerate(mechs)}
+        pre, post, mech, count = [], [], [], []
+        for k, rid in enumerate(rids):
+            incoming = [(neuron_id(con['syn_uname'].split('--')[0]), first + k, con)
+                        for con in connectivity[rid]['pre']['details']]
+            outgoing = [(first + k, neuron_id(con['syn_uname'].split('--')[1]), con)
+                        for con in connectivity[rid]['post']['details']]
+
+            for i, j, con in incoming + [(i, j, con) for i, j, con in outgoing if j is not None and j < first]:
+                if i is None:
+                    continue
+
+                label = con['syn_uname'] if con['syn_uname'] in custom_mechs else DEFAULT
+                if label not in mech_ids:
+                    mech_ids[label] = len(mechs)
+                    mechs.append(label)
+                pre.append(i)
+                post.append(j)
+                mech.append(mech_ids[label])
+                count.append(con.get('number', 1))
+
+        # Merge the new synapses into the CSR arrays, sorted by presynaptic neuron
+        n_neurons = first + len(added)
+        pre = np.concatenate([network.synapse_pre(), np.array(pre, dtype=np.int32)])
+        post = np.concatenate([network.syn_post, np.array(post, dtype=np.int32)])
+        mech = np.concatenate([network.syn_mech, np.array(mech, dtype=np.int32)])
+        count = np.concatenate([network.syn_count, np.array(count, dtype=np.int32)])
+        weight = np.concatenate([network.syn_weight, np.ones(len(count) - network.n_synapses)])
+        order = np.argsort(pre, kind='stable')
+        syn_ptr = np.zeros(n_neurons + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pre, minlength=n_neurons), out=syn_ptr[1:])
+
+        grown = NetworkIR(unames=network.unames.tolist() + list(added.keys()),
+                          rids=network.rids.tolist() + rids,
+                          cell_model=np.concatenate([network.cell_model, np.array(cell_model, dtype=np.int32)]),
+                          cell_models=cell_models,
+                          syn_ptr=syn_ptr,
+                          syn_post=post[order],
+                          syn_mech=mech[order],
+                          mechs=mechs,
+                          stims=network.stims,
+                          record=network.record,
+                          syn_count=count[order],
+                          syn_weight=weight[order],
+                          spike_ptr=np.concatenate([network.spike_ptr, np.repeat(network.spike_ptr[-1:], len(added))]),
+                          spike_times=network.spike_times,
+                          aggregation=network.aggregation)
+        if aggregate is not None:
+            grown = aggregate_synapses(grown, aggregate)[0]
+
+        # Stim and record specs of neurons outside of the query result are ignored, like in
+        # network_ir.build_network()
+        if stims is not None:
+            known = {json.dumps(stim, sort_keys=True, default=repr) for stim in network.stims}
+            for stim in stims:
+                if stim['target'] not in grown:
+                    continue
+                stim = {**stim, 'target': grown.index(stim['target'])}
+                if json.dumps(stim, sort_keys=True, default=repr) not in known:
+                    known.add(json.dumps(stim, sort_keys=True, default=repr))
+                    grown.stims.append(stim)
+        if record_names is not None:
+            recorded = set(network.record.tolist())
+            record = []
+            for name in record_names:
+                if name in grown and grown.index(name) not in recorded:
+                    recorded.add(grown.index(name))
+                    record.append(grown.index(name))
+            grown.record = np.concatenate([network.record, np.array(record, dtype=np.int32)])
+
+    changes = {'added_neurons': list(added.keys()),
+               'added_synapses': int(np.count_nonzero((grown.synapse_pre() >= first) | (grown.syn_post >= first))),
+               'added_stims': len(grown.stims) - len(network.stims),
+               'added_records': len(grown.record) - len(network.record),
+               'lookups': len(fetched),
+               'first_neuron': first,
+               'first_stim': len(network.stims),
+               'first_record': len(network.record)}
+
+    return grown, changes
+
+def grow_model(client,
+               res,
+               networkParams,
+               network: NetworkIR,
+               simConfig=None,
+               custom_mechs: tp.Dict[str, tp.Dict]=None,
+               custom_cells: tp.Dict[str, tp.Dict]=None,
+               default_mech: tp.Dict=None,
+               default_cell: tp.Dict=None,
+               stim_targets: tp.Dict=None,
+               record_names: tp.List[str]=None,
+               vectorized: bool=False,
+               maintain_morphology: bool=False,
+               morphology_cache=None,
+               morphology_reduction: tp.Dict=None,
+               record_spikes: bool=False,
+               cache=None,
+               max_workers: int=8,
+               profiler: Profiler=None,
+               aggregate: tp.Union[str, tp.Callable]=None) -> tp.Tuple[NetworkIR, tp.Dict]:
+    ''' Extend a model generated by either backend to a larger query result, in place
+
+    .. note::
+
+        The network is grown with grow_network(), and only the neurons, synapses, stimulation
+        targets and recordings it grew by are added to networkParams, so both fetching and
+        emitting take time proportional to what was added. Definitions, stim_targets and
+        record_names are those of the grown query, and everything else has to match what the
+        model was generated with. Keep the returned network to grow the model again later.
+
+        For netpyne models, pass the simConfig too, so that new recorded neurons are recorded.
+        Brian2 models have to be extended before they are simulated for the first time, or be
+        simulated from the start again afterwards; their new neurons start at time zero.
+
+    :param client: pointer to FBL client
+    :param res: FBL NAqueryResult object of the grown query
+    :param networkParams: model to extend, as generated by either backend's model_gen()
+    :param network: NetworkIR the model was generated from (see network_ir.network_from_query())
+    :param simConfig: netpyne SimConfig object generated along with a netpyne model
+    :param custom_mechs: custom synaptic mechanism definitions, see model_gen()
+    :param custom_cells: custom cell definitions, see model_gen()
+    :param default_mech: default synaptic mechanism, for brian2 models
+    :param default_cell: default cell model
+    :param stim_targets: stimulation targets, in the format of the model's backend
+    :param record_names: names of the neurons to record traces of
+    :param vectorized: whether the model was generated vectorized
+    :param maintain_morphology: whether the netpyne model maintains morphology
+    :param morphology_cache: MorphologyCache to reuse imported morphologies from
+    :param morphology_reduction: keyword arguments of morphology.reduce_morphology()
+    :param record_spikes: whether the brian2 model was generated with record_spikes
+    :param cache: QueryCache to look connectivity up in before asking the client
+    :param max_workers: maximum number of concurrent client lookups
+    :param profiler: Profiler to record the 'fetch', 'build' and 'emit' phases in, along with
+                     the numbers of added neurons and synapses
+    :param aggregate: weight mapping the model was generated with, see grow_network()
+    :return: grown network, and the changes it grew by (see grow_network())
+    '''
+
+    if profiler is None: profiler = Profiler(enabled=False)
+
+    if hasattr(networkParams, 'popParams'):
+        from .nlpToNetpyne import _stim_specs, extend_netparams
+    else:
+        from .nlptoBrian2 import _stim_specs, extend_model
+
+    grown, changes = grow_network(network, client, res,
+                                  custom_cells=custom_cells,
+                                  custom_mechs=custom_mechs,
+                                  stims=_stim_specs(stim_targets),
+                                  record_names=record_names,
+                                  cache=cache,
+                                  max_workers=max_workers,
+                                  profiler=profiler,
+                                  aggregate=aggregate)
+
+    with profiler.phase('emit'):
+        if hasattr(networkParams, 'popParams'):
+            extend_netparams(networkParams, grown, changes,
+                             custom_mechs=custom_mechs,
+                             custom_cells=custom_cells,
+                             default_cell=default_cell,
+                             maintain_morphology=maintain_morphology,
+                             G=res.graph,
+                             vectorized=vectorized,
+                             morphology_cache=morphology_cache,
+                             morphology_reduction=morphology_reduction)
+            if simConfig is not None:
+                simConfig.recordCells = list(simConfig.recordCells) + \
+                    [networkParams.neuron_index[str(grown.unames[i])] for i in grown.record[changes['first_record']:]]
+        else:
+            extend_model(networkParams, grown, changes,
+                         custom_mechs=custom_mechs,
+                         custom_cells=custom_cells,
+                         default_mech=default_mech,
+                         default_cell=default_cell,
+                         vectorized=vectorized,
+                         record_spikes=record_spikes)
+
+    profiler.count('added_neurons', len(changes['added_neurons']))
+    profiler.count('added_synapses', changes['added_synapses'])
+
+    return grown, changes
@@ -0,0 +1,213 @@
+import time
+import typing as tp
+
+from .analysis import SimulationResults
+from .comparison import _format, compare_results
+from .profiling import Profiler
+
+def calibrate(networkParams,
+              strategies: tp.List[tp.Dict],
+              duration: float,
+              reference: tp.Dict=None,
+              tolerance: float=1.0,
+              min_coincidence: float=0.9,
+              window: float=1.0,
+              simConfig=None,
+              internal_vars: tp.Dict=None,
+              profiler: Profiler=None) -> tp.Dict:
+    ''' Simulate a short probe of a network with every integration strategy, and pick the
+    fastest one whose results stay close to those of a reference strategy
+
+    .. note::
+
+        Strategies are dictionaries as taken by configure_integration() of the backend of the
+        network, e.g. [{'dt': 0.05}, {'cvode': True, 'atol': 1e-3}, {'cvode': True, 'local_dt': True}]
+        for NetPyNE, or [{'dt': 0.05}, {'dt': 0.1}, {'dt': 0.1, 'method': 'euler'}] for Brian2.
+        The reference should be the most accurate strategy affordable, e.g. a fixed step a
+        few times smaller than any probed.
+
+        Every probe is compared to the reference with comparison.compare_results(): a strategy
+        is accurate enough if the mean root mean square error of the recorded traces is at
+        most tolerance and the mean coincidence factor of the spikes at least min_coincidence
+        (either is skipped if nothing was recorded or nothing spiked). Only the time spent
+        running is measured, so probes should be long enough for it to dominate, but short
+        enough that the reference doesn't take long; a few hundred ms of simulated time is
+        usually plenty. Strategies the backend rejects, e.g. 'exact' for non-linear equations,
+        are reported with their error rather than raising.
+
+        Stimuli drawing random numbers every step, such as the rand()<rates*dt thresholds of
+        Brian2 Poisson sources, draw different numbers at different timesteps, which no
+        integration method can make up for. Calibrate with deterministic stimuli, e.g. a
+        NetStim with a noise of 0, or spikes replayed from a SpikeGeneratorGroup.
+
+        NetPyNE networks are created again for every probe, since netpyne only sets up local
+        steps when it creates a network, starting from simConfig with CVODE turned off. Brian2
+        networks are stored before the first probe and restored after the last one, along
+        with their timestep and methods, so the network is left as it was. Networks generated
+        with execution='cpp_standalone' can't be calibrated.
+
+    :param networkParams: network to calibrate, as generated by either backend's model_gen()
+    :param strategies: integration strategies to probe
+    :param duration: simulated time of every probe, in ms
+    :param reference: integration strategy to compare the probes to. Defaults to a fixed step
+                      a quarter of the smallest dt of the strategies, or of the current one.
+    :param tolerance: largest mean trace error of an accurate strategy, in the unit of the
+                      traces (mV)
+    :param min_coincidence: smallest mean spike coincidence factor of an accurate strategy
+    :param window: largest difference between matching spike times, in ms
+    :param simConfig: netpyne SimConfig object, for netpyne networks
+    :param internal_vars: predefined network variables, for brian2 networks
+    :param profiler: Profiler to record the 'reference' and 'probe' phases in
+    :return: dictionary of the 'reference' strategy and its 'run_s', the 'probes' (each with its
+             'strategy', 'run_s', 'speedup' over the reference, the 'comparison' report of
+             comparison.compare_results() and whether it is 'accurate', or the 'error' it
+             failed with), and the fastest accurate strategy as 'best', None if there is none
+    '''
+
+    if profiler == None: profiler = Profiler(enabled=False)
+
+    if hasattr(networkParams, 'popParams'):
+        run, current, restore = _netpyne_runner(networkParams, simConfig, duration)
+    else:
+        if (getattr(networkParams, 'standalone', None) != None):
+            raise ValueError("cpp_standalone networks can't be calibrated")
+        run, current, restore = _brian2_runner(networkParams, duration, internal_vars)
+
+    if (reference == None):
+        reference = {'dt': min([strategy['dt'] for strategy in strategies if 'dt' in strategy] + [current]) / 4}
+
+    probes = []
+    try:
+        with profiler.phase('reference'):
+            reference_time, reference_results = run(reference)
+
+        for strategy in strategies:
+            with profiler.phase('probe'):
+                try:
+                    run_time, results = run(strategy)
+                except Exception as e:
+                    # brian2 wraps the reason, e.g. equations a method can't integrate
+                    probes.append({'strategy': strategy, 'error': repr(e.__cause__ if e.__cause__ != None else e)})
+                    continue
+
+            comparison = compare_results(reference_results, results, labels=('reference', 'probe'), window=window)
+            probes.append({'strategy': strategy,
+                           'run_s': run_time,
+                           'speedup': reference_time / run_time if run_time > 0 else None,
+                           'comparison': comparison,
+                           'accurate': _accurate(comparison, tolerance, min_coincidence)})
+    finally:
+        restore()
+
+    accurate = [p for p in probes if p.get('accurate')]
+    best = min(accurate, key=lambda p: p['run_s'])['strategy'] if len(accurate) > 0 else None
+
+    return {'reference': reference,
+            'run_s': reference_time,
+            'duration': duration,
+            'tolerance': tolerance,
+            'min_coincidence': min_coincidence,
+            'probes': probes,
+            'best': best}
+
+def format_calibration(report: tp.Dict) -> str:
+    ''' A report of calibrate() as a table, one probe per row '''
+
+    lines = ['{:<44} {:>9} {:>8} {:>10} {:>11}  {}'.format('strategy', 'run (s)', 'speedup', 'rmse', 'coincidence',
+                                                            'accurate')]
+    lines.append('{:<44} {:>9}'.format(_strategy(report['reference']) + ' (reference)', _format(report['run_s'])))
+    for probe in report['probes']:
+        if ('error' in probe):
+            lines.append('{:<44} failed: {}'.format(_strategy(probe['strategy']), probe['error']))
+            continue
+        comparison = probe['comparison']
+        lines.append('{:<44} {:>9} {:>8} {:>10} {:>11}  {}'.format(
+            _strategy(probe['strategy']), _format(probe['run_s']), _format(probe['speedup']),
+            _format(comparison['traces']['mean_rmse']), _format(comparison['spike_matching']['coincidence']),
+            'yes' if probe['accurate'] else 'no'))
+    lines.append('')
+    lines.append('best: ' + (_strategy(report['best']) if report['best'] != None else 'none within tolerance'))
+
+    return '\n'.join(lines)
+
+def _accurate(comparison: tp.Dict, tolerance: float, min_coincidence: float) -> bool:
+    rmse = comparison['traces']['mean_rmse']
+    coincidence = comparison['spike_matching']['coincidence']
+    return (rmse == None or rmse <= tolerance) and (coincidence == None or coincidence >= min_coincidence)
+
+def _netpyne_runner(networkParams, simConfig, duration: float) -> tp.Tuple[tp.Callable, float, tp.Callable]:
+    ''' Functions running a netpyne probe and restoring simConfig, along with its current
+    timestep in ms '''
+
+    from netpyne import sim
+    from .nlpToNetpyne import configure_integration, simulation_results
+
+    # netpyne's Dict can't be deep copied, so the settings are changed in place and put back
+    settings = {name: getattr(simConfig, name, False)
+                for name in ['duration', 'dt', 'cvode_active', 'cvode_atol', 'use_local_dt']}
+
+    def run(strategy: tp.Dict) -> tp.Tuple[float, SimulationResults]:
+        restore()
+        simConfig.duration = duration
+        simConfig.cvode_active = False
+        simConfig.use_local_dt = False
+        configure_integration(simConfig, strategy)
+
+        sim.create(netParams=networkParams, simConfig=simConfig)
+        # NEURON keeps the local step setting between runs, and netpyne only ever turns it on
+        sim.cvode.use_local_dt(int(simConfig.use_local_dt))
+
+        start = time.perf_counter()
+        sim.runSim()
+        run_time = time.perf_counter() - start
+        sim.gatherData()
+        return run_time, simulation_results(networkParams)
+
+    def restore():
+        for name, value in settings.items():
+            setattr(simConfig, name, value)
+
+    return run, settings['dt'], restore
+
+def _brian2_runner(networkParams, duration: float, internal_vars: tp.Dict) -> tp.Tuple[tp.Callable, float, tp.Callable]:
+    ''' Functions running a brian2 probe from the initial state and restoring the network,
+    along with its current timestep in ms '''
+
+    from brian2 import NeuronGroup, Synapses, defaultclock, ms
+    from .nlptoBrian2 import configure_integration, simulation_results
+
+    if internal_vars == None: internal_vars = {}
+
+    dt = float(defaultclock.dt / ms)
+    methods = {obj.name: obj.state_updater.method_choice for obj in networkParams.objects
+               if isinstance(obj, (NeuronGroup, Synapses)) and obj.state_updater != None}
+    definitions = dict(networkParams.definitions)
+    networkParams.store('calibrate')
+
+    def run(strategy: tp.Dict) -> tp.Tuple[float, SimulationResults]:
+        networkParams.restore('calibrate', restore_random_state=True)
+        restore_settings()
+        configure_integration(networkParams, strategy)
+
+        # Code is generated again for every method, time it apart from the run
+        networkParams.run(0*ms, namespace=internal_vars)
+        start = time.perf_counter()
+        networkParams.run(duration*ms, namespace=internal_vars)
+        return time.perf_counter() - start, simulation_results(networkParams)
+
+    def restore_settings():
+        defaultclock.dt = dt*ms
+        for obj in networkParams.objects:
+            if obj.name in methods:
+                obj.state_updater.method_choice = methods[obj.name]
+        networkParams.definitions.clear()
+        networkParams.definitions.update(definitions)
+
+    def restore():
+        networkParams.restore('calibrate')
+        restore_settings()
+
+    return run, dt, restore
+
+def _strategy(strategy: tp.Dict) -> str:
+    return ', '.join(key + '=' + str(value) for key, value in strategy.items()) if len(strategy) > 0 else 'default'
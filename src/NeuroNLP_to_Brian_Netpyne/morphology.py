@@ -0,0 +1,294 @@
+import copy
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import typing as tp
+
+import numpy as np
+
+# Columns of an SWC file, in order, and the MorphologyData node attributes they come from
+SWC_COLUMNS = ['sample', 'identifier', 'x', 'y', 'z', 'r', 'parent']
+
+# Bump this whenever import_morphology() changes the cell rules it produces, so stale entries in
+# on-disk caches are no longer picked up
+RULE_VERSION = 1
+
+class MorphologyCache:
+    ''' Cache of imported netpyne cell rules, keyed by a hash of the morphology they came from
+
+    :param directory: directory to also persist cell rules to as JSON files, so they survive
+                      between sessions. Rules are only kept in memory if not provided.
+    '''
+
+    def __init__(self, directory: str=None):
+        self.directory = directory
+        self._rules = {}
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rules or (self.directory is not None and os.path.exists(self._path(key)))
+
+    def get(self, key: str) -> tp.Optional[tp.Dict]:
+        ''' Copy of the cell rule stored under key, or None if there isn't one '''
+
+        if key not in self._rules and self.directory is not None and os.path.exists(self._path(key)):
+            with open(self._path(key)) as f:
+                self._rules[key] = json.load(f)
+
+        if key not in self._rules:
+            return None
+        return copy.deepcopy(self._rules[key])
+
+    def put(self, key: str, rule: tp.Dict):
+        ''' Store a copy of a cell rule under key '''
+
+        # Round trip through JSON to drop netpyne's dict subclasses
+        self._rules[key] = json.loads(json.dumps(rule))
+
+        if self.directory is not None:
+            # Write to a temporary file first so a crash can't leave a truncated rule behind
+            with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as f:
+                json.dump(self._rules[key], f)
+            os.replace(f.name, self._path(key))
+
+    def clear(self):
+        ''' Drop every cached cell rule, including the ones on disk '''
+
+        self._rules = {}
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+# Used whenever no cache is passed in, so repeat builds in one session skip the import
+default_cache = MorphologyCache()
+
+def swc_arrays(morphology: tp.Dict) -> np.ndarray:
+    ''' Stack the SWC columns of a MorphologyData node into a single array
+
+    .. note::
+
+        Unidentified components (identifier 0) are turned into somas, in the returned copy only.
+        THIS IS BAD. WE ONLY DO THIS BECAUSE FBL DATA IS INCOMPLETE, and it will almost certainly
+        lead to bad simulations.
+
+    :param morphology: node data of a MorphologyData node
+    :return: array of shape (samples, 7), with columns in SWC_COLUMNS order
+    '''
+
+    arrays = np.stack([np.asarray(morphology[column], dtype=np.float64) for column in SWC_COLUMNS], axis=1)
+    arrays[arrays[:, 1] == 0, 1] = 1
+
+    return arrays
+
+def morphology_key(arrays: np.ndarray) -> str:
+    ''' Content hash of an SWC array, equal for identical morphologies '''
+
+    digest = hashlib.sha1(np.ascontiguousarray(arrays, dtype=np.float64).tobytes())
+    digest.update(str(RULE_VERSION).encode())
+
+    return digest.hexdigest()
+
+def write_swc(f: tp.TextIO, arrays: np.ndarray, header: str=None):
+    ''' Write an SWC array to an open text file in one go
+
+    :param f: file to write to
+    :param arrays: array of shape (samples, 7), with columns in SWC_COLUMNS order
+    :param header: comment to put at the top of the file
+    '''
+
+    if header is not None:
+        f.write('# ' + header + '\n')
+        f.write('#\n')
+
+    np.savetxt(f, arrays, fmt=['%d', '%d', '%.10g', '%.10g', '%.10g', '%.10g', '%d'])
+
+def reduce_morphology(arrays: np.ndarray,
+                      max_length: float=None,
+                      max_electrotonic: float=None,
+                      min_branch_length: float=0,
+                      Ra: float=35.4,
+                      g_pas: float=0.0000357) -> tp.Tuple[np.ndarray, tp.Dict[str, int]]:
+    ''' Coarsen a morphology by merging unbranched segments and pruning tiny branches
+
+    .. note::
+
+        Terminal branches (from a branch point to a tip) shorter than min_branch_length are
+        removed first, repeatedly, since removing one can turn its parent into a new terminal
+        branch. Then, along every unbranched stretch, consecutive samples are merged as long
+        as the merged segment stays within max_length um and max_electrotonic length constants
+        (with neither given, every unbranched stretch becomes a single segment). Only a single
+        segment that is longer than that on its own is kept longer.
+        Roots, branch points, tips and changes of SWC identifier are always kept, so
+        topology and section types survive. Merged samples get the length-weighted mean radius
+        of the segments they replace.
+
+        Length constants are computed from the local diameter. g_pas defaults to the passive
+        conductance that import_morphology() assigns to every section, and Ra to NEURON's default.
+
+    :param arrays: array of shape (samples, 7), with columns in SWC_COLUMNS order
+    :param max_length: maximum length of a merged segment, in um
+    :param max_electrotonic: maximum electrotonic length of a merged segment, in length constants
+    :param min_branch_length: terminal branches shorter than this, in um, are pruned
+    :param Ra: axial resistivity, in ohm cm
+    :param g_pas: passive membrane conductance, in S/cm2
+    :return: the reduced array, with samples renumbered from 1, and a report of the number of
+             samples and compartments (segments between a sample and its parent) before and
+             after, and the number of samples pruned
+    '''
+
+    n = len(arrays)
+    samples = arrays[:, 0].astype(np.int64)
+    row = {sample: i for i, sample in enumerate(samples.tolist())}
+    parent = np.array([row.get(p, -1) for p in arrays[:, 6].astype(np.int64).tolist()], dtype=np.int64)
+    has_parent = parent >= 0
+
+    xyz = arrays[:, 2:5]
+    seg_length = np.zeros(n)
+    seg_length[has_parent] = np.linalg.norm(xyz[has_parent] - xyz[parent[has_parent]], axis=1)
+
+    # Prune short terminal branches until there are none left
+    alive = np.ones(n, dtype=bool)
+    while (min_branch_length > 0):
+        n_children = np.bincount(parent[alive & has_parent], minlength=n)
+        pruned = False
+        for tip in np.flatnonzero(alive & has_parent & (n_children == 0)):
+            branch = [tip]
+            length = seg_length[tip]
+            node = parent[tip]
+            while (parent[node] >= 0 and n_children[node] == 1):
+                branch.append(node)
+                length += seg_length[node]
+                node = parent[node]
+
+            # Only prune branches that hang off a branch point, never the whole neuron
+            if (n_children[node] > 1 and length < min_branch_length):
+                alive[branch] = False
+                n_children[node] -= 1
+                pruned = True
+        if not pruned:
+            break
+
+    # Visit samples parents first, so merging can walk down every unbranched stretch
+    children = [[] for _ in range(n)]
+    for i in np.flatnonzero(alive & has_parent):
+        children[parent[i]].append(i)
+    order = list(np.flatnonzero(alive & ~has_parent))
+    for i in order:
+        order.extend(children[i])
+
+    # Longest segment allowed at every sample
+    limit = np.full(n, np.inf)
+    if max_length is not None:
+        limit[:] = max_length
+    if max_electrotonic is not None:
+        # lambda = sqrt(Rm d / 4 Ra), with the diameter converted from um to cm and back
+        lam = np.sqrt((1.0 / g_pas) * (2 * arrays[:, 5] * 1e-4) / (4 * Ra)) * 1e4
+        limit = np.minimum(limit, max_electrotonic * lam)
+
+    keep = np.zeros(n, dtype=bool)
+    anchor = np.full(n, -1, dtype=np.int64)    # closest kept ancestor (or self, if kept)
+    merged = np.zeros(n)                       # length merged into the segment ending here
+    radius_area = np.zeros(n)                  # radius * length merged into the segment
+    radius = arrays[:, 5].copy()
+    for i in order:
+        p = parent[i]
+        if (p < 0):
+            keep[i] = True
+            anchor[i] = i
+            continue
+
+        merged[i] = merged[p] + seg_length[i] if not keep[p] else seg_length[i]
+        radius_area[i] = (radius_area[p] if not keep[p] else 0) + arrays[i, 5] * seg_length[i]
+
+        # Keep the sample if merging its child too would make the segment longer than allowed
+        if (len(children[i]) != 1 or arrays[i, 1] != arrays[p, 1]
+                or merged[i] + seg_length[children[i][0]] > limit[i]
+                or arrays[children[i][0], 1] != arrays[i, 1]):
+            keep[i] = True
+            anchor[i] = i
+            if (merged[i] > 0):
+                radius[i] = radius_area[i] / merged[i]
+        else:
+            anchor[i] = anchor[p]
+
+    # Renumber kept samples in visiting order, pointing each at its closest kept ancestor
+    kept = np.array([i for i in order if keep[i]], dtype=np.int64)
+    new_sample = np.full(n, -1, dtype=np.int64)
+    new_sample[kept] = np.arange(1, len(kept) + 1)
+
+    reduced = arrays[kept].copy()
+    reduced[:, 0] = new_sample[kept]
+    reduced[:, 5] = radius[kept]
+    reduced[:, 6] = [new_sample[anchor[parent[i]]] if parent[i] >= 0 else -1 for i in kept]
+
+    report = {'samples_before': n,
+              'samples_after': len(kept),
+              'compartments_before': int(np.count_nonzero(has_parent)),
+              'compartments_after': int(np.count_nonzero(reduced[:, 6] >= 0)),
+              'pruned': int(np.count_nonzero(~alive))}
+
+    return reduced, report
+
+def import_morphology(networkParams,
+                      arrays: np.ndarray,
+                      label: str,
+                      cache: MorphologyCache=None,
+                      header: str=None) -> tp.Dict:
+    ''' Import a morphology into a netpyne cell rule, reusing a cached rule when there is one
+
+    .. note::
+
+        netpyne only imports morphology from files, so a morphology that hasn't been seen
+        before is written to a temporary SWC file first.
+
+    :param networkParams: netpyne networkParams object to add the cell rule to
+    :param arrays: array of shape (samples, 7), with columns in SWC_COLUMNS order
+    :param label: name of the cell rule and cell type to create
+    :param cache: MorphologyCache to look the cell rule up in and store it to, defaults to an
+                  in-memory cache shared by the whole session
+    :param header: comment to put at the top of the SWC file
+    :return: the cell rule
+    '''
+
+    if cache is None: cache = default_cache
+
+    key = morphology_key(arrays)
+    rule = cache.get(key)
+
+    if rule is None:
+        with tempfile.NamedTemporaryFile('w', suffix='.swc') as f:
+            write_swc(f, arrays, header)
+            f.flush()
+
+            cellRule = networkParams.importCellParams(label=label,
+                                                      conds={'cellType': label, 'cellModel': 'HH3D'},
+                                                      fileName=f.name,
+                                                      cellName=label)
+
+        # rename imported section 'soma_0' to 'soma'
+        if 'soma_0' in cellRule['secs']:
+            networkParams.renameCellParamsSec(label, 'soma_0', 'soma')
+            cellRule = networkParams.cellParams[label]
+
+        # Define Cell Rules
+        for secName in cellRule['secs']:
+            cellRule['secs'][secName]['mechs']['pas'] = {'g': 0.0000357, 'e': -70}
+            cellRule['secs'][secName]['geom']['cm'] = 1
+            if secName.startswith('soma'):
+                cellRule['secs'][secName]['mechs']['hh'] = {'gnabar': 0.12, 'gkbar': 0.036, 'gl': 0.003, 'el': -70}
+
+        cache.put(key, cellRule)
+        return cellRule
+
+    rule['conds'] = {'cellType': label, 'cellModel': 'HH3D'}
+    networkParams.cellParams[label] = rule
+
+    return networkParams.cellParams[label]
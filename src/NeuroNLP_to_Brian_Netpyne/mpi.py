@@ -0,0 +1,282 @@
+''' Distributed NetPyNE simulations under MPI
+
+The generated networkParams and simConfig are pickled, and this module is launched with mpiexec
+on every rank to create, run and gather the simulation:
+
+    mpiexec -n 4 python -m src.NeuroNLP_to_Brian_Netpyne.mpi job.pkl
+
+simulate_mpi() takes care of all of that, and returns the same SimulationResults as
+nlpToNetpyne.simulate(headless=True).
+'''
+
+import heapq
+import json
+import os
+import os.path
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import typing as tp
+
+import numpy as np
+
+from .analysis import SimulationResults
+from .profiling import Profiler
+
+# Cost of a cell of a point process population, e.g. the VecStims replaying surrogate neurons,
+# relative to a compartment. They integrate nothing and only deliver their spikes.
+POINT_CELL_COST = 0.1
+
+def cell_loads(networkParams, synapse_cost: float=0.5) -> tp.Dict[str, np.ndarray]:
+    ''' Estimated simulation cost of every cell of a netpyne network
+
+    .. note::
+
+        Every compartment (segment) of a cell costs 1, and every synapse or stimulation
+        targeting it costs synapse_cost, since each is a point process integrated and delivered
+        events on the rank owning the postsynaptic cell. Cells of point process populations
+        without a cell rule (VecStim surrogates, see partition.extract_partition()) cost
+        POINT_CELL_COST.
+
+    :param networkParams: netpyne networkParams object, as generated by model_gen()
+    :param synapse_cost: cost of a synapse relative to a compartment
+    :return: dictionary of populations and the cost of each of their cells, in index order
+    '''
+
+    loads = {}
+    pops_of_type = {}
+    for pop, params in networkParams.popParams.items():
+        if 'cellType' not in params:
+            loads[pop] = np.full(params['numCells'], POINT_CELL_COST)
+            continue
+        rule = networkParams.cellParams[params['cellType']]
+        compartments = sum(sec.get('geom', {}).get('nseg', 1) for sec in rule['secs'].values())
+        loads[pop] = np.full(params['numCells'], float(compartments))
+        pops_of_type.setdefault(params['cellType'], []).append(pop)
+
+    for rule in networkParams.connParams.values():
+        conds = rule['postConds']
+        pops = [conds['pop']] if 'pop' in conds else pops_of_type.get(conds.get('cellType'), [])
+        for pop in pops:
+            if 'connList' in rule:
+                np.add.at(loads[pop], [post for _, post in rule['connList']], synapse_cost)
+            else:
+                loads[pop] += synapse_cost
+
+    for rule in networkParams.stimTargetParams.values():
+        conds = rule['conds']
+        if conds.get('pop') not in loads:
+            continue
+        if 'cellList' in conds:
+            np.add.at(loads[conds['pop']], conds['cellList'], synapse_cost)
+        else:
+            loads[conds['pop']] += synapse_cost
+
+    return loads
+
+def balance(loads: tp.Dict[str, np.ndarray], ranks: int) -> tp.Tuple[tp.Dict[str, tp.List[tp.List[int]]], np.ndarray]:
+    ''' Assign cells to ranks so that every rank gets about the same total cost
+
+    Cells are handed out from most to least costly, each to the rank with the least cost so
+    far (longest processing time first scheduling), which ends up within 4/3 of the best
+    possible maximum.
+
+    :param loads: cost of every cell of every population, see cell_loads()
+    :param ranks: number of MPI ranks
+    :return: indices of the cells of every population placed on every rank, and the total cost
+             of every rank
+    '''
+
+    pops = list(loads.keys())
+    pop = np.concatenate([np.full(len(loads[p]), i, dtype=np.int64) for i, p in enumerate(pops)]) if pops else np.zeros(0, dtype=np.int64)
+    idx = np.concatenate([np.arange(len(loads[p])) for p in pops]) if pops else np.zeros(0, dtype=np.int64)
+    cost = np.concatenate([loads[p] for p in pops]) if pops else np.zeros(0)
+
+    placement = {p: [[] for _ in range(ranks)] for p in pops}
+    totals = np.zeros(ranks)
+    heap = [(0.0, rank) for rank in range(ranks)]
+    for cell in np.argsort(-cost, kind='stable'):
+        total, rank = heapq.heappop(heap)
+        placement[pops[pop[cell]]][rank].append(int(idx[cell]))
+        totals[rank] = total + cost[cell]
+        heapq.heappush(heap, (totals[rank], rank))
+
+    for p in pops:
+        for cells in placement[p]:
+            cells.sort()
+
+    return placement, totals
+
+def simulate_mpi(networkParams,
+                 simConfig,
+                 ranks: int=2,
+                 balanced: bool=True,
+                 synapse_cost: float=0.5,
+                 mpiexec: str='mpiexec',
+                 mpiexec_args: tp.List[str]=None,
+                 directory: str=None,
+                 timeout: float=None,
+                 profiler: Profiler=None) -> SimulationResults:
+    ''' Create and run a netpyne simulation on several MPI ranks, and gather its results
+
+    :param networkParams: netpyne networkParams object to simulate, as generated by model_gen()
+    :param simConfig: netpyne SimConfig object with desired simulation configuration
+    :param ranks: number of MPI ranks to launch
+    :param balanced: whether to place cells by their estimated cost (see cell_loads() and
+                     balance()) instead of netpyne's round robin
+    :param synapse_cost: cost of a synapse relative to a compartment, see cell_loads()
+    :param mpiexec: MPI launcher to run
+    :param mpiexec_args: extra launcher arguments, e.g. ['--oversubscribe'] to run more ranks
+                         than there are cores
+    :param directory: directory to write the job and its results to. Defaults to a temporary
+                      directory that is removed afterwards.
+    :param timeout: seconds after which the run is killed
+    :param profiler: Profiler to record the time of the 'mpi' phase in, along with the number of
+                     ranks
+    '''
+
+    return run_mpi(networkParams, simConfig, ranks, balanced, synapse_cost, mpiexec, mpiexec_args,
+                   directory, timeout, profiler)[0]
+
+def run_mpi(networkParams,
+            simConfig,
+            ranks: int=2,
+            balanced: bool=True,
+            synapse_cost: float=0.5,
+            mpiexec: str='mpiexec',
+            mpiexec_args: tp.List[str]=None,
+            directory: str=None,
+            timeout: float=None,
+            profiler: Profiler=None) -> tp.Tuple[SimulationResults, tp.Dict]:
+    ''' Same as simulate_mpi(), also returning the timings measured on rank 0
+
+    :return: results, and a dictionary of the 'create_s', 'run_s' and 'gather_s' times of the
+             simulation, the 'wall_s' time of the whole launch, the number of 'ranks', and the
+             load 'imbalance' of the placement (highest rank cost over mean rank cost)
+    '''
+
+    if profiler == None: profiler = Profiler(enabled=False)
+
+    loads = cell_loads(networkParams, synapse_cost)
+    if (balanced):
+        placement, totals = balance(loads, ranks)
+    else:
+        placement = None
+        totals = _round_robin_totals(loads, ranks)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if directory == None: directory = scratch
+        job = os.path.join(directory, 'job.pkl')
+        with open(job, 'wb') as f:
+            pickle.dump({'netParams': networkParams,
+                         'simConfig': simConfig,
+                         'placement': placement,
+                         'output': os.path.join(directory, 'results.npz'),
+                         'timings': os.path.join(directory, 'timings.json')}, f)
+
+        # The workers import this module the same way it was imported here
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(p for p in sys.path if p)}
+        command = [mpiexec, '-n', str(ranks)] + (mpiexec_args if mpiexec_args != None else []) + \
+                  [sys.executable, '-m', __spec__.name, job]
+
+        with profiler.phase('mpi'):
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True, timeout=timeout)
+            wall = time.perf_counter() - start
+
+        results = SimulationResults.load(os.path.join(directory, 'results.npz'))
+        with open(os.path.join(directory, 'timings.json')) as f:
+            timings = json.load(f)
+
+    profiler.count('ranks', ranks)
+
+    return results, {**timings, 'wall_s': wall, 'ranks': ranks,
+                     'imbalance': float(totals.max() / totals.mean()) if totals.sum() > 0 else 1.0}
+
+def scaling_study(networkParams,
+                  simConfig,
+                  ranks: tp.Sequence[int]=(1, 2, 4),
+                  **kwargs) -> tp.List[tp.Dict]:
+    ''' Simulate the same network on increasing numbers of ranks
+
+    :param networkParams: netpyne networkParams object to simulate
+    :param simConfig: netpyne SimConfig object with desired simulation configuration
+    :param ranks: numbers of ranks to measure
+    :param kwargs: any other arguments of simulate_mpi()
+    :return: the timings of every run (see run_mpi()), plus the 'speedup' and parallel
+             'efficiency' of its run phase relative to the first run
+    '''
+
+    rows = []
+    for n in ranks:
+        rows.append(run_mpi(networkParams, simConfig, ranks=n, **kwargs)[1])
+
+        baseline = rows[0]['run_s'] * rows[0]['ranks']
+        rows[-1]['speedup'] = baseline / rows[-1]['run_s']
+        rows[-1]['efficiency'] = rows[-1]['speedup'] / n
+
+    return rows
+
+def _round_robin_totals(loads: tp.Dict[str, np.ndarray], ranks: int) -> np.ndarray:
+    ''' Total cost of every rank under netpyne's own round robin placement '''
+
+    totals = np.zeros(ranks)
+    next_rank = 0
+    for cost in loads.values():
+        np.add.at(totals, (next_rank + np.arange(len(cost))) % ranks, cost)
+        next_rank = (next_rank + len(cost)) % ranks
+
+    return totals
+
+def _place(sim, placement: tp.Dict[str, tp.List[tp.List[int]]]):
+    ''' Make netpyne create the cells of every population on the ranks they were assigned to '''
+
+    for label, pop in sim.net.pops.items():
+        hosts = dict(enumerate(placement[label]))
+        pop._distributeCells = lambda numCells, hosts=hosts: hosts
+
+def main(argv: tp.List[str]=None):
+    # MPI has to be up before netpyne creates its ParallelContext
+    from neuron import h
+    h.nrnmpi_init()
+
+    from netpyne import sim
+    from .nlpToNetpyne import simulation_results
+
+    with open((argv if argv != None else sys.argv[1:])[0], 'rb') as f:
+        job = pickle.load(f)
+
+    timings = {}
+    start = time.perf_counter()
+    sim.initialize(netParams=job['netParams'], simConfig=job['simConfig'])
+    sim.net.createPops()
+    if (job['placement'] != None):
+        _place(sim, job['placement'])
+    sim.net.createCells()
+    sim.net.connectCells()
+    sim.net.addStims()
+    sim.setupRecording()
+    sim.pc.barrier()
+    timings['create_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sim.runSim()
+    timings['run_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sim.gatherData()
+    timings['gather_s'] = time.perf_counter() - start
+
+    if (sim.rank == 0):
+        simulation_results(job['netParams']).save(job['output'])
+        with open(job['timings'], 'w') as f:
+            json.dump(timings, f)
+
+    # Exiting through NEURON finalizes MPI, which mpiexec expects from every rank
+    sim.pc.barrier()
+    h.quit()
+
+if __name__ == '__main__':
+    main()
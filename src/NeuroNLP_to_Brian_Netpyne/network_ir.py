@@ -0,0 +1,461 @@
+import hashlib
+import json
+import typing as tp
+
+import networkx as nx
+import numpy as np
+
+from .connectivity import fetch_synapse_table, morphology_rids
+
+# Label of the cell model / synaptic mechanism used by anything without a custom definition
+DEFAULT = 'default'
+
+# Label of the cell model of surrogate neurons, which replay a spike train instead of being simulated
+SURROGATE = 'surrogate'
+
+# Every file written by NetworkIR.save() starts with this, followed by the format version
+MAGIC = b'NLPIR\0'
+VERSION = 1
+
+# Arrays are aligned to this many bytes in saved files, so they can be memory-mapped directly
+ALIGNMENT = 64
+
+# Weight mappings of aggregate_synapses(), from the number of contacts of a connection to its weight
+WEIGHT_MAPPINGS = {'linear': lambda count: count.astype(np.float64),
+                   'sqrt': lambda count: np.sqrt(count),
+                   'log': lambda count: 1 + np.log(count),
+                   'constant': lambda count: np.ones(len(count))}
+
+class NetworkIR:
+    ''' Simulator-neutral description of a network generated from a neuroNLP query
+
+    .. note::
+
+        Neurons are stored as a table of parallel arrays, indexed by neuron id. Synapses are
+        stored in compressed sparse row form, grouped by presynaptic neuron: the synapses of
+        neuron i are syn_post[syn_ptr[i]:syn_ptr[i+1]] and syn_mech[syn_ptr[i]:syn_ptr[i+1]].
+
+        Every synapse carries the number of contacts it stands for (the 'number' of its synapse
+        record) and a weight, which backends scale the weight of its connection by. Both are
+        one per record until parallel synapses are merged by aggregate_synapses().
+
+        Cell models and synaptic mechanisms are stored as ids into cell_models and mechs, which
+        hold labels rather than definitions: either DEFAULT or the key of a custom definition.
+        Definitions differ between simulators, so they are resolved by each backend when the
+        network is emitted.
+
+        Neurons whose cell model is SURROGATE stand in for neurons outside the network, e.g.
+        the inputs of a partition (see partition.extract_partition()). Backends emit them as
+        spike generators replaying their spike train, stored in compressed sparse row form
+        like synapses: the spike times of neuron i are spike_times[spike_ptr[i]:spike_ptr[i+1]].
+
+    :param unames: uname of every neuron
+    :param rids: rid of every neuron's MorphologyData node
+    :param cell_model: cell model id of every neuron
+    :param cell_models: cell model labels
+    :param syn_ptr: CSR row pointer of the synapses, one entry per neuron plus one
+    :param syn_post: postsynaptic neuron id of every synapse
+    :param syn_mech: mechanism id of every synapse
+    :param mechs: mechanism labels
+    :param stims: list of stimulation specs. Each is a dict with a 'source' stimulation source
+                  name, a 'target' neuron id, and any backend-specific parameters.
+    :param record: ids of the neurons to record
+    :param syn_count: number of contacts of every synapse, 1 each by default
+    :param syn_weight: weight of every synapse, 1 each by default
+    :param spike_ptr: CSR row pointer of the spike trains, one entry per neuron plus one. No
+                      neuron has any spikes by default.
+    :param spike_times: spike times of the surrogate neurons, in ms
+    :param aggregation: weight mapping parallel synapses were merged with by
+                        aggregate_synapses(), None if they weren't. Functions aren't saved.
+    '''
+
+    def __init__(self,
+                 unames: tp.Sequence[str],
+                 rids: tp.Sequence[str],
+                 cell_model: np.ndarray,
+                 cell_models: tp.List[str],
+                 syn_ptr: np.ndarray,
+                 syn_post: np.ndarray,
+                 syn_mech: np.ndarray,
+                 mechs: tp.List[str],
+                 stims: tp.List[tp.Dict]=None,
+                 record: np.ndarray=None,
+                 syn_count: np.ndarray=None,
+                 syn_weight: np.ndarray=None,
+                 spike_ptr: np.ndarray=None,
+                 spike_times: np.ndarray=None,
+                 aggregation: tp.Union[str, tp.Callable]=None):
+        self.unames = np.asarray(unames, dtype=str)
+        self.rids = np.asarray(rids, dtype=str)
+        self.names = np.asarray([sanitize_name(name) for name in self.unames], dtype=str)
+        self.cell_model = np.asarray(cell_model, dtype=np.int32)
+        self.cell_models = list(cell_models)
+        self.syn_ptr = np.asarray(syn_ptr, dtype=np.int64)
+        self.syn_post = np.asarray(syn_post, dtype=np.int32)
+        self.syn_mech = np.asarray(syn_mech, dtype=np.int32)
+        self.mechs = list(mechs)
+        self.stims = [] if stims is None else list(stims)
+        self.record = np.zeros(0, dtype=np.int32) if record is None else np.asarray(record, dtype=np.int32)
+        self.syn_count = np.ones(len(self.syn_post), dtype=np.int32) if syn_count is None else np.asarray(syn_count, dtype=np.int32)
+        self.syn_weight = np.ones(len(self.syn_post)) if syn_weight is None else np.asarray(syn_weight, dtype=np.float64)
+        self.spike_ptr = np.zeros(len(self.unames) + 1, dtype=np.int64) if spike_ptr is None else np.asarray(spike_ptr, dtype=np.int64)
+        self.spike_times = np.zeros(0) if spike_times is None else np.asarray(spike_times, dtype=np.float64)
+        self.aggregation = aggregation
+
+        self._index = None
+
+    @property
+    def n_neurons(self) -> int:
+        return len(self.unames)
+
+    @property
+    def n_synapses(self) -> int:
+        return len(self.syn_post)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._lookup()
+
+    def index(self, name: str) -> int:
+        ''' Neuron id of a neuron, looked up by uname or sanitized name
+
+        :param name: uname or sanitized name of the neuron
+        '''
+
+        if name not in self._lookup():
+            raise KeyError("no neuron named '" + name + "' in the network")
+        return self._index[name]
+
+    def digest(self) -> str:
+        ''' Hash of the structure of the network, equal for networks with equal arrays and labels '''
+
+        digest = hashlib.sha1()
+        for array in [self.unames, self.rids, self.cell_model, self.syn_ptr, self.syn_post, self.syn_mech, self.record,
+                      self.syn_count, self.syn_weight, self.spike_ptr, self.spike_times]:
+            digest.update(repr((array.dtype.str, array.shape)).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(json.dumps([self.cell_models, self.mechs, self.stims], sort_keys=True, default=repr).encode())
+
+        return digest.hexdigest()
+
+    def surrogates(self) -> np.ndarray:
+        ''' Whether every neuron is a surrogate spike source, as a boolean mask '''
+
+        if SURROGATE not in self.cell_models:
+            return np.zeros(self.n_neurons, dtype=bool)
+        return self.cell_model == self.cell_models.index(SURROGATE)
+
+    def spike_train(self, i: int) -> np.ndarray:
+        ''' Spike times of a surrogate neuron, in ms '''
+
+        return self.spike_times[self.spike_ptr[i]:self.spike_ptr[i + 1]]
+
+    def synapse_pre(self) -> np.ndarray:
+        ''' Presynaptic neuron id of every synapse, expanded from the CSR row pointer '''
+
+        return np.repeat(np.arange(self.n_neurons, dtype=np.int32), np.diff(self.syn_ptr))
+
+    def _lookup(self) -> tp.Dict[str, int]:
+        if self._index is None:
+            self._index = {}
+            for i, (uname, sanitized) in enumerate(zip(self.unames.tolist(), self.names.tolist())):
+                self._index.setdefault(sanitized, i)
+                self._index[uname] = i
+        return self._index
+
+    def save(self, path: str):
+        ''' Save the network to a single file that can be memory-mapped by load()
+
+        :param path: path of the file to write
+        '''
+
+        arrays = {'unames': self.unames,
+                  'rids': self.rids,
+                  'cell_model': self.cell_model,
+                  'syn_ptr': self.syn_ptr,
+                  'syn_post': self.syn_post,
+                  'syn_mech': self.syn_mech,
+                  'record': self.record,
+                  'syn_count': self.syn_count,
+                  'syn_weight': self.syn_weight,
+                  'spike_ptr': self.spike_ptr,
+                  'spike_times': self.spike_times}
+        meta = {'cell_models': self.cell_models,
+                'mechs': self.mechs,
+                'stims': self.stims,
+                'aggregation': self.aggregation if isinstance(self.aggregation, str) else None}
+
+        write_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool=True) -> 'NetworkIR':
+        ''' Load a network saved with save()
+
+        :param path: path of the file to read
+        :param mmap: whether to memory-map the synapse arrays instead of reading them into memory
+        '''
+
+        arrays, meta = read_arrays(path, mmap=mmap)
+
+        return cls(unames=arrays['unames'],
+                   rids=arrays['rids'],
+                   cell_model=arrays['cell_model'],
+                   cell_models=meta['cell_models'],
+                   syn_ptr=arrays['syn_ptr'],
+                   syn_post=arrays['syn_post'],
+                   syn_mech=arrays['syn_mech'],
+                   mechs=meta['mechs'],
+                   stims=meta['stims'],
+                   record=arrays['record'],
+                   syn_count=arrays.get('syn_count'),
+                   syn_weight=arrays.get('syn_weight'),
+                   spike_ptr=arrays.get('spike_ptr'),
+                   spike_times=arrays.get('spike_times'),
+                   aggregation=meta.get('aggregation'))
+
+def sanitize_name(name: str) -> str:
+    ''' Turn a neuron or synapse uname into a name that neuroml2 (and brian2) will accept '''
+
+    # neuroml2 doesn't like dashes or slashes
+    return name.replace('-', '_').replace('/', '')
+
+def build_network(G: nx.Graph,
+                  synapse_table: tp.List[tp.Dict],
+                  custom_cells: tp.Iterable[str]=None,
+                  custom_mechs: tp.Iterable[str]=None,
+                  stims: tp.List[tp.Dict]=None,
+                  record_names: tp.List[str]=None) -> NetworkIR:
+    ''' Build a NetworkIR from a neuroNLP graph and its synapse table
+
+    :param G: neuron graph
+    :param synapse_table: synapse table of the graph (see connectivity.fetch_synapse_table())
+    :param custom_cells: unames of the neurons that have a custom cell definition
+    :param custom_mechs: synapse unames that have a custom mechanism definition
+    :param stims: list of stimulation specs, each a dict with a 'source' stimulation source name,
+                  a 'target' neuron name, and any backend-specific parameters
+    :param record_names: names of the neurons to record
+    '''
+
+    custom_cells = set() if custom_cells is None else set(custom_cells)
+    custom_mechs = set() if custom_mechs is None else set(custom_mechs)
+
+    rid_to_uname_morph = morphology_rids(G)
+    rids = list(rid_to_uname_morph.keys())
+    unames = [rid_to_uname_morph[rid] for rid in rids]
+
+    # Neuron table
+    cell_models = [DEFAULT] + sorted(custom_cells.intersection(unames))
+    cell_model_ids = {label: i for i, label in enumerate(cell_models)}
+    cell_model = np.array([cell_model_ids.get(uname, 0) for uname in unames], dtype=np.int32)
+
+    # Synapse arrays, sorted into CSR order by presynaptic neuron
+    uname_to_index = {uname: i for i, uname in enumerate(unames)}
+    mechs = [DEFAULT]
+    mech_ids = {DEFAULT: 0}
+    pre = np.empty(len(synapse_table), dtype=np.int32)
+    post = np.empty(len(synapse_table), dtype=np.int32)
+    mech = np.empty(len(synapse_table), dtype=np.int32)
+    count = np.empty(len(synapse_table), dtype=np.int32)
+    for n, con in enumerate(synapse_table):
+        pre[n] = uname_to_index[con['pre']]
+        post[n] = uname_to_index[con['post']]
+        count[n] = con.get('number', 1)
+        if (con['syn_uname'] in custom_mechs):
+            if con['syn_uname'] not in mech_ids:
+                mech_ids[con['syn_uname']] = len(mechs)
+                mechs.append(con['syn_uname'])
+            mech[n] = mech_ids[con['syn_uname']]
+        else:
+            mech[n] = 0
+
+    order = np.argsort(pre, kind='stable')
+    syn_ptr = np.zeros(len(unames) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pre, minlength=len(unames)), out=syn_ptr[1:])
+
+    network = NetworkIR(unames=unames,
+                        rids=rids,
+                        cell_model=cell_model,
+                        cell_models=cell_models,
+                        syn_ptr=syn_ptr,
+                        syn_post=post[order],
+                        syn_mech=mech[order],
+                        mechs=mechs,
+                        syn_count=count[order])
+
+    # Stim and record specs refer to neurons by id. Like the simulators themselves, we ignore
+    # anything that refers to a neuron that isn't part of the query result.
+    if stims is not None:
+        network.stims = [{**stim, 'target': network.index(stim['target'])} for stim in stims
+                         if stim['target'] in network]
+    if record_names is not None:
+        network.record = np.array([network.index(name) for name in record_names if name in network],
+                                  dtype=np.int32)
+
+    return network
+
+def network_from_query(client,
+                       res,
+                       custom_cells: tp.Iterable[str]=None,
+                       custom_mechs: tp.Iterable[str]=None,
+                       stims: tp.List[tp.Dict]=None,
+                       record_names: tp.List[str]=None,
+                       cache=None,
+                       max_workers: int=8) -> NetworkIR:
+    ''' Fetch the connectivity of a neuroNLP query result and build a NetworkIR from it
+
+    :param client: pointer to FBL client
+    :param res: FBL NAqueryResult object, representing the system to be converted
+    :param custom_cells: unames of the neurons that have a custom cell definition
+    :param custom_mechs: synapse unames that have a custom mechanism definition
+    :param stims: list of stimulation specs (see build_network())
+    :param record_names: names of the neurons to record
+    :param cache: QueryCache to reuse previously fetched connectivity from
+    :param max_workers: maximum number of concurrent client lookups used to fetch connectivity
+    '''
+
+    synapse_table = fetch_synapse_table(client, res.graph, cache=cache, max_workers=max_workers)
+
+    return build_network(G=res.graph,
+                         synapse_table=synapse_table,
+                         custom_cells=custom_cells,
+                         custom_mechs=custom_mechs,
+                         stims=stims,
+                         record_names=record_names)
+
+def aggregate_synapses(network: NetworkIR,
+                       weight: tp.Union[str, tp.Callable[[np.ndarray], np.ndarray]]='linear'
+                       ) -> tp.Tuple[NetworkIR, tp.Dict]:
+    ''' Merge parallel synapses into a single connection per (pre, post, mechanism)
+
+    .. note::
+
+        Connectomes record many synapses between the same pair of neurons. Simulating each of
+        them separately multiplies the number of connection objects the backends create
+        without changing which neurons talk to each other, so they are merged into one
+        connection whose syn_count is the sum of their contacts. Its syn_weight is the
+        weight mapping of that count: 'linear' (count), 'sqrt', 'log' (1 + log(count)),
+        'constant' (1), or a function from an array of counts to an array of weights.
+        Backends multiply the weight of the connection by it, see the 'w' variable of
+        nlptoBrian2.model_from_network() and the weight of nlpToNetpyne.netparams_from_network().
+        The aggregated network remembers the mapping, so incremental.grow_network() merges
+        the synapses it adds the same way.
+
+    :param network: network to aggregate. It isn't modified.
+    :param weight: weight mapping, one of WEIGHT_MAPPINGS or a function of the counts
+    :return: aggregated network, and a report with the numbers of 'synapses' before
+             aggregating, 'connections' after, and connection objects 'removed'
+    '''
+
+    if callable(weight):
+        mapping = weight
+    elif weight in WEIGHT_MAPPINGS:
+        mapping = WEIGHT_MAPPINGS[weight]
+    else:
+        raise ValueError("unknown weight mapping '" + str(weight) + "', expected a function or one of "
+                         + ', '.join(WEIGHT_MAPPINGS.keys()))
+
+    # Synapses are already grouped by presynaptic neuron, so sorting by (pre, post, mech) keeps
+    # the CSR order and lines parallel synapses up next to each other
+    pre = network.synapse_pre()
+    order = np.lexsort((network.syn_mech, network.syn_post, pre))
+    keys = np.stack([pre[order], network.syn_post[order], network.syn_mech[order]], axis=1)
+    first = np.ones(len(order), dtype=bool)
+    if len(order) > 0:
+        first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    starts = np.flatnonzero(first)
+
+    count = np.add.reduceat(network.syn_count[order], starts) if len(starts) > 0 else np.zeros(0, dtype=np.int32)
+    syn_ptr = np.zeros(network.n_neurons + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys[starts, 0], minlength=network.n_neurons), out=syn_ptr[1:])
+
+    aggregated = NetworkIR(unames=network.unames,
+                           rids=network.rids,
+                           cell_model=network.cell_model,
+                           cell_models=network.cell_models,
+                           syn_ptr=syn_ptr,
+                           syn_post=keys[starts, 1],
+                           syn_mech=keys[starts, 2],
+                           mechs=network.mechs,
+                           stims=network.stims,
+                           record=network.record,
+                           syn_count=count,
+                           syn_weight=np.asarray(mapping(count), dtype=np.float64),
+                           spike_ptr=network.spike_ptr,
+                           spike_times=network.spike_times,
+                           aggregation=weight)
+
+    report = {'synapses': network.n_synapses,
+              'connections': aggregated.n_synapses,
+              'removed': network.n_synapses - aggregated.n_synapses}
+
+    return aggregated, report
+
+def write_arrays(path: str, arrays: tp.Dict[str, np.ndarray], meta: tp.Dict):
+    ''' Write named arrays and JSON metadata to a single memory-mappable file
+
+    .. note::
+
+        The file is laid out as MAGIC, a little-endian uint32 format version, a uint64 header
+        length, a JSON header describing the dtype, shape and offset of every array plus the
+        metadata, and finally the raw arrays, each aligned to ALIGNMENT bytes.
+
+    :param path: path of the file to write
+    :param arrays: dictionary of array names and arrays
+    :param meta: JSON-serializable metadata to store alongside the arrays
+    '''
+
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # Header size depends on the offsets and vice versa, so lay out relative to the data start
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+
+    header = json.dumps({'arrays': layout, 'meta': meta}).encode()
+    data_start = _align(len(MAGIC) + 12 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([VERSION], dtype='<u4').tobytes())
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.write(b'\0' * (data_start + layout[name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+
+def read_arrays(path: str, mmap: bool=True) -> tp.Tuple[tp.Dict[str, np.ndarray], tp.Dict]:
+    ''' Read named arrays and metadata written by write_arrays()
+
+    :param path: path of the file to read
+    :param mmap: whether to memory-map the arrays instead of reading them into memory
+    :return: dictionary of array names and arrays, and the metadata
+    '''
+
+    with open(path, 'rb') as f:
+        if (f.read(len(MAGIC)) != MAGIC):
+            raise ValueError(path + " is not a saved network")
+        version = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        if (version != VERSION):
+            raise ValueError(path + " has format version " + str(version) + ", expected " + str(VERSION))
+        header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(header_length).decode())
+
+    data_start = _align(len(MAGIC) + 12 + header_length)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        if (mmap and int(np.prod(shape)) > 0):
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + spec['offset'], shape=shape)
+        else:
+            count = int(np.prod(shape))
+            arrays[name] = np.fromfile(path, dtype=dtype, count=count,
+                                       offset=data_start + spec['offset']).reshape(shape)
+
+    return arrays, header['meta']
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,433 @@
+import json
+import os
+import os.path
+import re
+import typing as tp
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+from .network_ir import DEFAULT, SURROGATE, NetworkIR, sanitize_name
+from .recording import import_h5py
+
+NAMESPACE = 'http://www.neuroml.org/schema/neuroml2'
+
+# Components written for labels without a NeuroML definition of their own. The synapse matches
+# the Exp2Syn default of the NetPyNE backend
+DEFAULT_CELL = {'type': 'izhikevich2007Cell', 'C': '100pF', 'v0': '-60mV', 'k': '0.7nS_per_mV', 'vr': '-60mV',
+                'vt': '-40mV', 'vpeak': '35mV', 'a': '0.03per_ms', 'b': '-2nS', 'c': '-50.0mV', 'd': '100pA'}
+DEFAULT_SYNAPSE = {'type': 'expTwoSynapse', 'gbase': '1nS', 'erev': '0mV', 'tauRise': '0.1ms', 'tauDecay': '5ms'}
+DEFAULT_INPUT = {'type': 'poissonFiringSynapse', 'averageRate': '10Hz'}
+
+# Component ids are prefixed by kind, since cells, synapses and inputs share a namespace
+CELL_PREFIX = 'cell_'
+SYNAPSE_PREFIX = 'syn_'
+INPUT_PREFIX = 'input_'
+
+def write_neuroml(path: str,
+                  network: NetworkIR,
+                  cells: tp.Dict[str, tp.Dict]=None,
+                  synapses: tp.Dict[str, tp.Dict]=None,
+                  inputs: tp.Dict[str, tp.Dict]=None,
+                  network_id: str='network',
+                  hdf5: bool=False,
+                  chunk_size: int=10000):
+    ''' Write a network to a NeuroML2 document
+
+    .. note::
+
+        The document is written as it is generated, a chunk of connections at a time, so
+        neither the document nor an object model of it is ever held in memory.
+
+        Cell models, synaptic mechanisms and stimulation sources are written as components
+        with the id of their label, prefixed with CELL_PREFIX, SYNAPSE_PREFIX or INPUT_PREFIX.
+        Each is defined by a dict holding the NeuroML2 element 'type' and its attributes, e.g.
+        {'type': 'iafCell', 'C': '1nF', ...}, and falls back to DEFAULT_CELL, DEFAULT_SYNAPSE
+        or DEFAULT_INPUT. Inputs without a 'synapse' deliver their spikes through the default
+        synapse. Neuron unames and rids are stored as properties of their population, so
+        read_neuroml() gets the same network back. Recorded neurons and backend-specific
+        stimulation parameters (weight, delay, ...) aren't part of NeuroML2 networks, and are
+        left out. Connections of a network with synapse weights other than 1 (see
+        network_ir.aggregate_synapses()) are written as connectionWD elements carrying their
+        weight, with a delay of 0ms. Their numbers of contacts, if any isn't 1, and the weight
+        mapping they were aggregated with are stored as properties of the network.
+
+        Surrogate neurons (see partition.extract_partition()) are written as a population of
+        one each, of a spikeArray component holding their spike train.
+
+        With hdf5, the projections are written to a NeuroML2 HDF5 file next to the document
+        instead (path with its extension replaced by .projections.nml.h5), and included from
+        it. Connectivity is then stored as binary arrays rather than an element per
+        connection, which is far smaller and faster to read for large networks, and numbers
+        of contacts as a column of them. Needs h5py.
+
+    :param path: path of the document to write, e.g. network.net.nml
+    :param network: network to write
+    :param cells: NeuroML2 definitions of the network's cell models, keyed by label
+    :param synapses: NeuroML2 definitions of the network's synaptic mechanisms, keyed by label
+    :param inputs: NeuroML2 definitions of the network's stimulation sources, keyed by name
+    :param network_id: id of the network element
+    :param hdf5: whether to write projections to an HDF5 file instead
+    :param chunk_size: number of connections formatted at a time
+    '''
+
+    if cells is None: cells = {}
+    if synapses is None: synapses = {}
+    if inputs is None: inputs = {}
+    if (hdf5):
+        import_h5py('writing projections to HDF5')
+
+    pops, neuron_pop, neuron_idx = _populations(network)
+    projections = _projections(network, neuron_pop, neuron_idx)
+
+    projections_path = None
+    if (hdf5):
+        projections_path = _projections_path(path)
+        _write_projections_hdf5(projections_path, network_id, network, pops, projections)
+
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<neuroml xmlns="' + NAMESPACE + '" '
+                'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                'xsi:schemaLocation="' + NAMESPACE + ' https://raw.github.com/NeuroML/NeuroML2/development/Schemas/NeuroML2/NeuroML_v2.3.xsd" '
+                'id=' + quoteattr(network_id) + '>\n')
+        if (projections_path is not None):
+            f.write('    <include href=' + quoteattr(os.path.basename(projections_path)) + '/>\n')
+
+        # Components
+        for label in network.cell_models:
+            if (label != SURROGATE):
+                f.write(_component(CELL_PREFIX + _nml_id(label), cells.get(label, DEFAULT_CELL)))
+        for component, members in pops:
+            if component.startswith(CELL_PREFIX + SURROGATE + '_'):
+                f.write(_spike_array(component, network.spike_train(members[0])))
+        for label in sorted(set(network.mechs) | {DEFAULT}):
+            f.write(_component(SYNAPSE_PREFIX + _nml_id(label), synapses.get(label, DEFAULT_SYNAPSE)))
+        for source in sorted({stim['source'] for stim in network.stims}):
+            definition = dict(inputs.get(source, DEFAULT_INPUT))
+            if (definition.get('type') in ['poissonFiringSynapse', 'transientPoissonFiringSynapse']):
+                definition.setdefault('synapse', SYNAPSE_PREFIX + DEFAULT)
+                definition.setdefault('spikeTarget', './' + definition['synapse'])
+            f.write(_component(INPUT_PREFIX + _nml_id(source), definition))
+
+        f.write('    <network id=' + quoteattr(network_id) + '>\n')
+        if (projections_path is None and np.any(network.syn_count != 1)):
+            counts = (','.join(map(str, count.tolist())) for *_, count in projections)
+            f.write('        <property tag="syn_count" value="[' + ','.join(counts) + ']"/>\n')
+        if isinstance(network.aggregation, str):
+            f.write('        <property tag="aggregation" value=' + quoteattr(network.aggregation) + '/>\n')
+
+        # Populations, with the unames and rids of their neurons in index order
+        for p, (component, members) in enumerate(pops):
+            f.write('        <population id="pop_' + str(p) + '" component=' + quoteattr(component)
+                    + ' size="' + str(len(members)) + '">\n')
+            f.write('            <property tag="unames" value=' + quoteattr(json.dumps(network.unames[members].tolist())) + '/>\n')
+            f.write('            <property tag="rids" value=' + quoteattr(json.dumps(network.rids[members].tolist())) + '/>\n')
+            f.write('        </population>\n')
+
+        if (projections_path is None):
+            weighted = np.any(network.syn_weight != 1)
+            for n, (mech, pre_pop, post_pop, pre, post, weight, _) in enumerate(projections):
+                f.write('        <projection id="proj_' + str(n) + '" presynapticPopulation="pop_' + str(pre_pop)
+                        + '" postsynapticPopulation="pop_' + str(post_pop) + '" synapse='
+                        + quoteattr(SYNAPSE_PREFIX + _nml_id(network.mechs[mech])) + '>\n')
+                if (weighted):
+                    line = ('            <connectionWD id="%d" preCellId="../pop_' + str(pre_pop) + '[%d]" postCellId="../pop_'
+                            + str(post_pop) + '[%d]" weight="%r" delay="0ms"/>\n')
+                else:
+                    line = ('            <connection id="%d" preCellId="../pop_' + str(pre_pop) + '[%d]" postCellId="../pop_'
+                            + str(post_pop) + '[%d]"/>\n')
+                for start in range(0, len(pre), chunk_size):
+                    stop = min(start + chunk_size, len(pre))
+                    rows = zip(range(start, stop), pre[start:stop].tolist(), post[start:stop].tolist(),
+                               weight[start:stop].tolist())
+                    f.write(''.join([line % (row if weighted else row[:3]) for row in rows]))
+                f.write('        </projection>\n')
+
+        # Inputs, one list per stimulation source and population
+        stims = {}
+        for stim in network.stims:
+            stims.setdefault((stim['source'], int(neuron_pop[stim['target']])), []).append(int(neuron_idx[stim['target']]))
+        for n, ((source, pop), targets) in enumerate(sorted(stims.items())):
+            f.write('        <inputList id="inputs_' + str(n) + '" population="pop_' + str(pop) + '" component='
+                    + quoteattr(INPUT_PREFIX + _nml_id(source)) + '>\n')
+            for k, i in enumerate(targets):
+                f.write('            <input id="' + str(k) + '" target="../pop_' + str(pop) + '[' + str(i)
+                        + ']" destination="synapses"/>\n')
+            f.write('        </inputList>\n')
+
+        f.write('    </network>\n')
+        f.write('</neuroml>\n')
+
+def read_neuroml(path: str) -> NetworkIR:
+    ''' Read a NeuroML2 network back into a NetworkIR
+
+    .. note::
+
+        Meant for documents written by write_neuroml(), but anything using populations of a
+        given size, projections of connections, input lists and spike arrays is read. Neurons
+        of populations without unames are named '<population>_<index>'. Labels are the
+        component ids with their prefix removed, in the sanitized form of write_neuroml() (see
+        _nml_id()). Projections of included NeuroML2 HDF5 files are read too (needs h5py).
+
+        Neurons are numbered population by population, so a network written by write_neuroml()
+        comes back with its neurons grouped by cell model (in their order within every group),
+        followed by its surrogates.
+
+    :param path: path of the document to read
+    '''
+
+    pops = {}
+    projections = []
+    stims = []
+    includes = []
+    spike_arrays = {}
+    network_properties = {}
+    pre, post, weight = [], [], []
+
+    # Connections are collected as they are parsed, and dropped from the tree right away
+    for _, element in ET.iterparse(path, events=['end']):
+        tag = element.tag.rsplit('}', 1)[-1]
+
+        if (tag == 'include'):
+            includes.append(os.path.join(os.path.dirname(path), element.get('href')))
+        elif (tag == 'spikeArray'):
+            spike_arrays[element.get('id')] = [_time(spike.get('time')) for spike in element
+                                               if spike.tag.rsplit('}', 1)[-1] == 'spike']
+            element.clear()
+        elif (tag == 'network'):
+            network_properties = {p.get('tag'): p.get('value') for p in element if p.tag.rsplit('}', 1)[-1] == 'property'}
+        elif (tag == 'population'):
+            properties = {p.get('tag'): p.get('value') for p in element if p.tag.rsplit('}', 1)[-1] == 'property'}
+            size = int(element.get('size'))
+            pops[element.get('id')] = {'label': _strip(element.get('component'), CELL_PREFIX),
+                                       'spikes': spike_arrays.get(element.get('component')),
+                                       'size': size,
+                                       'unames': json.loads(properties['unames']) if 'unames' in properties else
+                                                 [element.get('id') + '_' + str(i) for i in range(size)],
+                                       'rids': json.loads(properties['rids']) if 'rids' in properties else
+                                               [''] * size}
+            element.clear()
+        elif (tag in ['connection', 'connectionWD']):
+            pre.append(_cell_index(element.get('preCellId')))
+            post.append(_cell_index(element.get('postCellId')))
+            weight.append(float(element.get('weight', 1)))
+            element.clear()
+        elif (tag == 'projection'):
+            projections.append((element.get('presynapticPopulation'), element.get('postsynapticPopulation'),
+                                _strip(element.get('synapse'), SYNAPSE_PREFIX),
+                                np.array(pre, dtype=np.int64), np.array(post, dtype=np.int64),
+                                np.array(weight, dtype=np.float64), None))
+            pre, post, weight = [], [], []
+            element.clear()
+        elif (tag == 'inputList'):
+            source = _strip(element.get('component'), INPUT_PREFIX)
+            for i in element:
+                stims.append({'source': source, 'population': element.get('population'),
+                              'index': _cell_index(i.get('target'))})
+            element.clear()
+
+    for include in includes:
+        if include.endswith('.h5'):
+            projections.extend(_read_projections_hdf5(include))
+
+    # Neurons are numbered population by population. Populations of spike arrays are surrogates
+    offsets = {}
+    unames, rids, labels, trains = [], [], [], []
+    for pop, spec in pops.items():
+        offsets[pop] = len(unames)
+        unames.extend(spec['unames'])
+        rids.extend(spec['rids'])
+        labels.extend([spec['label'] if spec['spikes'] is None else SURROGATE] * spec['size'])
+        trains.extend([spec['spikes'] if spec['spikes'] is not None else []] * spec['size'])
+
+    cell_models = [DEFAULT] + sorted(set(labels) - {DEFAULT})
+    cell_model_ids = {label: i for i, label in enumerate(cell_models)}
+    mechs = [DEFAULT] + sorted({mech for _, _, mech, *_ in projections} - {DEFAULT})
+    mech_ids = {label: i for i, label in enumerate(mechs)}
+
+    empty = [np.zeros(0, dtype=np.int64)]
+    pre = np.concatenate([offsets[pre_pop] + i for pre_pop, _, _, i, _, _, _ in projections] + empty)
+    post = np.concatenate([offsets[post_pop] + j for _, post_pop, _, _, j, _, _ in projections] + empty)
+    mech = np.concatenate([np.full(len(i), mech_ids[label]) for _, _, label, i, _, _, _ in projections] + empty)
+    weight = np.concatenate([w for _, _, _, _, _, w, _ in projections] + [np.zeros(0)])
+    if 'syn_count' in network_properties:
+        count = np.array(json.loads(network_properties['syn_count']), dtype=np.int64)
+    else:
+        count = np.concatenate([c if c is not None else np.ones(len(i), dtype=np.int64)
+                                for _, _, _, i, _, _, c in projections] + empty)
+
+    order = np.argsort(pre, kind='stable')
+    syn_ptr = np.zeros(len(unames) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pre, minlength=len(unames)), out=syn_ptr[1:])
+    spike_ptr = np.zeros(len(unames) + 1, dtype=np.int64)
+    np.cumsum([len(train) for train in trains], out=spike_ptr[1:])
+
+    return NetworkIR(unames=unames,
+                     rids=rids,
+                     cell_model=np.array([cell_model_ids[label] for label in labels], dtype=np.int32),
+                     cell_models=cell_models,
+                     syn_ptr=syn_ptr,
+                     syn_post=post[order],
+                     syn_mech=mech[order],
+                     mechs=mechs,
+                     stims=[{'source': stim['source'], 'target': offsets[stim['population']] + stim['index']}
+                            for stim in stims],
+                     syn_count=count[order],
+                     syn_weight=weight[order],
+                     spike_ptr=spike_ptr,
+                     spike_times=np.array([t for train in trains for t in train], dtype=np.float64),
+                     aggregation=network_properties.get('aggregation'))
+
+def brian2_from_neuroml(path: str,
+                        custom_mechs: tp.Dict[str, tp.Dict]=None,
+                        custom_cells: tp.Dict[str, tp.Dict]=None,
+                        **kwargs):
+    ''' Build a brian2 network from a NeuroML2 document, in this process
+
+    .. note::
+
+        Replaces running the document through pynml -brian2, which starts a JVM on every call
+        and can't simulate projections. The document is read with read_neuroml(), and the
+        network is emitted by nlptoBrian2.model_from_network() as if it came from a query, so
+        cell models, synaptic mechanisms and stimulation sources are defined by brian2
+        definitions keyed by their labels, like for model_gen().
+
+    :param path: path of the document to read
+    :param custom_mechs: brian2 synaptic mechanism definitions, keyed by label
+    :param custom_cells: brian2 cell definitions, keyed by label
+    :param kwargs: any other arguments of nlptoBrian2.model_from_network(), e.g. default_cell,
+                   default_mech, stim_sources and vectorized
+    '''
+
+    from .nlptoBrian2 import model_from_network
+
+    # Labels were sanitized on the way into the document
+    custom_mechs = {_nml_id(label): mech for label, mech in (custom_mechs or {}).items()}
+    custom_cells = {_nml_id(label): cell for label, cell in (custom_cells or {}).items()}
+
+    return model_from_network(read_neuroml(path), custom_mechs=custom_mechs, custom_cells=custom_cells, **kwargs)
+
+def _nml_id(label: str) -> str:
+    ''' A label turned into a valid NeuroML2 id '''
+
+    label = re.sub('[^A-Za-z0-9_]', '_', sanitize_name(label))
+    return label if re.match('[A-Za-z_]', label) else '_' + label
+
+def _strip(component: str, prefix: str) -> str:
+    return component[len(prefix):] if component.startswith(prefix) else component
+
+def _cell_index(reference: str) -> int:
+    ''' Index of the cell a NeuroML2 cell reference ('../pop[3]' or '../pop/3/cell') points to '''
+
+    if reference.endswith(']'):
+        return int(reference[reference.rindex('[') + 1:-1])
+    return int(reference.split('/')[2])
+
+def _time(value: str) -> float:
+    ''' A NeuroML2 time ('1.5ms' or '0.0015s') in ms '''
+
+    if value.endswith('ms'):
+        return float(value[:-2])
+    return float(value[:-1]) * 1e3 if value.endswith('s') else float(value)
+
+def _spike_array(component_id: str, times: np.ndarray) -> str:
+    spikes = ''.join('        <spike id="' + str(k) + '" time="' + repr(t) + 'ms"/>\n' for k, t in enumerate(times.tolist()))
+    return '    <spikeArray id=' + quoteattr(component_id) + '>\n' + spikes + '    </spikeArray>\n'
+
+def _component(component_id: str, definition: tp.Dict) -> str:
+    attributes = ''.join(' ' + name + '=' + quoteattr(str(value)) for name, value in definition.items() if name != 'type')
+    return '    <' + definition['type'] + ' id=' + quoteattr(component_id) + attributes + '/>\n'
+
+def _populations(network: NetworkIR) -> tp.Tuple[tp.List[tp.Tuple[str, np.ndarray]], np.ndarray, np.ndarray]:
+    ''' A population per cell model, and one per surrogate neuron, with the id of their cell
+    component, and the population and index of every neuron '''
+
+    neuron_pop = np.empty(network.n_neurons, dtype=np.int64)
+    neuron_idx = np.empty(network.n_neurons, dtype=np.int64)
+    pops = []
+    for model in np.unique(network.cell_model).tolist():
+        label = network.cell_models[model]
+        members = np.flatnonzero(network.cell_model == model)
+        groups = np.split(members, len(members)) if label == SURROGATE else [members]
+        for group in groups:
+            neuron_pop[group] = len(pops)
+            neuron_idx[group] = np.arange(len(group))
+            component = CELL_PREFIX + (_nml_id(label) if label != SURROGATE else SURROGATE + '_' + str(group[0]))
+            pops.append((component, group))
+
+    return pops, neuron_pop, neuron_idx
+
+def _projections(network: NetworkIR, neuron_pop: np.ndarray, neuron_idx: np.ndarray) -> tp.List[tp.Tuple]:
+    ''' Synapses grouped by (mechanism, presynaptic population, postsynaptic population) '''
+
+    pre = network.synapse_pre()
+    post = network.syn_post
+    keys = np.stack([network.syn_mech, neuron_pop[pre], neuron_pop[post]], axis=1)
+    order = np.lexsort(keys.T[::-1])
+
+    projections = []
+    if (len(order) > 0):
+        split = np.flatnonzero(np.any(np.diff(keys[order], axis=0) != 0, axis=1)) + 1
+        for syns in np.split(order, split):
+            mech, pre_pop, post_pop = keys[syns[0]].tolist()
+            projections.append((mech, pre_pop, post_pop, neuron_idx[pre[syns]], neuron_idx[post[syns]],
+                                network.syn_weight[syns], network.syn_count[syns]))
+
+    return projections
+
+def _projections_path(path: str) -> str:
+    stem = path[:-len('.nml')] if path.endswith('.nml') else path
+    return stem + '.projections.nml.h5'
+
+def _write_projections_hdf5(path: str, network_id: str, network: NetworkIR, pops: tp.List, projections: tp.List):
+    ''' Write projections in the NeuroML2 HDF5 layout: a group per projection, holding a
+    connection dataset with a row of (id, pre_cell_id, post_cell_id) per connection, a weight
+    column if any synapse weight isn't 1, and a syn_count column if any count isn't 1 '''
+
+    h5py = import_h5py('writing projections to HDF5')
+    with h5py.File(path, 'w') as f:
+        root = f.create_group('neuroml')
+        root.attrs['id'] = network_id + '_projections'
+        group = root.create_group('network')
+        group.attrs['id'] = network_id
+
+        weighted = np.any(network.syn_weight != 1)
+        counted = np.any(network.syn_count != 1)
+        for n, (mech, pre_pop, post_pop, pre, post, weight, count) in enumerate(projections):
+            projection = group.create_group('projection_proj_' + str(n))
+            projection.attrs['id'] = 'proj_' + str(n)
+            projection.attrs['type'] = 'projection'
+            projection.attrs['presynapticPopulation'] = 'pop_' + str(pre_pop)
+            projection.attrs['postsynapticPopulation'] = 'pop_' + str(post_pop)
+            projection.attrs['synapse'] = SYNAPSE_PREFIX + _nml_id(network.mechs[mech])
+
+            columns = [np.arange(len(pre)), pre, post] + ([weight] if weighted else []) + ([count] if counted else [])
+            connections = projection.create_dataset('connection', data=np.stack(columns, axis=1).astype(np.float64))
+            names = ['id', 'pre_cell_id', 'post_cell_id'] + (['weight'] if weighted else []) + (['syn_count'] if counted else [])
+            for c, column in enumerate(names):
+                connections.attrs['column_' + str(c)] = column
+
+def _read_projections_hdf5(path: str) -> tp.List[tp.Tuple]:
+    h5py = import_h5py('reading projections from HDF5')
+
+    projections = []
+    with h5py.File(path, 'r') as f:
+        for group in f['neuroml/network'].values():
+            if (group.attrs.get('type') != 'projection'):
+                continue
+
+            connections = group['connection']
+            columns = {connections.attrs[name]: int(name[len('column_'):]) for name in connections.attrs
+                       if name.startswith('column_')}
+            data = connections[:]
+            projections.append((group.attrs['presynapticPopulation'], group.attrs['postsynapticPopulation'],
+                                _strip(group.attrs['synapse'], SYNAPSE_PREFIX),
+                                data[:, columns.get('pre_cell_id', 1)].astype(np.int64),
+                                data[:, columns.get('post_cell_id', 2)].astype(np.int64),
+                                data[:, columns['weight']].astype(np.float64) if 'weight' in columns else
+                                np.ones(len(data)),
+                                data[:, columns['syn_count']].astype(np.int64) if 'syn_count' in columns else None))
+
+    return projections
@@ -1,14 +1,29 @@
-import flybrainlab as fbl
-import netpyne
-from netpyne.specs import netParams, SimConfig
-from netpyne import conversion, sim
+from __future__ import annotations
+
+import json
 import networkx as nx
 import numpy as np
 import os
 import os.path
-import tempfile
+import subprocess
 import typing as tp
 
+from .analysis import SimulationResults
+from .cache import QueryCache
+from .checkpoint import Checkpoint
+from .connectivity import fetch_synapse_table
+from .morphology import MorphologyCache, import_morphology, morphology_key, reduce_morphology, swc_arrays
+from .network_ir import DEFAULT, SURROGATE, NetworkIR, aggregate_synapses, build_network
+from .neuroml import write_neuroml
+from .profiling import Profiler
+from .recording import Recording
+
+# netpyne (and with it NEURON) and flybrainlab take seconds to import, so they are imported by
+# the functions that use them rather than along with this module
+if tp.TYPE_CHECKING:
+    import flybrainlab as fbl
+    import netpyne
+
 def model_gen(client: fbl.Client,
               res: fbl.graph.NAqueryResult,
               filename: str,
@@ -21,7 +36,18 @@ def model_gen(client: fbl.Client,
               record_names: tp.List=None,
               sim_duration: int=1*1e3,
               dt: int=0.05,
-              maintain_morphology: bool=False) -> tp.Tuple:
+              maintain_morphology: bool=False,
+              max_workers: int=8,
+              cache: QueryCache=None,
+              vectorized: bool=False,
+              network: NetworkIR=None,
+              morphology_cache: MorphologyCache=None,
+              morphology_reduction: tp.Dict=None,
+              profiler: Profiler=None,
+              headless: bool=False,
+              recording: Recording=None,
+              aggregate: tp.Union[str, tp.Callable]=None,
+              integration: tp.Dict=None) -> tp.Tuple:
     ''' Generates a netpyne model and simulation parameters from a neuroNLP graph
     
     .. note::
@@ -43,7 +69,8 @@ def model_gen(client: fbl.Client,
               (http://netpyne.org/reference.html#function-string)
     
     :param client: pointer to FBL client
-    :param res: FBL NAqueryResult object, representing the system to be converted to netpyne
+    :param res: FBL NAqueryResult object, representing the system to be converted to netpyne.
+                Can be None when a network is passed in, unless morphology is maintained.
     :param filename: name of the file to save sim outputs to
     :param custom_mechs: dictionary of all custom synaptic mechanisms to be used in the simulation.
                          It should be noted that since all custom mechanisms are defined here
@@ -64,67 +91,259 @@ def model_gen(client: fbl.Client,
     :param maintain_morphology: whether or not model morphology should be maintained in the
                                 simulation (not recommended if neuron sections are unidentified
                                 in swc definitions)
+    :param max_workers: maximum number of concurrent client lookups used to fetch connectivity
+    :param cache: QueryCache to reuse previously fetched connectivity from. Get res from the
+                  module function cache.execute_query(client, query, cache) too, to make warm
+                  builds skip the client entirely.
+    :param vectorized: whether to group neurons into shared populations connected through
+                       explicit connection lists (see generate_netparams_vectorized()).
+                       Recommended for anything past a few hundred neurons.
+    :param network: previously built NetworkIR of the query (see network_ir.network_from_query()).
+                    Passing the same network to both backends guarantees they simulate the
+                    same thing, and skips fetching connectivity from the client.
+    :param morphology_cache: MorphologyCache to reuse imported morphologies from when
+                             maintain_morphology is set. Defaults to an in-memory cache shared by
+                             the whole session; pass one with a directory to also reuse them
+                             between sessions.
+    :param morphology_reduction: keyword arguments of morphology.reduce_morphology(), e.g.
+                                 {'max_length': 20, 'min_branch_length': 2}. When given with
+                                 maintain_morphology, every morphology is coarsened before it is
+                                 imported, and the returned networkParams carries a
+                                 morphology_report of the compartment counts before and after.
+    :param profiler: Profiler to record the time and memory of the 'fetch', 'build' and 'emit'
+                     phases in, along with neuron, synapse and netpyne rule counts
+    :param headless: whether to leave all plotting out of the simulation configuration (see
+                     generate_simconfig()). Combine with simulate(headless=True).
+    :param recording: Recording to stream spikes and traces to disk with while simulating (see
+                      configure_recording()). Pass it to simulate() too.
+    :param aggregate: weight mapping to merge parallel synapses with before emitting the model
+                      (see network_ir.aggregate_synapses()), e.g. 'linear'. The returned
+                      networkParams then carries the aggregation_report.
+    :param integration: integration strategy to simulate with, e.g. {'cvode': True, 'atol': 1e-4}
+                        (see configure_integration()). Its 'dt' takes precedence over dt.
+                        integration.calibrate() picks one for a network.
     '''
     
-    # Define helper variables for easy access later
-    G = res.graph
-    neurons = res.neurons
-    synapses = res.synapses
+    # Define helper variables for easy access later. Prebuilt networks don't need a query result
+    G = None
+    if (res != None):
+        G = res.graph
+        neurons = res.neurons
+        synapses = res.synapses
+    
+    if profiler == None: profiler = Profiler(enabled=False)
+    
+    # Build the simulator-neutral network, unless we were handed one
+    if (network == None):
+        with profiler.phase('fetch'):
+            synapse_table = fetch_synapse_table(client, G, cache=cache, max_workers=max_workers)
+        
+        with profiler.phase('build'):
+            network = build_network(G=G,
+                                    synapse_table=synapse_table,
+                                    custom_cells=custom_cells,
+                                    custom_mechs=custom_mechs,
+                                    stims=_stim_specs(stim_targets),
+                                    record_names=record_names)
+    
+    report = None
+    if (aggregate != None):
+        with profiler.phase('aggregate'):
+            network, report = aggregate_synapses(network, aggregate)
+        profiler.count('synapses_removed', report['removed'])
+    
+    # netpyne would create surrogates as cells without sections, and fail on their missing cellType
+    if network.surrogates().any():
+        from neuron import h
+        if not hasattr(h, 'VecStim'):
+            raise RuntimeError('surrogate neurons need the VecStim mechanism, compile vecstim.mod with nrnivmodl')
     
     # Generate network parameters and simulation configuration settings
-    networkParams = generate_netparams(client=client,
-                                       neurons=neurons,
-                                       synapses=synapses,
-                                       G=G,
-                                       custom_mechs=custom_mechs,
-                                       custom_cells=custom_cells,
-                                       default_mech=default_mech,
-                                       default_cell=default_cell,
-                                       stim_sources=stim_sources,
-                                       stim_targets=stim_targets,
-                                       maintain_morphology=maintain_morphology)
-    simConfig = generate_simconfig(duration=sim_duration,
-                                   dt=dt,
-                                   filename=filename,
-                                   cells=record_names)
+    with profiler.phase('emit'):
+        networkParams = netparams_from_network(network=network,
+                                               custom_mechs=custom_mechs,
+                                               custom_cells=custom_cells,
+                                               default_mech=default_mech,
+                                               default_cell=default_cell,
+                                               stim_sources=stim_sources,
+                                               maintain_morphology=maintain_morphology,
+                                               G=G,
+                                               vectorized=vectorized,
+                                               morphology_cache=morphology_cache,
+                                               morphology_reduction=morphology_reduction)
+        if (report != None):
+            networkParams.aggregation_report = report
+    
+        # Recorded cells have to be referred to by population and index once populations are shared
+        if (vectorized and record_names != None):
+            record_names = [networkParams.neuron_index[name] for name in record_names
+                            if name in networkParams.neuron_index]
+    
+        simConfig = generate_simconfig(duration=sim_duration,
+                                       dt=dt,
+                                       filename=filename,
+                                       cells=record_names,
+                                       headless=headless)
+        
+        if (integration != None):
+            configure_integration(simConfig, integration)
+        if (recording != None):
+            configure_recording(simConfig, networkParams, recording)
+    
+    profiler.count('neurons', network.n_neurons)
+    profiler.count('synapses', network.n_synapses)
+    profiler.count('populations', len(networkParams.popParams))
+    profiler.count('cell_rules', len(networkParams.cellParams))
+    profiler.count('conn_rules', len(networkParams.connParams))
+    profiler.count('stim_targets', len(networkParams.stimTargetParams))
     
     return networkParams, simConfig
 
 def simulate(networkParams: netpyne.specs.netParams.NetParams,
-             simConfig: netpyne.specs.simConfig.SimConfig):
+             simConfig: netpyne.specs.simConfig.SimConfig,
+             profiler: Profiler=None,
+             headless: bool=False,
+             recording: Recording=None,
+             checkpoint: Checkpoint=None) -> tp.Optional[SimulationResults]:
     ''' Create and run netpyne simulation
     
     :param networkParams: netpyne networkParams object to simulate
     :param simConfig: netpyne SimConfig object with desired simulation configuration 
+    :param profiler: Profiler to record the time and memory of the 'create', 'run' and 'analysis'
+                     phases in, along with cell, connection and stimulation counts
+    :param headless: skip netpyne's analysis and plotting, and return the spikes and traces of
+                     the simulation as a SimulationResults instead (see simulation_results())
+    :param recording: Recording configured with configure_recording(). The simulation is run in
+                      intervals of flush_every ms, handing everything recorded to the recording
+                      after each of them. Since that leaves nothing in memory to plot or return,
+                      analysis is skipped; read the recording back with
+                      recording.read_recording() instead.
+    :param checkpoint: Checkpoint to write the state of the simulation to every checkpoint.every
+                       ms, see checkpoint.resume() and checkpoint.fork()
     '''
     
-    # Simulate and run
-    sim.createSimulateAnalyze(netParams = networkParams, simConfig = simConfig)
+    from netpyne import sim
+    
+    if profiler == None: profiler = Profiler(enabled=False)
+    
+    # Simulate and run, the same steps as sim.createSimulateAnalyze()
+    with profiler.phase('create'):
+        sim.create(netParams = networkParams, simConfig = simConfig)
+    
+    with profiler.phase('run'):
+        if (recording == None and checkpoint == None):
+            sim.simulate()
+        else:
+            if (recording != None):
+                _attach_recording(networkParams, recording)
+            if (checkpoint != None):
+                checkpoint.begin(networkParams, sim.cfg.duration, simConfig)
+            
+            def interval(t):
+                if (recording != None):
+                    recording.flush()
+                if (checkpoint != None and (checkpoint.due(t) or t >= sim.cfg.duration - sim.cfg.dt / 2)):
+                    checkpoint.save(networkParams, t)
+            
+            intervals = [owner.flush_every if owner is recording else owner.every
+                         for owner in [recording, checkpoint] if owner != None]
+            sim.runSimWithIntervalFunc(min(intervals), interval)
+            if (recording != None):
+                recording.close(sim.cfg.duration)
+            sim.gatherData()
+    
+    with profiler.phase('analysis'):
+        if (recording != None):
+            results = None
+        elif (headless):
+            results = simulation_results(networkParams)
+        else:
+            sim.analyze()
+            results = None
+    
+    if profiler.enabled:
+        profiler.count('cells', len(sim.net.cells))
+        profiler.count('connections', sum(len(cell.conns) for cell in sim.net.cells))
+        profiler.count('stims', sum(len(cell.stims) for cell in sim.net.cells))
+    
+    return results
+
+def simulation_results(networkParams: netpyne.specs.netParams.NetParams) -> SimulationResults:
+    ''' Collect the spikes and traces of the last netpyne simulation as NumPy arrays
+    
+    :param networkParams: netpyne networkParams object that was simulated, as generated by
+                          model_gen()
+    '''
+    
+    from netpyne import sim
+    
+    # Map the gids of simulated cells back to neurons. allPops holds the gids of every rank
+    names = []
+    gid_to_neuron = {}
+    for pop, cell_names in networkParams.neuron_names.items():
+        for gid, name in zip(sim.net.allPops[pop]['cellGids'], cell_names):
+            gid_to_neuron[gid] = len(names)
+            names.append(name)
+    
+    data = sim.allSimData
+    spike_neurons = np.array([gid_to_neuron.get(int(gid), -1) for gid in data['spkid']], dtype=np.int64)
+    spike_times = np.asarray(data['spkt'], dtype=np.float64)
+    
+    # One trace per recorded variable, with the same cells recorded for every variable
+    traces = {}
+    trace_neurons = None
+    for key, trace in sim.cfg.recordTraces.items():
+        if key not in data:
+            continue
+        gids = sorted(int(cell.split('_')[1]) for cell in data[key].keys())
+        traces[trace['var']] = np.array([np.asarray(data[key]['cell_' + str(gid)]) for gid in gids])
+        trace_neurons = np.array([gid_to_neuron[gid] for gid in gids], dtype=np.int64)
+    
+    return SimulationResults(names=names,
+                             spike_times=spike_times[spike_neurons >= 0],
+                             spike_neurons=spike_neurons[spike_neurons >= 0],
+                             t=np.asarray(data['t'], dtype=np.float64) if 't' in data else None,
+                             traces=traces,
+                             trace_neurons=trace_neurons,
+                             duration=sim.cfg.duration)
 
 def export_model(networkParams: netpyne.specs.netParams.NetParams,
                  simConfig: netpyne.specs.simConfig.SimConfig,
                  filename: str,
-                 exp_type: str="python"):
+                 exp_type: str="python",
+                 network: NetworkIR=None):
     ''' Export netpyne model to a certain format
     
     .. note:
     
-        python: use when exporting a model to run on netpyne somewhere else
+        python: use when exporting a model to run on netpyne somewhere else. To save a model
+        for reloading it later, snapshot.save_model() is much faster and smaller.
         neuroml: use when exporting a model to a simulator compatable with the neuroml format. Make sure
         that you've set up the simulation before doing this! (Doesn't require you to import network
         parameters for some reason)
         
+        Pass the network the model was generated from to export it to neuroml directly with
+        neuroml.write_neuroml() instead, which needs neither the simulation nor NEURON, and is
+        much faster for large networks. Cells and synaptic mechanisms are then written as
+        neuroml.DEFAULT_CELL and neuroml.DEFAULT_SYNAPSE; call write_neuroml() yourself to
+        define them.
+        
     :param networkParams: netpyne networkParams object to export
     :param simConfig: netpye SimConfig object to export
     :param filename: name of exported file
     :exp_type: 'python' or 'neuroml'
+    :param network: NetworkIR the model was generated from, to export to neuroml directly
     '''
     
+    from netpyne import conversion
+    
     if (exp_type != "python" and exp_type != "neuroml"):
         raise ValueError("exp_type must be 'python' or 'neuroml'")
         
     if (exp_type == "python"):
         conversion.pythonScript.createPythonScript(filename, networkParams, simConfig)
+    elif (network != None):
+        write_neuroml(filename, network)
     else:
         conversion.neuromlFormat.exportNeuroML2(filename)
         
@@ -135,7 +354,8 @@ def run_with_brian2(file_path):
         
             brian2 does not support simulations of network models with projections between
             cell populations. If the network model contains any synapses or stimulation sources,
-            it will not run!
+            it will not run! Use neuroml.brian2_from_neuroml() instead, which builds the
+            network in this process, projections included, and doesn't start a JVM.
             
             Additionally, the following are required:
                 - pyneuroml
@@ -147,7 +367,7 @@ def run_with_brian2(file_path):
                           with export_model()
     '''
     
-    os.system("pynml" + file_path + "-brian2")
+    subprocess.run(["pynml", file_path, "-brian2"], check=True)
     
     
 def generate_netparams(client: fbl.Client,
@@ -160,7 +380,8 @@ def generate_netparams(client: fbl.Client,
                        default_cell: tp.Dict=None,
                        stim_sources: tp.Dict[str, tp.Dict]=None,
                        stim_targets: tp.Dict[str, tp.Dict]=None,
-                       maintain_morphology: bool=False) -> netpyne.specs.netParams.NetParams:
+                       maintain_morphology: bool=False,
+                       synapse_table: tp.List[tp.Dict]=None) -> netpyne.specs.netParams.NetParams:
     ''' Generate a netpyne NetParams object from neurons and synapses.
     
     .. note::
@@ -187,13 +408,416 @@ def generate_netparams(client: fbl.Client,
     :param maintain_morphology: whether or not model morphology should be maintained in the
                                 simulation (not recommended if neuron sections are unidentified
                                 in swc definitions)
+    :param synapse_table: synapse table of the graph (see connectivity.fetch_synapse_table()). It
+                          is fetched from the client if not provided.
+    '''
+    
+    if (synapse_table == None):
+        synapse_table = fetch_synapse_table(client, G)
+    
+    network = build_network(G=G,
+                            synapse_table=synapse_table,
+                            custom_cells=custom_cells,
+                            custom_mechs=custom_mechs,
+                            stims=_stim_specs(stim_targets))
+    
+    return netparams_from_network(network=network,
+                                  custom_mechs=custom_mechs,
+                                  custom_cells=custom_cells,
+                                  default_mech=default_mech,
+                                  default_cell=default_cell,
+                                  stim_sources=stim_sources,
+                                  maintain_morphology=maintain_morphology,
+                                  G=G)
+
+def generate_netparams_vectorized(client: fbl.Client,
+                                  neurons: tp.Dict,
+                                  synapses: tp.Dict,
+                                  G: nx.graph,
+                                  custom_mechs: tp.Dict[str, tp.Dict]=None,
+                                  custom_cells: tp.Dict[str, tp.Dict]=None,
+                                  default_mech: tp.Dict=None,
+                                  default_cell: tp.Dict=None,
+                                  stim_sources: tp.Dict[str, tp.Dict]=None,
+                                  stim_targets: tp.Dict[str, tp.Dict]=None,
+                                  maintain_morphology: bool=False,
+                                  synapse_table: tp.List[tp.Dict]=None) -> netpyne.specs.netParams.NetParams:
+    ''' Generate a netpyne NetParams object from neurons and synapses, using a few populations
+    and explicit connection lists instead of a population and a connectivity rule per neuron.
+    
+    .. note::
+    
+        generate_netparams() adds one connParams rule per synapse that matches its pre and post
+        cells by population, and netpyne evaluates every rule against every cell when the network
+        is created. Here neurons that share a cell definition are put in the same population,
+        and connections between two populations that share a mechanism become a single rule with
+        a 'connList' of cell indices built from NumPy index arrays, so network creation scales
+        with the number of synapses. Parallel synapses between the same pair of neurons are
+        merged into a single connection with the weight of the first; merge them with
+        network_ir.aggregate_synapses() beforehand to scale it by their number of contacts.
+        
+        With maintain_morphology, only neurons with identical morphologies share a population.
+        
+        Since neurons no longer have a population of their own, the returned object carries a
+        neuron_index lookup table mapping every neuron's uname (and its sanitized name) to a
+        [population, index] pair, which is also the format expected by generate_simconfig(),
+        and a neuron_names table listing the unames of every population in index order.
+    
+    Parameters are the same as generate_netparams().
+    '''
+    
+    if (synapse_table == None):
+        synapse_table = fetch_synapse_table(client, G)
+    
+    network = build_network(G=G,
+                            synapse_table=synapse_table,
+                            custom_cells=custom_cells,
+                            custom_mechs=custom_mechs,
+                            stims=_stim_specs(stim_targets))
+    
+    return netparams_from_network(network=network,
+                                  custom_mechs=custom_mechs,
+                                  custom_cells=custom_cells,
+                                  default_mech=default_mech,
+                                  default_cell=default_cell,
+                                  stim_sources=stim_sources,
+                                  maintain_morphology=maintain_morphology,
+                                  G=G,
+                                  vectorized=True)
+
+def netparams_from_network(network: NetworkIR,
+                           custom_mechs: tp.Dict[str, tp.Dict]=None,
+                           custom_cells: tp.Dict[str, tp.Dict]=None,
+                           default_mech: tp.Dict=None,
+                           default_cell: tp.Dict=None,
+                           stim_sources: tp.Dict[str, tp.Dict]=None,
+                           maintain_morphology: bool=False,
+                           G: nx.graph=None,
+                           vectorized: bool=False,
+                           morphology_cache: MorphologyCache=None,
+                           morphology_reduction: tp.Dict=None) -> netpyne.specs.netParams.NetParams:
+    ''' Emit a netpyne NetParams object from a NetworkIR
+    
+    .. note::
+    
+        Cell and synaptic mechanism definitions are emitted once per distinct definition, and
+        shared by every population or connection using them. The returned object carries a
+        template_report with the numbers of 'cell_rules' and 'syn_mechs' emitted, and how many
+        of each were saved ('cell_rules_saved' and 'syn_mechs_saved') compared to emitting one
+        per neuron and one per custom mechanism.
+    
+    :param network: network to emit
+    :param custom_mechs: dictionary of all custom synaptic mechanisms to be used in the simulation,
+                         keyed by the mechanism labels of the network
+    :param custom_cells: dictionary of cell names and custom cell definitions to assign to them,
+                         keyed by the cell model labels of the network
+    :param default_mech: default synaptic mechanism to be used for unassigned synaptic connections.
+    :param default_cell: default cell model to be used for unassigned cells.
+    :param stim_sources: dictionary of stimulation source names, and their accompanying parameters.
+    :param maintain_morphology: whether or not model morphology should be maintained in the
+                                simulation
+    :param G: neuron graph the network was built from, only needed for maintain_morphology
+    :param vectorized: whether to emit shared populations and connection lists
+                       (see generate_netparams_vectorized()) rather than a population and a
+                       connectivity rule per neuron (see generate_netparams())
+    :param morphology_cache: MorphologyCache to reuse imported morphologies from
+    :param morphology_reduction: keyword arguments of morphology.reduce_morphology() to coarsen
+                                 morphologies with before importing them
     '''
     
     # Make all custom None dicts empty to prevent code from breaking
     if custom_mechs == None: custom_mechs = {}
     if custom_cells == None: custom_cells = {}
     
-    # Set up our network parameters object
+    # Set up our network parameters object, with stimulation sources and synaptic mechanisms
+    networkParams = _base_netparams(custom_mechs=custom_mechs,
+                                    default_mech=default_mech,
+                                    stim_sources=stim_sources)
+    
+    if (vectorized):
+        _emit_conn_lists(networkParams, network, custom_mechs, custom_cells, default_cell,
+                         maintain_morphology, G, morphology_cache, morphology_reduction)
+    else:
+        _emit_rules(networkParams, network, custom_mechs, custom_cells, default_cell,
+                    maintain_morphology, G, morphology_cache, morphology_reduction)
+    _template_report(networkParams, network)
+    
+    return networkParams
+
+def extend_netparams(networkParams: netpyne.specs.netParams.NetParams,
+                     network: NetworkIR,
+                     changes: tp.Dict,
+                     custom_mechs: tp.Dict[str, tp.Dict]=None,
+                     custom_cells: tp.Dict[str, tp.Dict]=None,
+                     default_cell: tp.Dict=None,
+                     maintain_morphology: bool=False,
+                     G: nx.graph=None,
+                     vectorized: bool=False,
+                     morphology_cache: MorphologyCache=None,
+                     morphology_reduction: tp.Dict=None) -> netpyne.specs.netParams.NetParams:
+    ''' Add the neurons, synapses and stimulation targets a NetworkIR grew by to the NetParams
+    emitted from it
+    
+    .. note::
+        
+        Only the added part of the network is emitted, so this takes time proportional to it
+        rather than to the whole network. Everything else has to match the arguments
+        networkParams was emitted with (see netparams_from_network()).
+    
+    :param networkParams: netpyne networkParams object to extend, emitted from the network
+                          before it grew
+    :param network: grown network
+    :param changes: what the network grew by, see incremental.grow_network()
+    '''
+    
+    if custom_mechs == None: custom_mechs = {}
+    if custom_cells == None: custom_cells = {}
+    
+    if (vectorized):
+        _emit_conn_lists(networkParams, network, custom_mechs, custom_cells, default_cell,
+                         maintain_morphology, G, morphology_cache, morphology_reduction, changes)
+    else:
+        _emit_rules(networkParams, network, custom_mechs, custom_cells, default_cell,
+                    maintain_morphology, G, morphology_cache, morphology_reduction, changes)
+    _template_report(networkParams, network)
+    
+    return networkParams
+
+# Currently only gives certain network analysis outputs, but more can be added
+def generate_simconfig(duration: float,
+                       dt: float,
+                       filename: str,
+                       cells: tp.List[str]=None,
+                       recordStep: float=1,
+                       verbose: bool=False,
+                       headless: bool=False) -> netpyne.specs.simConfig.SimConfig:
+    ''' Generate a netpyne SimConfig object from provided specifications
+    
+    :param duration: duration of the simulation, in ms
+    :param dt: internal integration timestep to use
+    :param filename: file output name
+    :param cells: list of cell names, or [population, index] pairs, to record traces from
+    :param recordstep: step size in ms to save data (e.g. V traces, LFP, etc)
+    :param verbose: show detailed messages
+    :param headless: leave out the raster, trace, 2D network and connectivity plots, which take
+                     up a noticeable share of the run time of batch runs. Traces of cells are
+                     still recorded, see simulate(headless=True).
+    '''
+    
+    from netpyne.specs import SimConfig
+    
+    simConfig = SimConfig()
+    
+    simConfig.duration = duration          
+    simConfig.dt = dt        
+    simConfig.verbose = verbose
+    simConfig.recordTraces = {'L2-C':{'sec':'soma','loc':0.5,'var':'v'}}  
+    simConfig.recordStep = recordStep
+    simConfig.filename = filename
+    simConfig.savePickle = False
+    
+    traces = []
+    
+    for cell in (cells if cells != None else []):
+        if isinstance(cell, str):
+            traces.append((cell,0))
+        else:
+            traces.append(tuple(cell))
+    
+    # Plotting traces records them too, without plots they have to be asked for explicitly
+    simConfig.recordCells = traces
+    
+    if (headless):
+        return simConfig
+
+    simConfig.analysis['plotRaster'] = {'orderBy': 'y', 'orderInverse': True, 'saveFig': True}
+    simConfig.analysis['plotTraces'] = {'include': traces, 'saveFig': True}
+    simConfig.analysis['plot2Dnet'] = {'saveFig': True}
+    simConfig.analysis['plotConn'] = {'saveFig': True}
+    
+    return simConfig
+
+def configure_integration(simConfig: netpyne.specs.simConfig.SimConfig,
+                          integration: tp.Dict):
+    ''' Set the integration strategy of a netpyne simulation
+    
+    .. note::
+        
+        The strategy is a dictionary of any of:
+            - 'dt': the fixed timestep, in ms. With CVODE, NEURON only uses it as the first
+              step, and recordStep still sets when traces are sampled.
+            - 'cvode': whether to integrate with NEURON's variable step CVODE solver, whose
+              step grows while cells are quiet and shrinks around spikes
+            - 'atol': the absolute error tolerance of CVODE (netpyne defaults to 1e-3)
+            - 'local_dt': whether to give every cell a step of its own (NEURON's local variable
+              time step), which pays off in networks where few cells are active at once.
+              Implies 'cvode'. Spikes are recorded as usual, but netpyne sets up traces of
+              local step simulations before the time vector they are sampled at, so they come
+              back empty.
+        
+        Settings the strategy leaves out are left as they are. The strategy applies to
+        simulations created after it is set, since netpyne sets up recording for local steps
+        when it creates the network.
+    
+    :param simConfig: netpyne SimConfig object to update, as generated by generate_simconfig()
+    :param integration: integration strategy
+    '''
+    
+    if ('dt' in integration):
+        simConfig.dt = integration['dt']
+    if ('cvode' in integration):
+        simConfig.cvode_active = bool(integration['cvode'])
+    if ('atol' in integration):
+        simConfig.cvode_atol = integration['atol']
+    if ('local_dt' in integration):
+        simConfig.use_local_dt = bool(integration['local_dt'])
+        if (simConfig.use_local_dt):
+            simConfig.cvode_active = True
+
+def configure_recording(simConfig: netpyne.specs.simConfig.SimConfig,
+                        networkParams: netpyne.specs.netParams.NetParams,
+                        recording: Recording):
+    ''' Set up a SimConfig to record the cells and variables of a Recording
+    
+    .. note::
+    
+        NetPyNE records every trace of every recorded cell at the same recordStep, so traces are
+        recorded every smallest stride of the recording's specifications, and specifications
+        with larger strides are decimated as they are flushed (to a multiple of the smallest
+        stride). Variables are recorded at the middle of the soma.
+        
+        The recording replaces the traces recorded by generate_simconfig(): traces of cells
+        recorded for plotting would otherwise keep growing for the whole simulation.
+    
+    :param simConfig: netpyne SimConfig object to update, as generated by generate_simconfig()
+    :param networkParams: netpyne networkParams object to record from, as generated by
+                          model_gen()
+    :param recording: Recording to set up
+    '''
+    
+    names = [name for pop_names in networkParams.neuron_names.values() for name in pop_names]
+    rows = recording.resolve(names)
+    recorded = np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+    
+    simConfig.recordCells = list(simConfig.recordCells) + [tuple(networkParams.neuron_index[names[i]])
+                                                           for i in recorded]
+    simConfig.recordTraces = {'recording_' + var: {'sec': 'soma', 'loc': 0.5, 'var': var}
+                              for spec in recording.traces for var in spec['variables']}
+    if (len(recording.traces) > 0):
+        simConfig.recordStep = min(spec['stride'] for spec in recording.traces) * simConfig.dt
+
+def _attach_recording(networkParams: netpyne.specs.netParams.NetParams,
+                      recording: Recording):
+    ''' Connect a Recording to the netpyne simulation that was just created
+    
+    Every flush converts the NEURON vectors holding the traces, sample times and spikes
+    recorded since the previous one to arrays, then empties them.
+    '''
+    
+    from netpyne import sim
+    
+    # Map the gids of simulated cells back to neurons
+    names = []
+    neuron_gid = []
+    gid_to_neuron = {}
+    for pop, cell_names in networkParams.neuron_names.items():
+        for gid, name in zip(sim.net.pops[pop].cellGids, cell_names):
+            gid_to_neuron[gid] = len(names)
+            neuron_gid.append(gid)
+            names.append(name)
+    
+    rows = recording.resolve(names)
+    steps = [max(1, int(round(spec['stride'] * sim.cfg.dt / sim.cfg.recordStep))) for spec in recording.traces]
+    flushed = [0]
+    
+    def collect():
+        data = sim.simData
+        t = data['t'].as_numpy().copy() if 't' in data else np.zeros(0)
+        
+        # Samples kept by every specification, counted from the start of the simulation
+        traces = []
+        for spec, r, step in zip(recording.traces, rows, steps):
+            keep = (flushed[0] + np.arange(len(t))) % step == 0
+            values = {}
+            for var in spec['variables']:
+                vectors = data['recording_' + var]
+                values[var] = np.array([vectors['cell_' + str(neuron_gid[i])].as_numpy()[keep]
+                                        for i in r]).reshape(len(r), -1)
+            traces.append((t[keep], values))
+        flushed[0] += len(t)
+        
+        spike_neurons = np.array([gid_to_neuron.get(int(gid), -1) for gid in data['spkid']], dtype=np.int64)
+        spike_times = data['spkt'].as_numpy().copy()
+        
+        for key in ['t', 'spkt', 'spkid']:
+            data[key].resize(0)
+        for var in {var for spec in recording.traces for var in spec['variables']}:
+            for vector in data['recording_' + var].values():
+                vector.resize(0)
+        
+        return traces, spike_times[spike_neurons >= 0], spike_neurons[spike_neurons >= 0]
+    
+    recording.attach(names, rows, sim.cfg.dt, collect,
+                     strides=[int(round(step * sim.cfg.recordStep / sim.cfg.dt)) for step in steps])
+
+def _import_morphology(networkParams: netpyne.specs.netParams.NetParams,
+                       G: nx.graph,
+                       rid: str,
+                       cellname: str,
+                       cache: MorphologyCache=None,
+                       arrays: np.ndarray=None) -> tp.Dict:
+    ''' Import the morphology of a neuron into a netpyne cell rule
+    
+    :param networkParams: netpyne networkParams object to add the cell rule to
+    :param G: neuron graph
+    :param rid: rid of the neuron's MorphologyData node
+    :param cellname: name of the cell rule and cell type to create
+    :param cache: MorphologyCache to reuse previously imported cell rules from
+    :param arrays: SWC array to import instead of the one stored in the graph, e.g. a reduced one
+    '''
+    
+    if arrays is None: arrays = swc_arrays(G.nodes[rid])
+    
+    return import_morphology(networkParams,
+                             arrays,
+                             label=cellname,
+                             cache=cache,
+                             header='SWC File for neuron ' + G.nodes[rid]['uname'])
+
+def _morphology_arrays(networkParams: netpyne.specs.netParams.NetParams,
+                       G: nx.graph,
+                       rid: str,
+                       cellname: str,
+                       reduction: tp.Dict=None) -> np.ndarray:
+    ''' SWC array of a neuron, coarsened first if reduction parameters are given
+    
+    The compartment counts before and after reduction are added to the morphology_report of
+    networkParams, under cellname.
+    '''
+    
+    arrays = swc_arrays(G.nodes[rid])
+    if (reduction == None):
+        return arrays
+    
+    arrays, report = reduce_morphology(arrays, **reduction)
+    if not hasattr(networkParams, 'morphology_report'):
+        networkParams.morphology_report = {}
+    networkParams.morphology_report[cellname] = report
+    
+    return arrays
+
+def _base_netparams(custom_mechs: tp.Dict[str, tp.Dict]=None,
+                    default_mech: tp.Dict=None,
+                    stim_sources: tp.Dict[str, tp.Dict]=None) -> netpyne.specs.netParams.NetParams:
+    ''' Create a netpyne NetParams object holding only stimulation sources and synaptic mechanisms
+    
+    :param custom_mechs: dictionary of all custom synaptic mechanisms to be used in the simulation.
+    :param default_mech: default synaptic mechanism to be used for unassigned synaptic connections.
+    :param stim_sources: dictionary of stimulation source names, and their accompanying parameters.
+    '''
+    
+    from netpyne.specs import netParams
+    
     networkParams = netParams.NetParams()
     
     # Define stimulation sources
@@ -212,188 +836,290 @@ def generate_netparams(client: fbl.Client,
     else:
         networkParams.addSynMechParams('default', default_mech)
         
-    # Custom-defined mechanisms
+    # Custom-defined mechanisms. Every distinct definition is emitted once, under the name of the
+    # first mechanism defining it, and mech_templates maps every mechanism to the entry to use
+    networkParams.mech_templates = {name: name for name in networkParams.synMechParams.keys()}
     if (custom_mechs != None):
+        templates = {_definition_key(mech): name for name, mech in networkParams.synMechParams.items()}
         for name, mech in custom_mechs.items():
-            networkParams.addSynMechParams(name, mech)
-        
-    #networkParams.addStimSourceParams('bkg', {'type': 'NetStim', 'rate': 10, 'noise': 0})
-    
-    rid_to_uname_morph = {rid: v['uname'] for rid, v in G.nodes(data=True)
-                          if 'uname' in v and v.get('class', None) == 'MorphologyData'}
-    rid_to_uname_neuron = {rid: v['uname'] for rid, v in G.nodes(data=True)
-                           if 'uname' in v and v.get('class', None) != 'MorphologyData'}
-    uname_to_rid = {v['uname']: rid for rid, v in G.nodes(data=True)
-                    if 'uname' in v and v.get('class', None) != 'MorphologyData'}
-    
-    # Turn neurons into netpyne cells, turn synapses into netpyne connections
-    for rid in rid_to_uname_morph.keys():
-        # NEURONS
+            key = _definition_key(mech)
+            if key not in templates:
+                templates[key] = name
+                networkParams.addSynMechParams(name, mech)
+            networkParams.mech_templates[name] = templates[key]
+            
+    return networkParams
+
+def _pyramidal_cell() -> tp.Dict:
+    ''' Default pyramidal cell, used when no default cell is provided '''
+    
+    PYRcell = {'secs': {}}
+    PYRcell['secs']['soma'] = {'geom': {}, 'mechs': {}}
+    PYRcell['secs']['soma']['geom'] = {'diam': 18.8, 'L': 18.8, 'Ra': 123.0}                           # soma geometry
+    PYRcell['secs']['soma']['mechs']['hh'] = {'gnabar': 0.12, 'gkbar': 0.036, 'gl': 0.003, 'el': -70}  # soma hh mechanism
+    
+    return PYRcell
+
+def _definition_key(definition: tp.Dict) -> str:
+    ''' Hashable key for a netpyne component definition dict, equal for equal definitions '''
+    
+    return json.dumps(definition, sort_keys=True, default=repr)
+
+def _emit_rules(networkParams: netpyne.specs.netParams.NetParams,
+                network: NetworkIR,
+                custom_mechs: tp.Dict[str, tp.Dict],
+                custom_cells: tp.Dict[str, tp.Dict],
+                default_cell: tp.Dict,
+                maintain_morphology: bool,
+                G: nx.graph,
+                morphology_cache: MorphologyCache,
+                morphology_reduction: tp.Dict=None,
+                changes: tp.Dict=None):
+    ''' Emit a population of 1 per neuron, and a connectivity rule per synapse
+    
+    Populations share a cell rule per distinct cell definition (or morphology), named after the
+    first neuron using it. Surrogate neurons are VecStim populations replaying their spike train
+    instead. With changes (see incremental.grow_network()), only what was added to the network
+    since networkParams was emitted from it is emitted.
+    '''
+    
+    first = changes['first_neuron'] if changes != None else 0
+    first_stim = changes['first_stim'] if changes != None else 0
+    if (first == 0):
+        networkParams.cell_templates = {}
+    templates = networkParams.cell_templates
+    
+    # Turn neurons into netpyne cells
+    for i in range(first, network.n_neurons):
+        cellname = str(network.names[i])
+        label = network.cell_models[network.cell_model[i]]
         
-        # neuroml2 doesn't like dashes or slashes
-        cellname = rid_to_uname_morph[rid]
-        cellname_raw = cellname
-        cellname = cellname.replace('-','_')
-        cellname = cellname.replace('/','')
+        if (label == SURROGATE):
+            networkParams.popParams[cellname] = {'cellModel': 'VecStim', 'numCells': 1,
+                                                 'spkTimes': [network.spike_train(i).tolist()]}
+            continue
         
         # Useful for visualization, but shouldn't affect functionality significantly
         if(maintain_morphology):
-            f = tempfile.NamedTemporaryFile(suffix='.swc')
-            f.write('# SWC File for neuron ' + rid_to_uname_morph[rid] + '\n')
-            f.write('#\n')
-            
-            # Turn morphology into a temporary .swc file. We need to to this because netpyne only
-            # takes files as imputs for imported morphology
-            for i in range(len(G[rid]['x'])):
-                # Turns all unidentified components into somas
-                # THIS IS BAD. WE ONLY DO THIS BECAUSE FBL DATA IS INCOMPLETE
-                # WILL ALMOST CERTAINLY LEAD TO BAD SIMULATIONS
-                if (G[rid]['identifier'][i] == 0):
-                    G[rid]['identifier'][i] = 1
-                    
-                f.write(str(G[rid]['sample'][i]) + ' ' +
-                    str(G[rid]['identifier'][i]) + ' ' +
-                    str(G[rid]['x'][i]) + ' ' +
-                    str(G[rid]['y'][i]) + ' ' +
-                    str(G[rid]['z'][i]) + ' ' +
-                    str(G[rid]['r'][i]) + ' ' +
-                    str(G[rid]['parent'][i]) + '\n')
+            arrays = _morphology_arrays(networkParams, G, str(network.rids[i]), cellname, morphology_reduction)
+            key = morphology_key(arrays)
+            if key not in templates:
+                _import_morphology(networkParams, G, str(network.rids[i]), cellname, morphology_cache, arrays)
+        
+        else:
+            # Set to default pyramidal cell if no default is provided
+            if (default_cell == None):
+                definition = _pyramidal_cell()
             
-            cellRule = networkParams.importCellParams(label=cellname,
-                                                      conds={'cellType': cellname, 'cellModel': 'HH3D'},
-                                                      fileName=f.name,
-                                                      cellName=cellname)
+            # Is the cell part of custom_cells?
+            elif (label in custom_cells.keys()):
+                definition = custom_cells[label]
             
-            # close our tempfile
-            f.close()
-    
-            # rename imported section 'soma_0' to 'soma'
-            networkParams.renameCellParamsSec(cellname + '_rule', 'soma_0', 'soma')
+            else:
+                definition = default_cell
             
-            # Define Cell Rules
-            for secName in cellRule['secs']:
-                cellRule['secs'][secName]['mechs']['pas'] = {'g': 0.0000357, 'e': -70}
-                cellRule['secs'][secName]['geom']['cm'] = 1
-                if secName.startswith('soma'):
-                    cellRule['secs'][secName]['mechs']['hh'] = {'gnabar': 0.12, 'gkbar': 0.036, 'gl': 0.003, 'el': -70}
+            key = _definition_key(definition)
+            if key not in templates:
+                networkParams.cellParams[cellname] = definition
+        
+        if key not in templates:
+            templates[key] = cellname
             
-        # Set to default pyramidal cell if no default is provided
-        elif (default_cell == None):
-            PYRcell = {'secs': {}}
-            PYRcell['secs']['soma'] = {'geom': {}, 'mechs': {}}
-            PYRcell['secs']['soma']['geom'] = {'diam': 18.8, 'L': 18.8, 'Ra': 123.0}                           # soma geometry
-            PYRcell['secs']['soma']['mechs']['hh'] = {'gnabar': 0.12, 'gkbar': 0.036, 'gl': 0.003, 'el': -70}  # soma hh mechanism
-            networkParams.cellParams[cellname] = PYRcell
+        # Create a cell population of 1
+        networkParams.popParams[cellname] = {'cellType': templates[key], 'numCells': 1}
+    
+    # STIMULATION TARGETS
+    for stim in network.stims[first_stim:]:
+        target = str(network.names[stim['target']])
+        networkParams.addStimTargetParams(target + "_stim",
+                                          {'source': stim['source'],
+                                           'conds': {'pop': target},
+                                           'weight': stim['weight'],
+                                           'delay': stim['delay'],
+                                           'synMech': networkParams.mech_templates.get(stim['mech'], stim['mech'])})
+    
+    # Turn synapses into netpyne connections. Synapses between neurons that were already emitted
+    # were emitted along with them
+    pre = network.synapse_pre()
+    for n in np.flatnonzero((pre >= first) | (network.syn_post >= first)):
+        post = network.syn_post[n]
+        networkParams.addConnParams(str(network.unames[pre[n]]) + '--' + str(network.unames[post]),
+                                    {'preConds': {'pop': str(network.names[pre[n]])},
+                                     'postConds': {'pop': str(network.names[post])},
+                                      #'probability': 1,
+                                     'weight': 0.1 * float(network.syn_weight[n]),
+                                     'delay': 5,
+                                     'synMech': _mech_label(networkParams, network.mechs[network.syn_mech[n]])})
+    
+    # Cells have a population of their own, so they are always the first cell of it
+    if (first == 0):
+        networkParams.neuron_index = {}
+        networkParams.neuron_names = {}
+    for uname, cellname in zip(network.unames[first:].tolist(), network.names[first:].tolist()):
+        networkParams.neuron_index[uname] = networkParams.neuron_index[cellname] = [cellname, 0]
+        networkParams.neuron_names[cellname] = [uname]
 
-        # Is the cell part of custom_cells?
-        elif (cellname_raw in custom_cells.keys()):
-            networkParams.cellParams[cellname] = custom_cells[cellname_raw]
+def _emit_conn_lists(networkParams: netpyne.specs.netParams.NetParams,
+                     network: NetworkIR,
+                     custom_mechs: tp.Dict[str, tp.Dict],
+                     custom_cells: tp.Dict[str, tp.Dict],
+                     default_cell: tp.Dict,
+                     maintain_morphology: bool,
+                     G: nx.graph,
+                     morphology_cache: MorphologyCache,
+                     morphology_reduction: tp.Dict=None,
+                     changes: tp.Dict=None):
+    ''' Emit a population per cell definition, and a connection list per pair of populations
+    
+    Surrogate neurons share a VecStim population replaying their spike trains. With changes
+    (see incremental.grow_network()), only what was added to the network since networkParams
+    was emitted from it is emitted. New neurons are appended to the populations of their cell
+    definition, so neurons that were already emitted keep their index.
+    '''
+    
+    if default_cell == None: default_cell = _pyramidal_cell()
+    
+    first = changes['first_neuron'] if changes != None else 0
+    first_stim = changes['first_stim'] if changes != None else 0
+    if (first == 0):
+        networkParams.pop_keys = {}
+        networkParams.neuron_index = {}
+        networkParams.neuron_names = {}
+    
+    # Sort neurons by cell definition, equal definitions end up in the same population
+    pop_keys = networkParams.pop_keys
+    pop_names = list(networkParams.neuron_names.keys())
+    pop_sizes = [len(names) for names in networkParams.neuron_names.values()]
+    neuron_pop = np.full(network.n_neurons, -1, dtype=np.int64)
+    neuron_idx = np.full(network.n_neurons, -1, dtype=np.int64)
+    for i in range(first, network.n_neurons):
+        label = network.cell_models[network.cell_model[i]]
         
+        if (label == SURROGATE):
+            key = SURROGATE
+        elif (maintain_morphology):
+            arrays = _morphology_arrays(networkParams, G, str(network.rids[i]),
+                                        str(network.names[i]), morphology_reduction)
+            key = morphology_key(arrays)
+        elif (label in custom_cells.keys()):
+            key = _definition_key(custom_cells[label])
         else:
-            networkParams.cellParams[cellname] = default_cell
+            key = _definition_key(default_cell)
         
+        if key not in pop_keys:
+            pop_keys[key] = len(pop_names)
+            pop_names.append('cells_' + str(len(pop_names)))
+            pop_sizes.append(0)
+            networkParams.neuron_names[pop_names[-1]] = []
             
-        # Create a cell population of 1
-        networkParams.popParams[cellname] = {'cellType': cellname, 'numCells': 1}
-        
-        # SYNAPSES
+            # Surrogate populations are spike generators without a cell rule, emitted below.
+            # Morphology is useful for visualization, but shouldn't affect functionality significantly
+            if (key == SURROGATE):
+                pass
+            elif (maintain_morphology):
+                _import_morphology(networkParams, G, str(network.rids[i]), pop_names[-1], morphology_cache, arrays)
+            elif (label in custom_cells.keys()):
+                networkParams.cellParams[pop_names[-1]] = custom_cells[label]
+            else:
+                networkParams.cellParams[pop_names[-1]] = default_cell
         
-        # Grab neuron info from the client because synaptic partners aren't easily accessible
-        # from the graph for some reason
-        info = client.getInfo(rid)
+        neuron_pop[i] = pop_keys[key]
+        neuron_idx[i] = pop_sizes[neuron_pop[i]]
+        pop_sizes[neuron_pop[i]] += 1
         
-        connectivity = info['data']['connectivity']['pre']['details']
-        
-        # Loop through connections
-        for con in connectivity:
-            syn = con['syn_rid']
-            pre, post = con['syn_uname'].split('--')
-            
-            # Only grab synapses to neurons that we actually care about
-            if(pre in uname_to_rid.keys()):
-                
-                # neuroml2 doesn't like dashes or slashes
-                con_uname_raw = con['syn_uname']
-                con_uname = con['syn_uname'].replace('-','_')
-                con_uname = con_uname.replace('/','')
-                pre = pre.replace('-','_')
-                pre = pre.replace('/','')
-                post = post.replace('-','_')
-                post = post.replace('/','')
-                
-                # Check to see if this is predefined synapse mechanism
-                if (custom_mechs != None):
-                    if (con_uname_raw in custom_mechs.keys()):
-                        networkParams.addConnParams(con['syn_uname'], {'preConds': {'cellType': pre},
-                                                                       'postConds': {'cellType': post},
-                                                                        #'probability': 1,
-                                                                       'weight': 0.1,
-                                                                       'delay': 5,
-                                                                       'synMech': con_uname_raw})
-                    else:
-                        networkParams.addConnParams(con['syn_uname'], {'preConds': {'cellType': pre},
-                                                                       'postConds': {'cellType': post},
-                                                                        #'probability': 1,
-                                                                       'weight': 0.1,
-                                                                       'delay': 5,
-                                                                       'synMech': 'default'})
-                # Set to default if not
-                else:
-                    networkParams.addConnParams(con['syn_uname'], {'preConds': {'cellType': pre},
-                                                                   'postConds': {'cellType': post},
-                                                                    #'probability': 1,
-                                                                   'weight': 0.1,
-                                                                   'delay': 5,
-                                                                   'synMech': 'default'})
-                
-        # STIMULATION TARGETS
-        if (stim_targets != None):
-            for stim in stim_targets.keys():
-                #networkParams.addStimTargetParams(stim + "_stim", stim_targets[stim])
-                networkParams.addStimTargetParams(stim + "_stim",
-                                                  {'source': stim_targets[stim]['source'],
-                                                   'conds': {'pop': stim},
-                                                   'weight': stim_targets[stim]['weight'],
-                                                   'delay': stim_targets[stim]['delay'],
-                                                   'synMech': stim_targets[stim]['mech']})
-                
-    return networkParams
-
-# Currently only gives certain network analysis outputs, but more can be added
-def generate_simconfig(duration: float,
-                       dt: float,
-                       filename: str,
-                       cells: tp.List[str]=None,
-                       recordStep: float=1,
-                       verbose: bool=False) -> netpyne.specs.simConfig.SimConfig:
-    ''' Generate a netpyne SimConfig object from provided specifications
+        uname = str(network.unames[i])
+        networkParams.neuron_index[uname] = networkParams.neuron_index[str(network.names[i])] = [pop_names[neuron_pop[i]],
+                                                                                                 int(neuron_idx[i])]
+        networkParams.neuron_names[pop_names[neuron_pop[i]]].append(uname)
     
-    :param duration: duration of the simulation, in ms
-    :param dt: internal integration timestep to use
-    :param filename: file output name
-    :param cells: list of cell names to record traces from
-    :param recordstep: step size in ms to save data (e.g. V traces, LFP, etc)
-    :param verbose: show detailed messages
-    '''
+    for name, size in zip(pop_names, pop_sizes):
+        networkParams.popParams[name] = {'cellType': name, 'numCells': size}
+    if SURROGATE in pop_keys:
+        name = pop_names[pop_keys[SURROGATE]]
+        networkParams.popParams[name] = {'cellModel': 'VecStim', 'numCells': len(networkParams.neuron_names[name]),
+                                         'spkTimes': [network.spike_train(network.index(uname)).tolist()
+                                                      for uname in networkParams.neuron_names[name]]}
     
-    simConfig = SimConfig()
+    # Synapses between neurons that were already emitted were emitted along with them
+    pre = network.synapse_pre()
+    post = network.syn_post
+    new = np.flatnonzero((pre >= first) | (post >= first))
+    stims = network.stims[first_stim:]
     
-    simConfig.duration = duration          
-    simConfig.dt = dt        
-    simConfig.verbose = verbose
-    simConfig.recordTraces = {'L2-C':{'sec':'soma','loc':0.5,'var':'v'}}  
-    simConfig.recordStep = recordStep
-    simConfig.filename = filename
-    simConfig.savePickle = False
+    # Neurons that were already emitted are looked up by name
+    pop_ids = {name: p for p, name in enumerate(pop_names)}
+    targets = np.array([stim['target'] for stim in stims], dtype=np.int64)
+    for i in np.unique(np.concatenate([pre[new], post[new], targets])):
+        if (i < first):
+            pop, idx = networkParams.neuron_index[str(network.unames[i])]
+            neuron_pop[i] = pop_ids[pop]
+            neuron_idx[i] = idx
     
-    traces = []
+    # Mechanisms without a custom definition fall back to the default one
+    mech_names = [_mech_label(networkParams, label) for label in network.mechs]
+    mech_ids = np.unique(mech_names, return_inverse=True)[1]
+    mech_names = [mech_names[m] for m in np.unique(mech_ids, return_index=True)[1]]
     
-    for cell in cells:
-        traces.append((cell,0))
+    # Merge parallel synapses, keeping the weight of the first, then emit one connList rule per
+    # (mechanism, pre pop, post pop). Rules that already exist have the connections of new
+    # neurons appended to them
+    conns, first_syn = np.unique(np.stack([mech_ids[network.syn_mech[new]], neuron_pop[pre[new]], neuron_pop[post[new]],
+                                           neuron_idx[pre[new]], neuron_idx[post[new]]], axis=1),
+                                 axis=0, return_index=True)
+    weights = 0.1 * network.syn_weight[new[first_syn]]
+    if (len(conns) > 0):
+        split = np.flatnonzero(np.any(np.diff(conns[:, :3], axis=0) != 0, axis=1)) + 1
+        for rule, weight in zip(np.split(conns, split), np.split(weights, split)):
+            m, pre_pop, post_pop = rule[0, :3]
+            label = mech_names[m] + '--' + pop_names[pre_pop] + '--' + pop_names[post_pop]
+            if label in networkParams.connParams:
+                networkParams.connParams[label]['connList'] += rule[:, 3:].tolist()
+                networkParams.connParams[label]['weight'] += weight.tolist()
+                networkParams.connParams[label]['delay'] += [5] * len(rule)
+                continue
+            
+            networkParams.addConnParams(label,
+                                        {'preConds': {'pop': pop_names[pre_pop]},
+                                         'postConds': {'pop': pop_names[post_pop]},
+                                         'connList': rule[:, 3:].tolist(),
+                                         'weight': weight.tolist(),
+                                         'delay': [5] * len(rule),
+                                         'synMech': mech_names[m]})
+    
+    # STIMULATION TARGETS
+    for stim in stims:
+        i = stim['target']
+        networkParams.addStimTargetParams(str(network.names[i]) + "_stim",
+                                          {'source': stim['source'],
+                                           'conds': {'pop': pop_names[neuron_pop[i]], 'cellList': [int(neuron_idx[i])]},
+                                           'weight': stim['weight'],
+                                           'delay': stim['delay'],
+                                           'synMech': networkParams.mech_templates.get(stim['mech'], stim['mech'])})
 
-    simConfig.analysis['plotRaster'] = {'orderBy': 'y', 'orderInverse': True, 'saveFig': True}
-    simConfig.analysis['plotTraces'] = {'include': traces, 'saveFig': True}
-    simConfig.analysis['plot2Dnet'] = {'saveFig': True}
-    simConfig.analysis['plotConn'] = {'saveFig': True}
+def _mech_label(networkParams: netpyne.specs.netParams.NetParams, label: str) -> str:
+    ''' Name of the synMechParams entry to use for a mechanism label of a NetworkIR '''
+    
+    return networkParams.mech_templates.get(label, DEFAULT)
+
+def _template_report(networkParams: netpyne.specs.netParams.NetParams, network: NetworkIR):
+    ''' Count the cell rules and synaptic mechanisms emitted, and how many were shared instead
+    of emitted once per neuron or mechanism, as networkParams.template_report. Surrogate
+    neurons are VecStims without a cell rule, so they don't count as saved ones. '''
+    
+    cells = network.n_neurons - int(np.count_nonzero(network.surrogates()))
+    networkParams.template_report = {'cell_rules': len(networkParams.cellParams),
+                                     'cell_rules_saved': cells - len(networkParams.cellParams),
+                                     'syn_mechs': len(networkParams.synMechParams),
+                                     'syn_mechs_saved': len(networkParams.mech_templates) - len(networkParams.synMechParams)}
+
+def _stim_specs(stim_targets: tp.Dict[str, tp.Dict]) -> tp.List[tp.Dict]:
+    ''' Turn netpyne stim_targets into the stimulation specs stored by a NetworkIR '''
+    
+    if (stim_targets == None):
+        return None
     
-    return simConfig
\ No newline at end of file
+    return [{'source': stim['source'],
+             'target': target,
+             'weight': stim['weight'],
+             'delay': stim['delay'],
+             'mech': stim['mech']} for target, stim in stim_targets.items()]
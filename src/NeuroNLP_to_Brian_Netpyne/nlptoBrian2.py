@@ -1,6 +1,8 @@
-import flybrainlab as fbl
-from brian2 import *
-from brian2tools import *
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
 import networkx as nx
 import numpy as np
 import os
@@ -8,6 +10,19 @@ import os.path
 import tempfile
 import typing as tp
 
+from .analysis import SimulationResults
+from .cache import QueryCache
+from .checkpoint import Checkpoint, run_brian2
+from .connectivity import fetch_synapse_table
+from .network_ir import SURROGATE, NetworkIR, aggregate_synapses, build_network
+from .profiling import Profiler
+from .recording import Recording
+
+# brian2, brian2tools and flybrainlab take seconds to import, so they are imported by the
+# functions that use them rather than along with this module
+if tp.TYPE_CHECKING:
+    import flybrainlab as fbl
+
 def model_gen(client: fbl.Client,
               res: fbl.graph.NAqueryResult,
               custom_mechs: tp.Dict[str, tp.Dict]=None,
@@ -20,6 +35,18 @@ def model_gen(client: fbl.Client,
               sim_duration: int=1*1e3,
               dt: int=0.05,
               maintain_morphology: bool=False,
+              max_workers: int=8,
+              cache: QueryCache=None,
+              vectorized: bool=False,
+              network: NetworkIR=None,
+              profiler: Profiler=None,
+              record_spikes: bool=False,
+              recording: Recording=None,
+              execution: str='runtime',
+              threads: int=None,
+              build_dir: str=None,
+              aggregate: tp.Union[str, tp.Callable]=None,
+              integration: tp.Dict=None,
               **kwargs):
     ''' Generates a brian2 model from a neuroNLP graph
     
@@ -33,7 +60,8 @@ def model_gen(client: fbl.Client,
         (https://brian2.readthedocs.io/en/stable/resources/tutorials/index.html)
     
     :param client: pointer to FBL client
-    :param res: FBL NAqueryResult object, representing the system to be converted to netpyne
+    :param res: FBL NAqueryResult object, representing the system to be converted to netpyne.
+                Can be None when a network is passed in, unless morphology is maintained.
     :param filename: name of the file to save sim outputs to
     :param custom_mechs: dictionary of all custom synaptic mechanisms to be used in the simulation.
                          It should be noted that since all custom mechanisms are defined here
@@ -54,49 +82,259 @@ def model_gen(client: fbl.Client,
     :param maintain_morphology: whether or not model morphology should be maintained in the
                                 simulation (not recommended if neuron sections are unidentified
                                 in swc definitions)
+    :param max_workers: maximum number of concurrent client lookups used to fetch connectivity
+    :param cache: QueryCache to reuse previously fetched connectivity from. Get res from the
+                  module function cache.execute_query(client, query, cache) too, to make warm
+                  builds skip the client entirely.
+    :param vectorized: whether to group neurons and synapses that share a definition into single
+                       brian2 objects (see generate_model_vectorized()). Recommended for anything
+                       past a few hundred neurons.
+    :param network: previously built NetworkIR of the query (see network_ir.network_from_query()).
+                    Passing the same network to both backends guarantees they simulate the
+                    same thing, and skips fetching connectivity from the client.
+    :param profiler: Profiler to record the time and memory of the 'fetch', 'build' and 'emit'
+                     phases in, along with neuron, synapse and brian2 object counts
+    :param record_spikes: whether to add a SpikeMonitor to every neuron group, so that
+                          simulate(headless=True) returns spike times too
+    :param recording: Recording to stream spikes and traces to disk with while simulating. Pass
+                      it to simulate() too.
+    :param execution: 'runtime' to simulate from Python, or 'cpp_standalone' to generate,
+                      compile and run a standalone C++ project instead (see model_from_network())
+    :param threads: number of OpenMP threads cpp_standalone simulations run with
+    :param build_dir: directory the cpp_standalone projects are built in, one subdirectory per
+                      network structure. Defaults to the system's temporary directory.
+    :param aggregate: weight mapping to merge parallel synapses with before emitting the model
+                      (see network_ir.aggregate_synapses()), e.g. 'linear'. The returned
+                      network then carries the aggregation_report. Mechanisms should scale
+                      their effect by w, see model_from_network().
+    :param integration: integration strategy to simulate with, e.g.
+                        {'dt': 0.1, 'method': 'exponential_euler'} (see configure_integration()).
+                        Its 'dt' is set as defaultclock.dt, which the dt argument isn't.
+                        integration.calibrate() picks one for a network.
     '''
     
-    # Define helper variables for easy access later
-    G = res.graph
-    neurons = res.neurons
-    synapses = res.synapses
+    # Define helper variables for easy access later. Prebuilt networks don't need a query result
+    G = None
+    if (res != None):
+        G = res.graph
+        neurons = res.neurons
+        synapses = res.synapses
+    
+    if profiler == None: profiler = Profiler(enabled=False)
+    
+    # Build the simulator-neutral network, unless we were handed one
+    if (network == None):
+        with profiler.phase('fetch'):
+            synapse_table = fetch_synapse_table(client, G, cache=cache, max_workers=max_workers)
+        
+        with profiler.phase('build'):
+            network = build_network(G=G,
+                                    synapse_table=synapse_table,
+                                    custom_cells=custom_cells,
+                                    custom_mechs=custom_mechs,
+                                    stims=_stim_specs(stim_targets),
+                                    record_names=record_names)
+    
+    report = None
+    if (aggregate != None):
+        with profiler.phase('aggregate'):
+            network, report = aggregate_synapses(network, aggregate)
+        profiler.count('synapses_removed', report['removed'])
     
     # Generate network parameters and simulation configuration settings
-    networkParams = generate_model(client=client,
-                                   neurons=neurons,
-                                   synapses=synapses,
-                                   G=G,
-                                   custom_mechs=custom_mechs,
-                                   custom_cells=custom_cells,
-                                   default_mech=default_mech,
-                                   default_cell=default_cell,
-                                   stim_sources=stim_sources,
-                                   stim_targets=stim_targets,
-                                   record_names=record_names,
-                                   maintain_morphology=maintain_morphology,
-                                   **kwargs)
+    with profiler.phase('emit'):
+        networkParams = model_from_network(network=network,
+                                           custom_mechs=custom_mechs,
+                                           custom_cells=custom_cells,
+                                           default_mech=default_mech,
+                                           default_cell=default_cell,
+                                           stim_sources=stim_sources,
+                                           vectorized=vectorized,
+                                           record_spikes=record_spikes,
+                                           recording=recording,
+                                           execution=execution,
+                                           threads=threads,
+                                           build_dir=build_dir,
+                                           integration=integration,
+                                           **kwargs)
+        if (report != None):
+            networkParams.aggregation_report = report
+    
+    profiler.count('neurons', network.n_neurons)
+    profiler.count('synapses', network.n_synapses)
+    profiler.count('objects', len(networkParams.objects))
     
     return networkParams
 
 def simulate(networkParams,
              t: float,
-             internal_vars: tp.Dict):
+             internal_vars: tp.Dict,
+             profiler: Profiler=None,
+             headless: bool=False,
+             recording: Recording=None,
+             run_args: tp.Dict[str, tp.Any]=None,
+             checkpoint: Checkpoint=None) -> tp.Optional[SimulationResults]:
     ''' Create and run brian2 simulation
     
+    .. note::
+    
+        With a profiler, code generation and compilation is timed on its own by running the
+        network for zero time first. Compiled code is cached, so the actual run that follows
+        mostly reuses it, but it still regenerates code, which can add noticeably to the run
+        phase of networks with many objects.
+        
+        Networks generated with execution='cpp_standalone' are built the first time they are
+        simulated, and every later call only reruns the compiled binary with new run_args.
+        Duration and internal_vars are compiled into the project, so they can't change between
+        calls on the same network; generating the network again with different values reuses
+        its project directory and only recompiles the files that changed.
+    
     :param networkParams: brian2 network to simulate
     :param t: duration of simulation, in ms
     :param internal_vars: predefined network variables to insert into simulation
+    :param profiler: Profiler to record the time and memory of the 'compile', 'run' and
+                     'analysis' phases in, along with the number of code objects
+    :param headless: skip plotting the recorded traces, and return the spikes and traces of the
+                     simulation as a SimulationResults instead (see simulation_results())
+    :param recording: Recording the network was generated with. Whatever it holds when the run
+                      ends is flushed, and the recording is closed. Read it back with
+                      recording.read_recording(), its spikes and traces aren't part of the
+                      returned results.
+    :param run_args: values to set before running, keyed by '<object name>.<variable>', e.g.
+                     {'cells_0.v': -65*mV, 'synapses_0.w': 2}. Values can be scalars or arrays
+                     with a value per neuron or synapse.
+    :param checkpoint: Checkpoint to write the state of the simulation to every checkpoint.every
+                       ms, see checkpoint.resume() and checkpoint.fork()
     '''
     
-    # Simulate and run
-    #networkParams.before_run(internal_vars)
-    networkParams.run(t*ms, namespace=internal_vars)
+    from brian2 import ms
+    
+    if profiler == None: profiler = Profiler(enabled=False)
+    
+    standalone = getattr(networkParams, 'standalone', None)
+    if (standalone != None and checkpoint != None):
+        raise ValueError("cpp_standalone simulations can't be checkpointed")
+    if (standalone != None):
+        _simulate_standalone(networkParams, t, internal_vars, profiler, run_args)
+    else:
+        for variable, value in _run_args(networkParams, run_args).items():
+            variable[:] = value
+        
+        # Simulate and run
+        #networkParams.before_run(internal_vars)
+        if profiler.enabled:
+            with profiler.phase('compile'):
+                networkParams.run(0*ms, namespace=internal_vars)
+        
+        with profiler.phase('run'):
+            if (checkpoint == None):
+                networkParams.run(t*ms, namespace=internal_vars)
+            else:
+                checkpoint.begin(networkParams, float(networkParams.t / ms) + t)
+                run_brian2(networkParams, t, internal_vars, checkpoint)
+            if (recording != None):
+                recording.close(float(networkParams.t / ms))
+    
+    if profiler.enabled:
+        profiler.count('code_objects', sum(len(getattr(o, 'code_objects', ())) for o in networkParams.sorted_objects))
     
     # Grab monitoring objects. There is definitely a better way to do this
+    with profiler.phase('analysis'):
+        if (headless):
+            return simulation_results(networkParams)
+        
+        import matplotlib.pyplot as plt
+        from brian2 import StateMonitor
+        from brian2tools import brian_plot
+        
+        for o in networkParams.objects:
+            if (isinstance(o, StateMonitor)):
+                brian_plot(o)
+                plt.show()
+
+def _simulate_standalone(networkParams,
+                         t: float,
+                         internal_vars: tp.Dict,
+                         profiler: Profiler,
+                         run_args: tp.Dict[str, tp.Any]=None):
+    ''' Build a cpp_standalone network on its first simulation, then run the compiled binary '''
+    
+    from brian2 import device, ms
+    
+    standalone = networkParams.standalone
+    with profiler.phase('compile'):
+        if (standalone['duration'] == None):
+            networkParams.run(t*ms, namespace=internal_vars)
+            device.build(directory=standalone['directory'], compile=True, run=False, with_output=False)
+            standalone['duration'] = t
+        elif (standalone['duration'] != t):
+            raise ValueError('the network was compiled for a duration of ' + str(standalone['duration'])
+                             + ' ms, generate it again to simulate it for ' + str(t) + ' ms')
+    
+    with profiler.phase('run'):
+        device.run(directory=standalone['directory'], with_output=False,
+                   run_args=_run_args(networkParams, run_args))
+
+def _run_args(networkParams, run_args: tp.Dict[str, tp.Any]=None) -> tp.Dict:
+    ''' Turn run_args keyed by '<object name>.<variable>' into brian2 variables and values '''
+    
+    if (run_args == None):
+        return {}
+    
+    variables = {}
+    for key, value in run_args.items():
+        name, variable = key.rsplit('.', 1)
+        variables[getattr(networkParams[name], variable)] = value
+    
+    return variables
+
+def simulation_results(networkParams) -> SimulationResults:
+    ''' Collect the spikes and traces recorded by a brian2 network as NumPy arrays
+    
+    .. note::
+    
+        Spikes are only recorded by networks generated with record_spikes.
+    
+    :param networkParams: brian2 network that was simulated, as generated by model_gen()
+    '''
+    
+    from brian2 import SpikeMonitor, StateMonitor, mV, ms
+    
+    # Neurons are numbered group by group, in the order of neuron_names
+    names = []
+    offsets = {}
+    for group, group_names in networkParams.neuron_names.items():
+        offsets[group] = len(names)
+        names.extend(group_names)
+    
+    spike_times = []
+    spike_neurons = []
+    t = None
+    traces = {}
+    trace_neurons = []
+    recording_monitors = getattr(networkParams, 'recording_monitors', set())
     for o in networkParams.objects:
-        if (isinstance(o, monitors.statemonitor.StateMonitor)):
-            brian_plot(o)
-            plt.show()
+        # Skip anything monitoring stimulation sources, or streaming to a Recording
+        if (not hasattr(o, 'source') or o.source.name not in offsets or o.name in recording_monitors):
+            continue
+        
+        offset = offsets[o.source.name]
+        if (isinstance(o, SpikeMonitor)):
+            spike_times.append(np.asarray(o.t / ms))
+            spike_neurons.append(np.asarray(o.i[:], dtype=np.int64) + offset)
+        elif (isinstance(o, StateMonitor)):
+            t = np.asarray(o.t / ms)
+            trace_neurons.append(np.asarray(o.record, dtype=np.int64) + offset)
+            for var in o.record_variables:
+                traces.setdefault(var, []).append(np.asarray(getattr(o, var) / mV if var == 'v' else getattr(o, var)))
+    
+    return SimulationResults(names=names,
+                             spike_times=np.concatenate(spike_times) if spike_times else np.zeros(0),
+                             spike_neurons=np.concatenate(spike_neurons) if spike_neurons else np.zeros(0, dtype=np.int64),
+                             t=t,
+                             traces={var: np.concatenate(trace) for var, trace in traces.items()},
+                             trace_neurons=np.concatenate(trace_neurons) if trace_neurons else None,
+                             duration=float(networkParams.t / ms))
     
 def generate_model(client: fbl.Client,
                    neurons: tp.Dict,
@@ -110,6 +348,7 @@ def generate_model(client: fbl.Client,
                    stim_targets: tp.Dict[str, str]=None,
                    record_names: tp.List[str]=None,
                    maintain_morphology: bool=False,
+                   synapse_table: tp.List[tp.Dict]=None,
                    **kwargs):
     ''' Generate a brian2 network from neurons and synapses.
     
@@ -117,9 +356,8 @@ def generate_model(client: fbl.Client,
     
         A lot of this is really ugly. Because Brian2 works entirely off of magic functions,
         spinning up a network on the fly gets really messy really fast since it wasn't built
-        with doing so in mind. I've done my best to mitigate it, but we still end up with a
-        bunch of floating variables we have to pullfrom locals() and hardcoded values to get
-        everything to fit together.
+        with doing so in mind. I've done my best to mitigate it, but we still end up with
+        hardcoded values to get everything to fit together.
         
         Should Brian2 be chosen as the simulator of choice moving forward, I highly recommend
         getting someone more knowledgeable about wrangling magic functions to clean this up.
@@ -149,106 +387,645 @@ def generate_model(client: fbl.Client,
     :param maintain_morphology: whether or not model morphology should be maintained in the
                                 simulation (not recommended if neuron sections are unidentified
                                 in swc definitions)
+    :param synapse_table: synapse table of the graph (see connectivity.fetch_synapse_table()). It
+                          is fetched from the client if not provided.
     '''
     
-    # Define our network
+    if (synapse_table == None):
+        synapse_table = fetch_synapse_table(client, G)
+    
+    network = build_network(G=G,
+                            synapse_table=synapse_table,
+                            custom_cells=custom_cells,
+                            custom_mechs=custom_mechs,
+                            stims=_stim_specs(stim_targets),
+                            record_names=record_names)
+    
+    return model_from_network(network=network,
+                              custom_mechs=custom_mechs,
+                              custom_cells=custom_cells,
+                              default_mech=default_mech,
+                              default_cell=default_cell,
+                              stim_sources=stim_sources,
+                              **kwargs)
+
+def generate_model_vectorized(client: fbl.Client,
+                              neurons: tp.Dict,
+                              synapses: tp.Dict,
+                              G: nx.graph,
+                              custom_mechs: tp.Dict[str, tp.Dict]=None,
+                              custom_cells: tp.Dict[str, tp.Dict]=None,
+                              default_mech: tp.Dict=None,
+                              default_cell: tp.Dict[str, tp.Dict]=None,
+                              stim_sources: tp.Dict[str, tp.Dict]=None,
+                              stim_targets: tp.Dict[str, str]=None,
+                              record_names: tp.List[str]=None,
+                              maintain_morphology: bool=False,
+                              synapse_table: tp.List[tp.Dict]=None,
+                              **kwargs):
+    ''' Generate a brian2 network from neurons and synapses, grouping neurons and synapses
+    that share a definition into a single brian2 object.
+    
+    .. note::
+    
+        generate_model() creates a NeuronGroup per neuron and a Synapses object per connection,
+        and brian2 generates and compiles code for every one of them. Here all neurons that
+        share a cell definition live in one NeuronGroup, and all connections between two groups
+        that share a mechanism live in one Synapses object connected with index arrays, so the
+        number of code objects depends on the number of distinct definitions rather than on the
+        size of the network.
+        
+        Since neurons no longer have an object of their own, the returned network carries two
+        lookup tables: neuron_index maps every neuron's uname (and its sanitized name) to a
+        (group name, index) pair, and neuron_names maps every group name to the unames of its
+        neurons in index order.
+    
+    Parameters are the same as generate_model().
+    '''
+    
+    if (synapse_table == None):
+        synapse_table = fetch_synapse_table(client, G)
+    
+    network = build_network(G=G,
+                            synapse_table=synapse_table,
+                            custom_cells=custom_cells,
+                            custom_mechs=custom_mechs,
+                            stims=_stim_specs(stim_targets),
+                            record_names=record_names)
+    
+    return model_from_network(network=network,
+                              custom_mechs=custom_mechs,
+                              custom_cells=custom_cells,
+                              default_mech=default_mech,
+                              default_cell=default_cell,
+                              stim_sources=stim_sources,
+                              vectorized=True,
+                              **kwargs)
+
+def model_from_network(network: NetworkIR,
+                       custom_mechs: tp.Dict[str, tp.Dict]=None,
+                       custom_cells: tp.Dict[str, tp.Dict]=None,
+                       default_mech: tp.Dict=None,
+                       default_cell: tp.Dict[str, tp.Dict]=None,
+                       stim_sources: tp.Dict[str, tp.Dict]=None,
+                       vectorized: bool=False,
+                       record_spikes: bool=False,
+                       recording: Recording=None,
+                       execution: str='runtime',
+                       threads: int=None,
+                       build_dir: str=None,
+                       integration: tp.Dict=None,
+                       **kwargs):
+    ''' Emit a brian2 network from a NetworkIR
+    
+    .. note::
+    
+        With execution='cpp_standalone', the network is emitted for brian2's C++ standalone
+        device, running with threads OpenMP threads (one per CPU by default, 0 turns OpenMP off). Its project
+        lives in a subdirectory of build_dir named after a hash of the network's structure and
+        definitions, so generating the same network again, e.g. in a later session, rebuilds
+        the same project: brian2 only rewrites generated files whose contents changed, and
+        make only recompiles those. The hash is stored as networkParams.standalone['key'].
+        
+        Recordings flush from a NetworkOperation, which cpp_standalone doesn't support.
+        
+        Every Synapses object has a w variable holding the syn_weight of its synapses (1 unless
+        they were merged by network_ir.aggregate_synapses()), added to the model of mechanisms
+        that don't declare one. Mechanisms should scale their effect by it, e.g.
+        {'on_pre': 'v += w*10*mV'}. Stimulation synapses have a w of 1.
+    
+    :param network: network to emit
+    :param custom_mechs: dictionary of all custom synaptic mechanisms to be used in the simulation,
+                         keyed by the mechanism labels of the network
+    :param custom_cells: dictionary of cell names and custom cell definitions to assign to them,
+                         keyed by the cell model labels of the network
+    :param default_mech: default synaptic mechanism to be used for unassigned synaptic connections.
+    :param default_cell: default cell model to be used for unassigned cells.
+    :param stim_sources: dictionary of stimulation source names, and their accompanying parameters.
+    :param vectorized: whether to group neurons and synapses that share a definition into single
+                       brian2 objects (see generate_model_vectorized()) rather than creating one
+                       per neuron and per synapse (see generate_model())
+    :param record_spikes: whether to add a SpikeMonitor to every neuron group
+    :param recording: Recording to stream spikes and traces to while simulating, see
+                      _attach_recording()
+    :param execution: 'runtime' or 'cpp_standalone'
+    :param threads: number of OpenMP threads of cpp_standalone simulations
+    :param build_dir: directory to build cpp_standalone projects in
+    :param integration: integration strategy, see configure_integration(). Its dt is set
+                        before anything is emitted, so monitors sampling every few steps follow it.
+    '''
+    
+    from brian2 import Network, NeuronGroup, defaultclock, ms
+    
+    if custom_mechs == None: custom_mechs = {}
+    if custom_cells == None: custom_cells = {}
+    
+    if (execution == 'cpp_standalone' and recording != None):
+        raise ValueError("recordings can't be streamed from cpp_standalone simulations")
+    _select_device(execution, threads)
+    if (integration != None and 'dt' in integration):
+        defaultclock.dt = integration['dt'] * ms
+    
+    # Define our network. definitions holds the definition every NeuronGroup and Synapses
+    # object was created from, by name, so snapshot.save_model() can create them again
     networkParams = Network()
+    networkParams.definitions = {}
     
     # Define stimulation sources
+    sources = {}
     if (stim_sources != None):
         for name, stim in stim_sources.items():
-            locals()[name] = NeuronGroup(1, **stim)
-            networkParams.add(locals()[name])
+            sources[name] = NeuronGroup(1, name=name, **stim)
+            networkParams.add(sources[name])
+            networkParams.definitions[name] = stim
+    
+    if (vectorized):
+        _emit_groups(networkParams, network, sources, custom_mechs, custom_cells, default_mech, default_cell,
+                     record_spikes)
+    else:
+        _emit_neurons(networkParams, network, sources, custom_mechs, custom_cells, default_mech, default_cell,
+                      record_spikes)
+    
+    if (recording != None):
+        _attach_recording(networkParams, recording)
+    if (integration != None):
+        configure_integration(networkParams, integration)
+    
+    if (execution == 'cpp_standalone'):
+        key = hashlib.sha1(json.dumps([network.digest(),
+                                       _definition_key(custom_mechs), _definition_key(custom_cells),
+                                       _definition_key(default_mech or {}), _definition_key(default_cell or {}),
+                                       _definition_key(stim_sources or {}), _definition_key(integration or {}),
+                                       vectorized, record_spikes, threads,
+                                       float(defaultclock.dt / ms)]).encode()).hexdigest()
+        directory = build_dir if build_dir != None else os.path.join(tempfile.gettempdir(), 'brian2_standalone')
+        networkParams.standalone = {'key': key, 'directory': os.path.join(directory, key), 'duration': None}
+    
+    return networkParams
+
+def configure_integration(networkParams, integration: tp.Dict):
+    ''' Set the integration strategy of a brian2 network
+    
+    .. note::
+        
+        The strategy is a dictionary of any of:
+            - 'dt': the timestep, in ms. It is set as defaultclock.dt, which every network of
+              the session shares; monitors created with a dt of their own keep it.
+            - 'method': the state update method of every NeuronGroup and Synapses object
+              with differential equations, e.g. 'exact' (for linear equations, such as most
+              synapse models), 'exponential_euler' (for conductance based neurons, such as
+              Hodgkin-Huxley) or 'euler'. A list of methods picks the first that applies to
+              the equations of every object, e.g. ['exact', 'exponential_euler'].
         
-    #networkParams.addStimSourceParams('bkg', {'type': 'NetStim', 'rate': 10, 'noise': 0})
+        Settings the strategy leaves out are left as they are. Methods are chosen when the
+        network is next run, so an unsupported one raises there. The definitions of the
+        network are updated too, so snapshot.save_model() keeps the method.
     
-    rid_to_uname_morph = {rid: v['uname'] for rid, v in G.nodes(data=True)
-                          if 'uname' in v and v.get('class', None) == 'MorphologyData'}
-    rid_to_uname_neuron = {rid: v['uname'] for rid, v in G.nodes(data=True)
-                           if 'uname' in v and v.get('class', None) != 'MorphologyData'}
-    uname_to_rid = {v['uname']: rid for rid, v in G.nodes(data=True)
-                    if 'uname' in v and v.get('class', None) != 'MorphologyData'}
+    :param networkParams: brian2 network to update, as generated by model_gen()
+    :param integration: integration strategy
+    '''
     
-    # Turn neurons into neuron groups
-    for rid in rid_to_uname_morph.keys():
-        # NEURONS
+    from brian2 import NeuronGroup, Synapses, defaultclock, ms
+    
+    if ('dt' in integration):
+        defaultclock.dt = integration['dt'] * ms
+    if ('method' not in integration):
+        return
+    
+    method = integration['method']
+    if not isinstance(method, str):
+        method = list(method)
+    for obj in networkParams.objects:
+        if not isinstance(obj, (NeuronGroup, Synapses)) or obj.state_updater == None:
+            continue
+        obj.state_updater.method_choice = method
+        if (obj.name in networkParams.definitions):
+            networkParams.definitions[obj.name] = {**networkParams.definitions[obj.name], 'method': method}
+
+def extend_model(networkParams,
+                 network: NetworkIR,
+                 changes: tp.Dict,
+                 custom_mechs: tp.Dict[str, tp.Dict]=None,
+                 custom_cells: tp.Dict[str, tp.Dict]=None,
+                 default_mech: tp.Dict=None,
+                 default_cell: tp.Dict[str, tp.Dict]=None,
+                 vectorized: bool=False,
+                 record_spikes: bool=False):
+    ''' Add the neurons, synapses and stimulation targets a NetworkIR grew by to the brian2
+    network emitted from it
+    
+    .. note::
+        
+        Only the added part of the network is emitted, so this takes time proportional to it
+        rather than to the whole network. Everything else has to match the arguments
+        networkParams was emitted with (see model_from_network()).
         
-        # neuroml2 doesn't like dashes or slashes
-        cellname = rid_to_uname_morph[rid]
-        cellname_raw = cellname
-        cellname = cellname.replace('-','_')
-        cellname = cellname.replace('/','')
+        NeuronGroups have a fixed size, so in vectorized networks the new neurons get groups of
+        their own. Networks built for cpp_standalone, or streaming to a Recording, can't be
+        extended; generate them again instead.
+    
+    :param networkParams: brian2 network to extend, emitted from the network before it grew
+    :param network: grown network
+    :param changes: what the network grew by, see incremental.grow_network()
+    '''
+    
+    if (getattr(networkParams, 'standalone', None) != None):
+        raise ValueError("cpp_standalone networks can't be extended, generate the network again")
+    if (len(getattr(networkParams, 'recording_monitors', ())) > 0):
+        raise ValueError("networks streaming to a Recording can't be extended, generate the network again")
+    
+    if custom_mechs == None: custom_mechs = {}
+    if custom_cells == None: custom_cells = {}
+    
+    sources = {stim['source']: networkParams[stim['source']] for stim in network.stims[changes['first_stim']:]}
+    
+    if (vectorized):
+        _emit_groups(networkParams, network, sources, custom_mechs, custom_cells, default_mech, default_cell,
+                     record_spikes, changes)
+    else:
+        _emit_neurons(networkParams, network, sources, custom_mechs, custom_cells, default_mech, default_cell,
+                      record_spikes, changes)
+    
+    return networkParams
+
+def _select_device(execution: str, threads: int=None):
+    ''' Switch brian2 to the device of an execution mode, before any object is created '''
+    
+    from brian2 import all_devices, device, get_device, prefs, set_device
+    
+    if (execution == 'runtime'):
+        if get_device() is not all_devices['runtime']:
+            set_device('runtime')
+    elif (execution == 'cpp_standalone'):
+        # Start a fresh project, even if another network was already built in this session
+        set_device('cpp_standalone', build_on_run=False)
+        device.reinit()
+        device.activate(build_on_run=False)
+        prefs.devices.cpp_standalone.openmp_threads = threads if threads != None else os.cpu_count()
+    else:
+        raise ValueError("execution must be 'runtime' or 'cpp_standalone'")
 
+def _attach_recording(networkParams, recording: Recording):
+    ''' Add the monitors of a Recording to a brian2 network, and flush them periodically
+    
+    Every trace specification gets a StateMonitor per neuron group it records from, sampling
+    every stride timesteps of defaultclock, and spikes get a SpikeMonitor per group. A
+    NetworkOperation hands their contents to the recording every flush_every ms, then empties
+    them, so they never hold more than one interval worth of samples.
+    '''
+    
+    from brian2 import NetworkOperation, NeuronGroup, SpikeMonitor, StateMonitor, defaultclock, ms
+    
+    # Neurons are numbered group by group, in the order of neuron_names
+    names = []
+    offsets = {}
+    for group, group_names in networkParams.neuron_names.items():
+        offsets[group] = len(names)
+        names.extend(group_names)
+    groups = {o.name: o for o in networkParams.objects if isinstance(o, NeuronGroup) and o.name in offsets}
+    rows = recording.resolve(names)
+    
+    trace_monitors = []
+    for s, (spec, r) in enumerate(zip(recording.traces, rows)):
+        trace_monitors.append([])
+        for group, offset in offsets.items():
+            idx = r[(r >= offset) & (r < offset + len(networkParams.neuron_names[group]))] - offset
+            if (len(idx) == 0):
+                continue
+            
+            monitor = StateMonitor(groups[group], spec['variables'], record=idx, dt=spec['stride'] * defaultclock.dt,
+                                   name=group + '_recording_' + str(s))
+            networkParams.add(monitor)
+            trace_monitors[s].append(monitor)
+    
+    spike_monitors = []
+    if (recording.spikes):
+        for group, offset in offsets.items():
+            monitor = SpikeMonitor(groups[group], name=group + '_recording_spikes')
+            networkParams.add(monitor)
+            spike_monitors.append((offset, monitor))
+    
+    networkParams.recording_monitors = {m.name for ms in trace_monitors for m in ms}
+    networkParams.recording_monitors.update(m.name for _, m in spike_monitors)
+    
+    def collect():
+        traces = []
+        for spec, monitors in zip(recording.traces, trace_monitors):
+            t = np.zeros(0)
+            values = {var: [] for var in spec['variables']}
+            for monitor in monitors:
+                t = np.array(monitor.t_[:]) * 1000
+                for var in spec['variables']:
+                    value = np.array(monitor.variables[var].get_value()).T
+                    values[var].append(value * 1000 if var == 'v' else value)
+                monitor.resize(0)
+            traces.append((t, {var: np.concatenate(value) if value else np.zeros((0, len(t)))
+                               for var, value in values.items()}))
+        
+        spike_times = []
+        spike_neurons = []
+        for offset, monitor in spike_monitors:
+            spike_times.append(np.array(monitor.t_[:]) * 1000)
+            spike_neurons.append(np.array(monitor.i[:], dtype=np.int64) + offset)
+            monitor.resize(0)
+            monitor.variables['N'].set_value(0)
+        
+        return (traces,
+                np.concatenate(spike_times) if spike_times else np.zeros(0),
+                np.concatenate(spike_neurons) if spike_neurons else np.zeros(0, dtype=np.int64))
+    
+    recording.attach(names, rows, float(defaultclock.dt / ms), collect)
+    networkParams.add(NetworkOperation(recording.flush, dt=recording.flush_every * ms, when='end',
+                                       name='recording_flush'))
+
+def _definition_key(definition: tp.Dict) -> str:
+    ''' Hashable key for a brian2 component definition dict, equal for equal definitions '''
+    
+    return repr(sorted((k, repr(v)) for k, v in definition.items()))
+
+def _spike_generator(network: NetworkIR, neurons: np.ndarray, name: str=None):
+    ''' SpikeGeneratorGroup replaying the spike trains of surrogate neurons, one neuron each '''
+    
+    from brian2 import SpikeGeneratorGroup, defaultclock, ms
+    
+    counts = network.spike_ptr[neurons + 1] - network.spike_ptr[neurons]
+    indices = np.repeat(np.arange(len(neurons)), counts)
+    times = np.concatenate([network.spike_train(i) for i in neurons]) if len(neurons) > 0 else np.zeros(0)
+    
+    # SpikeGeneratorGroup refuses neurons spiking twice in a timestep, so keep the first spike
+    # of every timestep, binned the way brian2 bins them
+    dt = float(defaultclock.dt / ms)
+    steps = ((times + 1e-3 * dt) / dt).astype(np.int64)
+    keep = np.sort(np.unique(np.stack([indices, steps], axis=1), axis=0, return_index=True)[1])
+    
+    return SpikeGeneratorGroup(len(neurons), indices[keep], times[keep] * ms,
+                               **({'name': name} if name != None else {}))
+
+def _emit_neurons(networkParams,
+                  network: NetworkIR,
+                  sources: tp.Dict,
+                  custom_mechs: tp.Dict[str, tp.Dict],
+                  custom_cells: tp.Dict[str, tp.Dict],
+                  default_mech: tp.Dict,
+                  default_cell: tp.Dict,
+                  record_spikes: bool=False,
+                  changes: tp.Dict=None):
+    ''' Emit a NeuronGroup of 1 per neuron, and a Synapses object per synapse
+    
+    Surrogate neurons are SpikeGeneratorGroups of 1 replaying their spike train instead. With
+    changes (see incremental.grow_network()), only what was added to the network since
+    networkParams was emitted from it is emitted.
+    '''
+    
+    from brian2 import NeuronGroup, SpikeMonitor, StateMonitor, Synapses, mV
+    
+    first = changes['first_neuron'] if changes != None else 0
+    first_stim = changes['first_stim'] if changes != None else 0
+    first_record = changes['first_record'] if changes != None else 0
+    
+    # Turn neurons into neuron groups
+    groups = {}
+    for i in range(first, network.n_neurons):
+        label = network.cell_models[network.cell_model[i]]
+        
+        if (label == SURROGATE):
+            groups[i] = _spike_generator(network, np.array([i]))
+            networkParams.add(groups[i])
+            continue
+        
         # Is the cell part of custom_cells?
-        if (custom_cells != None):
-            if (cellname_raw in custom_cells.keys()):
-                eqs = custom_cells[cellname_raw]
-            else:
-                eqs = default_cell
+        if (label in custom_cells.keys()):
+            eqs = custom_cells[label]
         else:
             eqs = default_cell
         
         # Create a cell population of 1
-        locals()[cellname] = NeuronGroup(1, **eqs)
-        locals()[cellname].v = 0 * mV
-        
-        networkParams.add(locals()[cellname])
-        
-        # We can't define recordings outside of network setup b/c of how Brian2 is structured,
-        # so we do it here
-        if (record_names != None):
-            if cellname_raw in record_names:
-                locals()[cellname + "_record"] = StateMonitor(locals()[cellname], ('v'), record=True)
-                networkParams.add(locals()[cellname + "_record"])
-    
-    # Turn synapses into synapse groups                                         
-    for rid in rid_to_uname_morph.keys():
-        # Grab neuron info from the client because synaptic partners aren't easily accessible
-        # from the graph for some reason
-        info = client.getInfo(rid)
-        
-        connectivity = info['data']['connectivity']['pre']['details']
-        
-        # Loop through connections                                     
-                                             
-        for con in connectivity:
-            syn = con['syn_rid']
-            pre, post = con['syn_uname'].split('--')
+        groups[i] = NeuronGroup(1, **eqs)
+        groups[i].v = 0 * mV
+        
+        networkParams.add(groups[i])
+        networkParams.definitions[groups[i].name] = eqs
+    
+    # Synapses between neurons that were already emitted were emitted along with them
+    pre = network.synapse_pre()
+    new = np.flatnonzero((pre >= first) | (network.syn_post >= first))
+    stims = network.stims[first_stim:]
+    record = network.record[first_record:]
+    record = record[~network.surrogates()[record]]
+    
+    # Neurons that were already emitted are looked up by name
+    targets = np.array([stim['target'] for stim in stims], dtype=np.int64)
+    for i in np.unique(np.concatenate([pre[new], network.syn_post[new], targets, record])):
+        if (i < first):
+            groups[i] = networkParams[networkParams.neuron_index[str(network.unames[i])][0]]
+    
+    # We can't define recordings outside of network setup b/c of how Brian2 is structured,
+    # so we do it here
+    for i in record:
+        networkParams.add(StateMonitor(groups[i], ('v'), record=True))
+    if (record_spikes):
+        for i in range(first, network.n_neurons):
+            networkParams.add(SpikeMonitor(groups[i], name=groups[i].name + '_spikes'))
+    
+    # Turn synapses into synapse groups
+    for n in new:
+        label = network.mechs[network.syn_mech[n]]
+        
+        # Check to see if this is predefined synapse mechanism
+        if (label in custom_mechs.keys()):
+            mech = _weighted(custom_mechs[label])
+        else:
+            mech = _weighted(default_mech)
+        
+        syn = Synapses(groups[pre[n]], groups[network.syn_post[n]], **mech)
+        syn.connect()
+        syn.w = network.syn_weight[n]
+        
+        networkParams.add(syn)
+        networkParams.definitions[syn.name] = mech
+    
+    # STIMULATION TARGETS
+    stim_mech = _weighted(default_mech) if len(stims) > 0 else None
+    for stim in stims:
+        stim_syn = Synapses(sources[stim['source']], groups[stim['target']], **stim_mech)
+        stim_syn.connect()
+        stim_syn.w = 1
+        
+        networkParams.add(stim_syn)
+        networkParams.definitions[stim_syn.name] = stim_mech
+    
+    # Cells have a group of their own, so they are always the first neuron of it
+    if (first == 0):
+        networkParams.neuron_index = {}
+        networkParams.neuron_names = {}
+    for i in range(first, network.n_neurons):
+        uname = str(network.unames[i])
+        networkParams.neuron_index[uname] = networkParams.neuron_index[str(network.names[i])] = (groups[i].name, 0)
+        networkParams.neuron_names[groups[i].name] = [uname]
+
+def _emit_groups(networkParams,
+                 network: NetworkIR,
+                 sources: tp.Dict,
+                 custom_mechs: tp.Dict[str, tp.Dict],
+                 custom_cells: tp.Dict[str, tp.Dict],
+                 default_mech: tp.Dict,
+                 default_cell: tp.Dict,
+                 record_spikes: bool=False,
+                 changes: tp.Dict=None):
+    ''' Emit a NeuronGroup per cell definition, and a Synapses object per pair of groups
+    
+    Surrogate neurons share a SpikeGeneratorGroup replaying their spike trains. With changes
+    (see incremental.grow_network()), only what was added to the network since networkParams
+    was emitted from it is emitted. NeuronGroups can't grow, so new neurons are put in new
+    groups rather than the groups of neurons that were already emitted.
+    '''
+    
+    from brian2 import NeuronGroup, SpikeMonitor, StateMonitor, Synapses, mV
+    
+    first = changes['first_neuron'] if changes != None else 0
+    first_stim = changes['first_stim'] if changes != None else 0
+    first_record = changes['first_record'] if changes != None else 0
+    if (first == 0):
+        networkParams.neuron_index = {}
+        networkParams.neuron_names = {}
+    
+    # Sort neurons by cell definition, equal definitions end up in the same group
+    groups = [networkParams[name] for name in networkParams.neuron_names.keys()]
+    emitted = len(groups)
+    group_keys = {}
+    group_defs = []
+    group_sizes = []
+    neuron_group = np.full(network.n_neurons, -1, dtype=np.int64)
+    neuron_idx = np.full(network.n_neurons, -1, dtype=np.int64)
+    for i in range(first, network.n_neurons):
+        label = network.cell_models[network.cell_model[i]]
+        if (label == SURROGATE):
+            eqs = None
+        elif (label in custom_cells.keys()):
+            eqs = custom_cells[label]
+        else:
+            eqs = default_cell
+        
+        key = _definition_key(eqs) if eqs != None else SURROGATE
+        if key not in group_keys:
+            group_keys[key] = emitted + len(group_defs)
+            group_defs.append(eqs)
+            group_sizes.append(0)
+        
+        neuron_group[i] = group_keys[key]
+        neuron_idx[i] = group_sizes[neuron_group[i] - emitted]
+        group_sizes[neuron_group[i] - emitted] += 1
+    
+    # Turn neuron groups into NeuronGroups, and surrogates into a SpikeGeneratorGroup
+    for eqs, size in zip(group_defs, group_sizes):
+        if (eqs == None):
+            groups.append(_spike_generator(network, np.flatnonzero(neuron_group == len(groups)),
+                                           name='cells_' + str(len(groups))))
+            networkParams.add(groups[-1])
+            continue
+        groups.append(NeuronGroup(size, name='cells_' + str(len(groups)), **eqs))
+        groups[-1].v = 0 * mV
+        networkParams.add(groups[-1])
+        networkParams.definitions[groups[-1].name] = eqs
+    
+    # Synapses between neurons that were already emitted were emitted along with them
+    pre = network.synapse_pre()
+    post = network.syn_post
+    new = np.flatnonzero((pre >= first) | (post >= first))
+    stims = network.stims[first_stim:]
+    record = np.unique(network.record[first_record:])
+    record = record[~network.surrogates()[record]]
+    
+    # Neurons that were already emitted are looked up by name
+    group_ids = {group.name: g for g, group in enumerate(groups)}
+    targets = np.array([stim['target'] for stim in stims], dtype=np.int64)
+    for i in np.unique(np.concatenate([pre[new], post[new], targets, record])):
+        if (i < first):
+            group, idx = networkParams.neuron_index[str(network.unames[i])]
+            neuron_group[i] = group_ids[group]
+            neuron_idx[i] = idx
+    
+    # One StateMonitor per group, recording only the requested neurons
+    for group in np.unique(neuron_group[record]):
+        name = groups[group].name + '_record' + ('_' + str(first_record) if first_record > 0 else '')
+        networkParams.add(StateMonitor(groups[group], ('v'), record=neuron_idx[record[neuron_group[record] == group]],
+                                       name=name))
+    if (record_spikes):
+        for group in groups[emitted:]:
+            networkParams.add(SpikeMonitor(group, name=group.name + '_spikes'))
+    
+    # Sort synapses by (mechanism, presynaptic group, postsynaptic group), then turn every run of
+    # equal keys into a single Synapses object connected with index arrays. Every run involves a
+    # new group, so it never matches a Synapses object that was already emitted
+    offset = sum(1 for o in networkParams.objects if isinstance(o, Synapses) and o.name.startswith('synapses_'))
+    pre = pre[new]
+    post = post[new]
+    keys = np.stack([network.syn_mech[new], neuron_group[pre], neuron_group[post]], axis=1)
+    order = np.lexsort(keys.T[::-1])
+    if (len(order) > 0):
+        split = np.flatnonzero(np.any(np.diff(keys[order], axis=0) != 0, axis=1)) + 1
+        for n, syns in enumerate(np.split(order, split)):
+            mech, pre_group, post_group = keys[syns[0]]
+            definition = _weighted(custom_mechs.get(network.mechs[mech], default_mech))
+            syn = Synapses(groups[pre_group], groups[post_group], name='synapses_' + str(offset + n), **definition)
+            syn.connect(i=neuron_idx[pre[syns]], j=neuron_idx[post[syns]])
+            syn.w = network.syn_weight[new[syns]]
             
-            # Only grab synapses to neurons that we actually care about
-            if(pre in uname_to_rid.keys()):
-                
-                # neuroml2 doesn't like dashes or slashes
-                con_uname_raw = con['syn_uname']
-                con_uname = con['syn_uname'].replace('-','_')
-                con_uname = con_uname.replace('/','')
-                pre = pre.replace('-','_')
-                pre = pre.replace('/','')
-                post = post.replace('-','_')
-                post = post.replace('/','')
-                
-                # Check to see if this is predefined synapse mechanism
-                if (custom_mechs != None):
-                    if (con_uname_raw in custom_mechs.keys()):
-                        locals()[con_uname] = Synapses(locals()[pre], locals()[post], **custom_mechs[con_uname_raw])
-                    else:
-                        locals()[con_uname] = Synapses(locals()[pre], locals()[post], **default_mech)
-                else:
-                    locals()[con_uname] = Synapses(locals()[pre], locals()[post], **default_mech)
-                    
-                locals()[con_uname].connect()
-                locals()[con_uname].add_attribute('w')
-                locals()[con_uname].w = 1
-                    
-                networkParams.add(locals()[con_uname])
-                
-        # STIMULATION TARGETS
-        if (stim_targets != None):
-            for stim in stim_targets.keys():
-                #networkParams.addStimTargetParams(stim + "_stim", stim_targets[stim])
-                locals()[stim + "_stim"] = Synapses(locals()[stim], locals()[stim_targets[stim]], on_pre=default_mech)
-                locals()[stim + "_stim"].connect()
-                
-                networkParams.add(locals()[stim + "_stim"])
-                
-    return networkParams
\ No newline at end of file
+            networkParams.add(syn)
+            networkParams.definitions[syn.name] = definition
+    
+    # STIMULATION TARGETS
+    stim_mech = _weighted(default_mech) if len(stims) > 0 else None
+    for stim in stims:
+        i = stim['target']
+        stim_syn = Synapses(sources[stim['source']], groups[neuron_group[i]],
+                            name=str(network.names[i]) + '_stim', **stim_mech)
+        stim_syn.connect(i=0, j=neuron_idx[i])
+        stim_syn.w = 1
+        
+        networkParams.add(stim_syn)
+        networkParams.definitions[stim_syn.name] = stim_mech
+    
+    for i in range(first, network.n_neurons):
+        uname = str(network.unames[i])
+        networkParams.neuron_index[uname] = networkParams.neuron_index[str(network.names[i])] = (groups[neuron_group[i]].name,
+                                                                                                 int(neuron_idx[i]))
+    networkParams.neuron_names.update({group.name: [] for group in groups[emitted:]})
+    for i in first + np.lexsort((neuron_idx[first:], neuron_group[first:])):
+        networkParams.neuron_names[groups[neuron_group[i]].name].append(str(network.unames[i]))
+
+def _weighted(definition: tp.Dict) -> tp.Dict:
+    ''' A synaptic mechanism definition with a w weight variable, added to its model unless it
+    declares one already '''
+    
+    model = definition.get('model', '')
+    if 'w' in _model_names(model):
+        return definition
+    
+    if isinstance(model, str):
+        return {**definition, 'model': model + '\nw : 1'}
+    
+    from brian2 import Equations
+    
+    return {**definition, 'model': model + Equations('w : 1')}
+
+def _model_names(model) -> tp.FrozenSet[str]:
+    ''' Names of the variables a model declares. Parsing is slow, so string models are cached '''
+    
+    if isinstance(model, str):
+        return _parse_model_names(model)
+    return frozenset(model.names)
+
+@functools.lru_cache(maxsize=None)
+def _parse_model_names(model: str) -> tp.FrozenSet[str]:
+    from brian2 import Equations
+    
+    return frozenset(Equations(model).names)
+
+def _stim_specs(stim_targets: tp.Dict[str, str]) -> tp.List[tp.Dict]:
+    ''' Turn brian2 stim_targets into the stimulation specs stored by a NetworkIR '''
+    
+    if (stim_targets == None):
+        return None
+    
+    return [{'source': stim, 'target': target} for stim, target in stim_targets.items()]
@@ -0,0 +1,388 @@
+import heapq
+import os.path
+import tempfile
+import typing as tp
+
+import networkx as nx
+import numpy as np
+
+from .analysis import SimulationResults
+from .batch import run_batch
+from .network_ir import SURROGATE, NetworkIR
+
+# Labels partition_network() groups neurons by, from their unames ('Mi4-C')
+LABELS = {'column': lambda uname: uname.rsplit('-', 1)[-1],
+          'cell_type': lambda uname: uname.split('-')[0]}
+
+def partition_network(network: NetworkIR,
+                      by: tp.Union[str, tp.Sequence[str]]='column',
+                      parts: int=None,
+                      seed: int=0) -> tp.List[np.ndarray]:
+    ''' Split the neurons of a network into partitions that can be simulated separately
+
+    .. note::
+
+        Neurons are grouped by 'column' (the part of their uname after the last dash, 'C' for
+        'Mi4-C'), by 'cell_type' (the part before the first dash, 'Mi4'), or by a label given
+        for every neuron. With parts, the groups are then packed into that many partitions of
+        about the same number of neurons, largest first, so no group is ever split.
+
+        'community' splits the network along its sparsest cuts instead: the partition with
+        the most neurons is bisected with the Kernighan-Lin algorithm, minimizing the contacts
+        between its halves (synapses weighted by their syn_count, in either direction), until
+        there are parts partitions.
+
+        Query graphs don't hold synapses, so build the network of the whole query with
+        network_ir.network_from_query() first. A NetworkIR of the whole medulla fits in memory
+        easily, where the simulators can't hold more than a few columns.
+
+    :param network: network to partition
+    :param by: 'column', 'cell_type', 'community', or a label per neuron
+    :param parts: number of partitions to make. Defaults to one per label, and to 2 for
+                  'community'.
+    :param seed: seed of the random initial bisections of 'community'
+    :return: sorted neuron ids of every partition
+    '''
+
+    if (isinstance(by, str) and by == 'community'):
+        return _bisect(network, parts if parts != None else 2, seed)
+
+    if isinstance(by, str):
+        if by not in LABELS:
+            raise ValueError("unknown partitioning '" + by + "', expected 'community', a label per neuron or one of "
+                             + ', '.join(LABELS.keys()))
+        labels = [LABELS[by](uname) for uname in network.unames.tolist()]
+    else:
+        labels = by
+    if (len(labels) != network.n_neurons):
+        raise ValueError('expected a label per neuron, got ' + str(len(labels)) + ' for ' + str(network.n_neurons))
+
+    label = np.unique(np.asarray(labels, dtype=str), return_inverse=True)[1]
+    order = np.argsort(label, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(label[order])) + 1) if network.n_neurons > 0 else []
+
+    if (parts != None and parts < len(groups)):
+        groups = _pack(groups, parts)
+
+    return [np.sort(group) for group in groups]
+
+def partition_report(network: NetworkIR, partitions: tp.List[np.ndarray]) -> tp.Dict:
+    ''' How much of a network a partitioning cuts, to compare partitionings before simulating
+
+    :param network: partitioned network
+    :param partitions: neuron ids of every partition, see partition_network()
+    :return: dictionary of the number of 'partitions', their 'sizes', the numbers of 'synapses'
+             and of synapses 'cut' between partitions, the 'cut_fraction', and the number of
+             'surrogates' needed to replace the inputs of every partition
+    '''
+
+    part = np.full(network.n_neurons, -1, dtype=np.int64)
+    for p, members in enumerate(partitions):
+        part[members] = p
+    pre = network.synapse_pre()
+    cut = part[pre] != part[network.syn_post]
+
+    # A neuron is a surrogate once per partition it has synapses into
+    pairs = np.unique(np.stack([pre[cut], part[network.syn_post[cut]]], axis=1), axis=0)
+
+    return {'partitions': len(partitions),
+            'sizes': [len(members) for members in partitions],
+            'synapses': network.n_synapses,
+            'cut': int(np.count_nonzero(cut)),
+            'cut_fraction': float(np.mean(cut)) if network.n_synapses > 0 else 0.0,
+            'surrogates': len(pairs)}
+
+def extract_partition(network: NetworkIR,
+                      members: tp.Sequence[int],
+                      surrogate: tp.Union[str, SimulationResults]='poisson',
+                      rate: tp.Union[float, np.ndarray]=10.0,
+                      duration: float=None,
+                      seed: int=0) -> NetworkIR:
+    ''' The network of a single partition, with its inputs from outside replaced by surrogates
+
+    .. note::
+
+        The partition keeps its neurons, the synapses onto them, and their stimulation and
+        recording specs. Every neuron outside of it with synapses onto it becomes a surrogate
+        neuron (see network_ir.SURROGATE), which the backends emit as a spike generator:
+
+            - 'poisson': a Poisson spike train of rate Hz, drawn from a generator seeded with
+              seed and the neuron's id, so every partition it feeds gets the same train
+            - SimulationResults: the spikes the neuron fired in those results, e.g. of a
+              previous partitioned run (see run_partitions()), or of a smaller network the
+              neuron was simulated in. Neurons missing from the results don't spike.
+
+        Neurons come first in the order of the network, followed by the surrogates. Names
+        are kept, so results of the partition line up with the network (see stitch_results()).
+
+    :param network: network to extract the partition from. It isn't modified.
+    :param members: neuron ids of the partition
+    :param surrogate: 'poisson', or SimulationResults to replay the spikes of
+    :param rate: rate of the Poisson surrogates in Hz, or an array of a rate per neuron of
+                 the network
+    :param duration: simulated time to draw Poisson spike trains for, in ms
+    :param seed: seed of the Poisson spike trains
+    '''
+
+    members = np.unique(np.asarray(members, dtype=np.int64))
+    inside = np.zeros(network.n_neurons, dtype=bool)
+    inside[members] = True
+
+    pre = network.synapse_pre()
+    kept = np.flatnonzero(inside[network.syn_post])
+    boundary = np.unique(pre[kept][~inside[pre[kept]]])
+    neurons = np.concatenate([members, boundary])
+    new_id = np.full(network.n_neurons, -1, dtype=np.int64)
+    new_id[neurons] = np.arange(len(neurons))
+
+    # Kept synapses are still grouped by their old presynaptic id, regroup them by the new one
+    new_pre = new_id[pre[kept]]
+    order = np.argsort(new_pre, kind='stable')
+    syn_ptr = np.zeros(len(neurons) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_pre, minlength=len(neurons)), out=syn_ptr[1:])
+
+    cell_models = list(network.cell_models)
+    if (len(boundary) > 0 and SURROGATE not in cell_models):
+        cell_models.append(SURROGATE)
+    cell_model = network.cell_model[neurons].copy()
+    if (len(boundary) > 0):
+        cell_model[len(members):] = cell_models.index(SURROGATE)
+
+    trains = [network.spike_train(i) for i in members] + _surrogate_trains(network, boundary, surrogate, rate,
+                                                                           duration, seed)
+    spike_ptr = np.zeros(len(neurons) + 1, dtype=np.int64)
+    np.cumsum([len(train) for train in trains], out=spike_ptr[1:])
+
+    record = network.record[inside[network.record]]
+
+    return NetworkIR(unames=network.unames[neurons],
+                     rids=network.rids[neurons],
+                     cell_model=cell_model,
+                     cell_models=cell_models,
+                     syn_ptr=syn_ptr,
+                     syn_post=new_id[network.syn_post[kept]][order],
+                     syn_mech=network.syn_mech[kept][order],
+                     mechs=network.mechs,
+                     stims=[{**stim, 'target': int(new_id[stim['target']])} for stim in network.stims
+                            if inside[stim['target']]],
+                     record=new_id[record],
+                     syn_count=network.syn_count[kept][order],
+                     syn_weight=network.syn_weight[kept][order],
+                     spike_ptr=spike_ptr,
+                     spike_times=np.concatenate(trains) if len(trains) > 0 else np.zeros(0),
+                     aggregation=network.aggregation)
+
+def stitch_results(network: NetworkIR,
+                   partitions: tp.List[np.ndarray],
+                   results: tp.List[SimulationResults]) -> SimulationResults:
+    ''' Put the results of every partition of a network together into results of the network
+
+    .. note::
+
+        Only the spikes and traces of the neurons of each partition are kept, the spikes its
+        surrogates replayed are left out. Traces are interpolated onto the sample times of the
+        first partition with any, in case partitions were recorded at different steps.
+
+    :param network: network the partitions were extracted from
+    :param partitions: neuron ids of every partition, see partition_network()
+    :param results: results of every partition, in the same order
+    :return: results with a neuron per neuron of the network, in the same order
+    '''
+
+    spike_times, spike_neurons = [], []
+    trace_neurons, rows = [], []
+    t = None
+    for members, result in zip(partitions, results):
+        members = np.asarray(members, dtype=np.int64)
+        owner = np.full(result.n_neurons, -1, dtype=np.int64)
+        _, found, index = np.intersect1d(result.names, network.unames[members], return_indices=True)
+        owner[found] = members[index]
+
+        spiked = owner[result.spike_neurons]
+        spike_times.append(result.spike_times[spiked >= 0])
+        spike_neurons.append(spiked[spiked >= 0])
+
+        traced = owner[result.trace_neurons]
+        if (np.count_nonzero(traced >= 0) == 0):
+            continue
+        if t is None:
+            t = result.t
+        trace_neurons.append(traced[traced >= 0])
+        rows.append({var: np.array([np.interp(t, result.t, row) for row in trace[traced >= 0]])
+                     if not np.array_equal(result.t, t) else trace[traced >= 0]
+                     for var, trace in result.traces.items()})
+
+    variables = set.intersection(*[set(row.keys()) for row in rows]) if len(rows) > 0 else set()
+    durations = [result.duration for result in results if result.duration is not None]
+
+    return SimulationResults(names=network.unames,
+                             spike_times=np.concatenate(spike_times) if len(spike_times) > 0 else np.zeros(0),
+                             spike_neurons=np.concatenate(spike_neurons) if len(spike_neurons) > 0 else np.zeros(0),
+                             t=t,
+                             traces={var: np.concatenate([row[var] for row in rows]) for var in variables},
+                             trace_neurons=np.concatenate(trace_neurons) if len(trace_neurons) > 0 else None,
+                             duration=min(durations) if len(durations) > 0 else None)
+
+def run_partitions(network: NetworkIR,
+                   partitions: tp.List[np.ndarray],
+                   backend: str,
+                   duration: float,
+                   model: tp.Dict=None,
+                   simulate: tp.Dict=None,
+                   surrogate: tp.Union[str, SimulationResults]='poisson',
+                   rate: tp.Union[float, np.ndarray]=10.0,
+                   iterations: int=1,
+                   seed: int=0,
+                   max_workers: int=None,
+                   timeout: float=None,
+                   memory_limit_mb: float=None,
+                   quiet: bool=True) -> tp.Tuple[SimulationResults, tp.List[tp.Dict]]:
+    ''' Simulate every partition of a network in parallel, and stitch their results together
+
+    .. note::
+
+        Every partition is extracted with extract_partition(), saved to a temporary file and
+        simulated as a job of batch.run_batch(), in a process of its own, so only the largest
+        partitions have to fit in memory at once rather than the whole network.
+
+        With more than one iteration, every further one replays the spikes the previous one
+        stitched together through the surrogates, instead of surrogate. Boundary inputs then
+        carry the activity the partitions actually produced, and the stitched results get
+        closer to those of the whole network with every iteration, at the cost of simulating
+        every partition again.
+
+        Jobs run in freshly spawned processes, so set anything global through model, e.g. the
+        brian2 timestep with {'integration': {'dt': 0.025}}. Recorded neurons (record_names of
+        model) are restricted to those of each partition.
+
+    :param network: network to simulate
+    :param partitions: neuron ids of every partition, see partition_network()
+    :param backend: 'netpyne' or 'brian2'
+    :param duration: simulated time, in ms. Sets sim_duration of netpyne models or t of brian2
+                     simulations, unless given there.
+    :param model: keyword arguments of the backend's model_gen(), see batch.run_batch()
+    :param simulate: keyword arguments of the backend's simulate(), e.g. internal_vars for brian2
+    :param surrogate: what replaces the inputs of the first iteration, see extract_partition()
+    :param rate: rate of Poisson surrogates in Hz, or an array of a rate per neuron
+    :param iterations: number of times every partition is simulated
+    :param seed: seed of the Poisson surrogates
+    :param max_workers: maximum number of partitions simulated at once, defaults to the number
+                        of CPUs
+    :param timeout: seconds after which the simulation of a partition is killed
+    :param memory_limit_mb: address space limit of every partition's process, in MB
+    :param quiet: whether to silence the output of the simulators
+    :return: stitched results of the last iteration (see stitch_results()), and the results of
+             batch.run_batch() of its partitions, with their profile and time but without
+             their SimulationResults
+    '''
+
+    if (iterations < 1):
+        raise ValueError('iterations must be at least 1, got ' + str(iterations))
+
+    model = dict(model) if model != None else {}
+    sim_args = dict(simulate) if simulate != None else {}
+    if (backend == 'netpyne'):
+        model.setdefault('sim_duration', duration)
+    else:
+        sim_args.setdefault('t', duration)
+
+    stitched = None
+    with tempfile.TemporaryDirectory() as directory:
+        for iteration in range(iterations):
+            jobs = []
+            for p, members in enumerate(partitions):
+                part = extract_partition(network, members, surrogate if stitched is None else stitched, rate,
+                                         duration, seed)
+                path = os.path.join(directory, 'partition_' + str(p) + '.nlpir')
+                part.save(path)
+
+                part_model = dict(model)
+                if (model.get('record_names') != None):
+                    surrogates = part.surrogates()
+                    part_model['record_names'] = [name for name in model['record_names']
+                                                  if name in part and not surrogates[part.index(name)]]
+                jobs.append({'backend': backend, 'network': path, 'model': part_model, 'simulate': sim_args,
+                             'label': p})
+
+            runs = sorted(run_batch(jobs, max_workers=max_workers, timeout=timeout, memory_limit_mb=memory_limit_mb,
+                                    quiet=quiet), key=lambda run: run['index'])
+            for run in runs:
+                if (run['error'] != None):
+                    raise RuntimeError('partition ' + str(run['label']) + ' failed: ' + run['error'])
+
+            stitched = stitch_results(network, partitions, [run['results'] for run in runs])
+
+    return stitched, [{key: value for key, value in run.items() if key != 'results'} for run in runs]
+
+def _pack(groups: tp.List[np.ndarray], parts: int) -> tp.List[np.ndarray]:
+    ''' Pack groups into parts bins of about the same size, largest group first '''
+
+    bins = [[] for _ in range(parts)]
+    heap = [(0, b) for b in range(parts)]
+    for group in sorted(groups, key=len, reverse=True):
+        size, b = heapq.heappop(heap)
+        bins[b].append(group)
+        heapq.heappush(heap, (size + len(group), b))
+
+    return [np.concatenate(groups) for groups in bins if len(groups) > 0]
+
+def _bisect(network: NetworkIR, parts: int, seed: int) -> tp.List[np.ndarray]:
+    ''' Bisect the largest partition along its minimum cut until there are parts of them '''
+
+    pre = network.synapse_pre()
+    G = nx.Graph()
+    G.add_nodes_from(range(network.n_neurons))
+    for i, j, count in zip(pre.tolist(), network.syn_post.tolist(), network.syn_count.tolist()):
+        if (i != j):
+            weight = G.get_edge_data(i, j, {'weight': 0})['weight']
+            G.add_edge(i, j, weight=weight + count)
+
+    partitions = [set(G.nodes)] if network.n_neurons > 0 else []
+    while (0 < len(partitions) < parts):
+        largest = max(range(len(partitions)), key=lambda p: len(partitions[p]))
+        if (len(partitions[largest]) < 2):
+            break
+        halves = nx.algorithms.community.kernighan_lin_bisection(G.subgraph(partitions[largest]), weight='weight',
+                                                                  seed=seed)
+        partitions[largest:largest + 1] = list(halves)
+
+    return [np.array(sorted(members), dtype=np.int64) for members in partitions]
+
+def _surrogate_trains(network: NetworkIR,
+                      neurons: np.ndarray,
+                      surrogate: tp.Union[str, SimulationResults],
+                      rate: tp.Union[float, np.ndarray],
+                      duration: float,
+                      seed: int) -> tp.List[np.ndarray]:
+    ''' Spike trains of the surrogates of neurons, see extract_partition() '''
+
+    surrogates = network.surrogates()
+    if isinstance(surrogate, SimulationResults):
+        order = np.argsort(surrogate.spike_neurons, kind='stable')
+        ptr = np.zeros(surrogate.n_neurons + 1, dtype=np.int64)
+        np.cumsum(np.bincount(surrogate.spike_neurons, minlength=surrogate.n_neurons), out=ptr[1:])
+        index = {name: k for k, name in enumerate(surrogate.names.tolist())}
+
+        trains = []
+        for i in neurons.tolist():
+            k = index.get(str(network.unames[i]))
+            if (surrogates[i] or k is None):
+                trains.append(network.spike_train(i))
+            else:
+                trains.append(np.sort(surrogate.spike_times[order[ptr[k]:ptr[k + 1]]]))
+        return trains
+
+    if (surrogate != 'poisson'):
+        raise ValueError("surrogate must be 'poisson' or SimulationResults, got " + repr(surrogate))
+    if (duration is None and len(neurons) > 0):
+        raise ValueError('Poisson surrogates need a duration')
+
+    rates = np.broadcast_to(np.asarray(rate, dtype=np.float64), (network.n_neurons,))
+    trains = []
+    for i in neurons.tolist():
+        if surrogates[i]:
+            trains.append(network.spike_train(i))
+            continue
+        rng = np.random.default_rng([seed, i])
+        trains.append(np.sort(rng.uniform(0, duration, rng.poisson(rates[i] * duration / 1000))))
+    return trains
@@ -0,0 +1,196 @@
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+import typing as tp
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS simply isn't reported
+    resource = None
+
+class ProfileReport:
+    ''' Phases and counts recorded by a Profiler
+
+    :param phases: one dict per finished phase, in the order they finished, with the keys 'phase',
+                   'wall_s', 'cpu_s', 'peak_mb' (peak traced Python allocations, or None) and
+                   'max_rss_mb' (peak resident set size of the process so far, or None)
+    :param counts: dictionary of counted quantities, e.g. neurons, synapses or code objects
+    '''
+
+    def __init__(self, phases: tp.List[tp.Dict], counts: tp.Dict[str, int]):
+        self.phases = phases
+        self.counts = counts
+
+    def __getitem__(self, phase: str) -> tp.Dict:
+        return self.totals()[phase]
+
+    def __contains__(self, phase: str) -> bool:
+        return any(p['phase'] == phase for p in self.phases)
+
+    def totals(self) -> tp.Dict[str, tp.Dict]:
+        ''' Phases aggregated by name: times are summed, and memory peaks are maxed '''
+
+        totals = {}
+        for p in self.phases:
+            total = totals.setdefault(p['phase'], {'calls': 0, 'wall_s': 0, 'cpu_s': 0,
+                                                   'peak_mb': None, 'max_rss_mb': None})
+            total['calls'] += 1
+            total['wall_s'] += p['wall_s']
+            total['cpu_s'] += p['cpu_s']
+            for key in ['peak_mb', 'max_rss_mb']:
+                if p[key] != None:
+                    total[key] = p[key] if total[key] == None else max(total[key], p[key])
+
+        return totals
+
+    def to_dict(self) -> tp.Dict:
+        return {'phases': self.phases, 'counts': self.counts}
+
+    def __repr__(self) -> str:
+        lines = ['{:<12} {:>6} {:>10} {:>10} {:>10} {:>10}'.format('phase', 'calls', 'wall (s)', 'cpu (s)',
+                                                                'peak (MB)', 'rss (MB)')]
+        for phase, total in self.totals().items():
+            lines.append('{:<12} {:>6} {:>10.3f} {:>10.3f} {:>10} {:>10}'.format(
+                phase, total['calls'], total['wall_s'], total['cpu_s'],
+                '-' if total['peak_mb'] == None else '{:.1f}'.format(total['peak_mb']),
+                '-' if total['max_rss_mb'] == None else '{:.1f}'.format(total['max_rss_mb'])))
+        for name, value in self.counts.items():
+            lines.append('{:<12} {}'.format(name, value))
+
+        return '\n'.join(lines)
+
+class Profiler:
+    ''' Records the wall time, CPU time and memory peaks of named phases, plus counts
+
+    .. note::
+
+        Pass one to model_gen() and simulate() of either backend to find out where the time of a
+        build or run goes. Phases are named after the pipeline stage they time: 'fetch'
+        (connectivity lookups), 'build' (NetworkIR), 'emit' (simulator objects or parameters),
+        'create' (NetPyNE network instantiation), 'compile' (Brian2 code generation), 'run' and
+        'analysis'. Phases can nest, each is measured on its own.
+
+        Allocation peaks come from tracemalloc, which slows Python code down noticeably while
+        it is tracing, so it can be turned off with trace_memory. A disabled profiler does
+        nothing at all, which is also what every function uses when none is passed in.
+
+    :param enabled: whether to record anything
+    :param trace_memory: whether to record peak Python allocations with tracemalloc
+    :param log: path of a JSON-lines file to append every phase and count to as they are recorded
+    :param tag: value of a 'tag' key added to every logged line, e.g. a query or run label
+    '''
+
+    def __init__(self,
+                 enabled: bool=True,
+                 trace_memory: bool=True,
+                 log: str=None,
+                 tag: str=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory and enabled
+        self.log = log
+        self.tag = tag
+
+        self._phases = []
+        self._counts = {}
+        self._stack = []
+        self._log = None
+        self._started_tracing = False
+
+    def phase(self, name: str) -> tp.ContextManager:
+        ''' Context manager timing everything run inside it as a phase called name '''
+
+        if not self.enabled:
+            return _NULL_PHASE
+        return self._phase(name)
+
+    def count(self, name: str, value: int):
+        ''' Record a counted quantity, replacing any earlier value of the same name '''
+
+        if not self.enabled:
+            return
+
+        self._counts[name] = value
+        self._write({'count': name, 'value': value})
+
+    def report(self) -> ProfileReport:
+        ''' Everything recorded so far '''
+
+        return ProfileReport([dict(p) for p in self._phases], dict(self._counts))
+
+    def close(self):
+        ''' Stop tracing allocations if this profiler started it, and close the log '''
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextlib.contextmanager
+    def _phase(self, name: str):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        # Let enclosing phases keep the peak reached so far, since it is reset for this one
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for frame in self._stack:
+                frame['peak'] = max(frame['peak'], peak)
+            tracemalloc.reset_peak()
+
+        frame = {'peak': 0}
+        self._stack.append(frame)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self._stack.pop()
+
+            peak_mb = None
+            if self.trace_memory:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                for parent in self._stack:
+                    parent['peak'] = max(parent['peak'], frame['peak'])
+                peak_mb = frame['peak'] / 1024**2
+
+            record = {'phase': name, 'wall_s': wall, 'cpu_s': cpu, 'peak_mb': peak_mb, 'max_rss_mb': _max_rss_mb()}
+            self._phases.append(record)
+            self._write(record)
+
+    def _write(self, record: tp.Dict):
+        if self.log is None:
+            return
+
+        if self._log is None:
+            self._log = open(self.log, 'a')
+        if self.tag is not None:
+            record = {**record, 'tag': self.tag}
+        self._log.write(json.dumps({**record, 'time': time.time()}) + '\n')
+        self._log.flush()
+
+# Shared by every disabled profiler, so turning profiling off costs a single attribute check
+_NULL_PHASE = contextlib.nullcontext()
+
+def _max_rss_mb() -> tp.Optional[float]:
+    ''' Peak resident set size of the process so far, in MB '''
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024**2
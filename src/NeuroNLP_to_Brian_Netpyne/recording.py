@@ -0,0 +1,254 @@
+import glob
+import json
+import os
+import os.path
+import typing as tp
+
+import numpy as np
+
+from .analysis import SimulationResults
+from .network_ir import sanitize_name
+
+class Recording:
+    ''' Streams spikes and subsampled traces of a simulation to disk while it runs
+
+    .. note::
+
+        Pass the same Recording to model_gen() and simulate() of either backend. model_gen()
+        sets up one monitor per neuron group (Brian2) or the recorded cells and traces
+        (NetPyNE), and simulate() hands everything recorded so far to the Recording every
+        flush_every ms of simulated time, then clears the simulator's buffers. Memory use
+        therefore depends on flush_every rather than on the duration of the simulation.
+
+        Each entry of traces records some variables of a set of neurons, every stride
+        integration steps:
+
+            {'variables': ['v'], 'neurons': ['Mi4-C', 'Mi1-C'], 'stride': 10}
+
+        Neurons can be given by uname or by sanitized name, and leaving neurons out records
+        every neuron. NetPyNE records every trace at the same step, the smallest stride of all
+        entries, and decimates the others as they are flushed.
+
+        Files ending in .h5 or .hdf5 are written as HDF5 (needs h5py), with every array
+        growing as chunks are appended. Anything else is a directory of numbered .npz chunks.
+        Either can be read back with read_recording().
+
+    :param path: file or directory to write to
+    :param traces: list of trace specifications, see above
+    :param spikes: whether to record spikes of every neuron
+    :param flush_every: interval between flushes, in ms of simulated time
+    '''
+
+    def __init__(self,
+                 path: str,
+                 traces: tp.List[tp.Dict]=None,
+                 spikes: bool=True,
+                 flush_every: float=100.0):
+        self.path = path
+        self.traces = [{'variables': list(spec.get('variables', ['v'])),
+                        'neurons': spec.get('neurons', None),
+                        'stride': int(spec.get('stride', 1))} for spec in (traces if traces is not None else [])]
+        self.spikes = spikes
+        self.flush_every = flush_every
+
+        self._writer = None
+        self._meta = None
+        self._collect = None
+
+    def resolve(self, names: tp.List[str]) -> tp.List[np.ndarray]:
+        ''' Sorted indices into names of the neurons recorded by every trace specification
+
+        Neurons that aren't in names are skipped, like anything else referring to neurons
+        outside of a query result.
+        '''
+
+        lookup = {}
+        for i, name in enumerate(names):
+            lookup.setdefault(name, i)
+            lookup.setdefault(sanitize_name(name), i)
+
+        rows = []
+        for spec in self.traces:
+            if spec['neurons'] is None:
+                rows.append(np.arange(len(names), dtype=np.int64))
+            else:
+                rows.append(np.unique(np.array([lookup[name] for name in spec['neurons'] if name in lookup],
+                                               dtype=np.int64)))
+
+        return rows
+
+    def attach(self,
+               names: tp.List[str],
+               rows: tp.List[np.ndarray],
+               dt: float,
+               collect: tp.Callable[[], tp.Tuple],
+               strides: tp.List[int]=None):
+        ''' Connect the Recording to a simulation, called by the backends
+
+        :param names: uname of every neuron the recorded neuron indices refer to
+        :param rows: neuron indices of the rows recorded by every trace specification
+        :param dt: integration timestep, in ms
+        :param collect: callable returning everything recorded since it was last called, as a
+                        tuple of (traces, spike_times, spike_neurons). traces holds a
+                        (t, {variable: (rows, samples) array}) tuple per trace specification.
+        :param strides: strides actually recorded by every trace specification, if the backend
+                        had to round them
+        '''
+
+        if strides is None: strides = [spec['stride'] for spec in self.traces]
+
+        self._meta = {'names': list(names),
+                      'dt': dt,
+                      'traces': [{**spec, 'neurons': [int(i) for i in r], 'stride': stride}
+                                 for spec, r, stride in zip(self.traces, rows, strides)],
+                      'spikes': self.spikes,
+                      'duration': 0.0}
+        self._collect = collect
+
+    def flush(self):
+        ''' Write everything recorded since the last flush '''
+
+        if self._collect is None:
+            return
+
+        traces, spike_times, spike_neurons = self._collect()
+
+        if self._writer is None:
+            self._writer = _Hdf5Writer(self.path) if _is_hdf5(self.path) else _NpzWriter(self.path)
+        self._writer.append(traces, spike_times, spike_neurons)
+
+        for t, _ in traces:
+            if (len(t) > 0):
+                self._meta['duration'] = max(self._meta['duration'], float(t[-1]))
+        self._writer.write_meta(self._meta)
+
+    def close(self, duration: float=None):
+        ''' Flush anything left, and close the file
+
+        :param duration: simulated time, in ms. Otherwise the time of the last trace sample is
+                         stored as the duration of the recording.
+        '''
+
+        if (duration is not None and self._meta is not None):
+            self._meta['duration'] = duration
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._collect = None
+
+def read_recording(path: str, spec: int=0) -> SimulationResults:
+    ''' Read a recording written by a Recording back into memory
+
+    :param path: file or directory the recording was written to
+    :param spec: index of the trace specification to read the traces of
+    '''
+
+    if _is_hdf5(path):
+        h5py = import_h5py('reading HDF5 recordings')
+        with h5py.File(path, 'r') as f:
+            meta = json.loads(f.attrs['meta'])
+            spike_times = f['spikes/times'][:]
+            spike_neurons = f['spikes/neurons'][:]
+            group = 'traces_' + str(spec)
+            t = f[group + '/t'][:] if group in f else None
+            traces = {var: f[group + '/' + var][:] for var in meta['traces'][spec]['variables']} if group in f else {}
+    else:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        spike_times, spike_neurons, t, traces = [], [], [], {}
+        for chunk in sorted(glob.glob(os.path.join(path, 'chunk_*.npz'))):
+            with np.load(chunk) as data:
+                spike_times.append(data['spike_times'])
+                spike_neurons.append(data['spike_neurons'])
+                if ('traces_' + str(spec) + '_t') in data.files:
+                    t.append(data['traces_' + str(spec) + '_t'])
+                    for var in meta['traces'][spec]['variables']:
+                        traces.setdefault(var, []).append(data['traces_' + str(spec) + '_' + var])
+
+        spike_times = np.concatenate(spike_times) if spike_times else np.zeros(0)
+        spike_neurons = np.concatenate(spike_neurons) if spike_neurons else np.zeros(0, dtype=np.int64)
+        t = np.concatenate(t) if t else None
+        traces = {var: np.concatenate(chunks, axis=1) for var, chunks in traces.items()}
+
+    return SimulationResults(names=meta['names'],
+                             spike_times=spike_times,
+                             spike_neurons=spike_neurons,
+                             t=t,
+                             traces=traces,
+                             trace_neurons=meta['traces'][spec]['neurons'] if len(meta['traces']) > spec else None,
+                             duration=meta['duration'])
+
+def _is_hdf5(path: str) -> bool:
+    return path.endswith('.h5') or path.endswith('.hdf5')
+
+class _NpzWriter:
+    ''' Writes every flush as the next numbered .npz file of a directory '''
+
+    def __init__(self, directory: str):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunks = 0
+
+    def append(self, traces: tp.List[tp.Tuple], spike_times: np.ndarray, spike_neurons: np.ndarray):
+        arrays = {'spike_times': spike_times, 'spike_neurons': spike_neurons}
+        for s, (t, values) in enumerate(traces):
+            arrays['traces_' + str(s) + '_t'] = t
+            for var, value in values.items():
+                arrays['traces_' + str(s) + '_' + var] = value
+
+        np.savez(os.path.join(self.directory, 'chunk_{:06d}.npz'.format(self.chunks)), **arrays)
+        self.chunks += 1
+
+    def write_meta(self, meta: tp.Dict):
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def close(self):
+        pass
+
+class _Hdf5Writer:
+    ''' Appends every flush to resizable HDF5 datasets '''
+
+    def __init__(self, path: str):
+        h5py = import_h5py('writing HDF5 recordings', ', use a directory path to write .npz chunks')
+        self.file = h5py.File(path, 'w')
+
+    def append(self, traces: tp.List[tp.Tuple], spike_times: np.ndarray, spike_neurons: np.ndarray):
+        self._extend('spikes/times', spike_times)
+        self._extend('spikes/neurons', spike_neurons)
+        for s, (t, values) in enumerate(traces):
+            self._extend('traces_' + str(s) + '/t', t)
+            for var, value in values.items():
+                self._extend('traces_' + str(s) + '/' + var, value)
+
+    def write_meta(self, meta: tp.Dict):
+        self.file.attrs['meta'] = json.dumps(meta)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def _extend(self, name: str, values: np.ndarray):
+        # Datasets grow along their last axis (samples), one chunk at a time
+        values = np.asarray(values)
+        if name not in self.file:
+            self.file.create_dataset(name, data=values, maxshape=values.shape[:-1] + (None,),
+                                     chunks=values.shape[:-1] + (max(1, min(values.shape[-1], 4096)),))
+            return
+
+        dataset = self.file[name]
+        start = dataset.shape[-1]
+        dataset.resize(start + values.shape[-1], axis=values.ndim - 1)
+        dataset[..., start:] = values
+
+def import_h5py(purpose: str, hint: str=''):
+    ''' Import h5py on first use, it is optional and slow to import '''
+
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError(purpose + ' requires h5py' + hint) from None
+    return h5py
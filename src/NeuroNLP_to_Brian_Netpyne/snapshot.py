@@ -0,0 +1,390 @@
+import json
+import typing as tp
+
+import numpy as np
+
+from .network_ir import read_arrays, sanitize_name, write_arrays
+
+# Version of the layout of arrays and metadata within a snapshot, on top of the format version
+# of network_ir.write_arrays()
+SNAPSHOT_VERSION = 1
+
+# Plain attributes of Synapses objects that are saved along with their states. The brian2
+# backend used to add w as one; it's a synaptic variable now (see nlptoBrian2._weighted())
+SYNAPSE_ATTRIBUTES = ['w']
+
+# connParams rules with only these keys, and conditions on a single population, are stored as
+# arrays. Anything else is stored as is
+CONN_KEYS = {'preConds', 'postConds', 'synMech', 'weight', 'delay', 'connList'}
+
+def save_model(path: str, networkParams, simConfig=None):
+    ''' Save a model generated by either backend to a single file that load_model() rebuilds it from
+
+    .. note::
+
+        Meant to replace export_model(exp_type='python') for reloading models: rather than a
+        script of an add*Params() call per rule, populations, connections and their weights
+        and delays are stored as typed arrays (see network_ir.write_arrays()), and the
+        comparatively few cell, synaptic mechanism and stimulation definitions as JSON
+        metadata. The file is memory-mappable, and carries both the format version and
+        SNAPSHOT_VERSION, so files of another version are refused rather than misread.
+
+        NetPyNE models are stored along with their simConfig, if given. Brian2 models are
+        stored object by object, from the definitions they were generated from, along with
+        the current values of their state variables, synaptic delays and connectivity, and
+        their monitors (but not what they recorded). Networks generated with a Recording or
+        with execution='cpp_standalone' can't be saved, and neither can objects that were
+        added to a network after it was generated.
+
+    :param path: path of the file to write
+    :param networkParams: model to save, as generated by either backend's model_gen()
+    :param simConfig: netpyne SimConfig object generated along with a netpyne model
+    '''
+
+    if hasattr(networkParams, 'popParams'):
+        arrays, meta = _save_netpyne(networkParams, simConfig)
+    else:
+        arrays, meta = _save_brian2(networkParams)
+    meta['snapshot_version'] = SNAPSHOT_VERSION
+
+    write_arrays(path, arrays, meta)
+
+def load_model(path: str, mmap: bool=True):
+    ''' Rebuild a model saved with save_model()
+
+    :param path: path of the file to read
+    :param mmap: whether to memory-map the arrays instead of reading them into memory
+    :return: netpyne NetParams and SimConfig objects (None if no simConfig was saved) for netpyne
+             models, a brian2 Network for brian2 models
+    '''
+
+    arrays, meta = read_arrays(path, mmap=mmap)
+    if (meta.get('snapshot_version') != SNAPSHOT_VERSION):
+        raise ValueError(path + " has snapshot version " + str(meta.get('snapshot_version')) + ", expected "
+                         + str(SNAPSHOT_VERSION))
+
+    if (meta['backend'] == 'netpyne'):
+        return _load_netpyne(arrays, meta)
+    return _load_brian2(arrays, meta)
+
+def _save_netpyne(networkParams, simConfig) -> tp.Tuple[tp.Dict[str, np.ndarray], tp.Dict]:
+    meta = {'backend': 'netpyne',
+            'cellParams': _plain(networkParams.cellParams),
+            'synMechParams': _plain(networkParams.synMechParams),
+            'stimSourceParams': _plain(networkParams.stimSourceParams),
+            'stimTargetParams': _plain(networkParams.stimTargetParams),
+            'simConfig': _plain(simConfig.todict()) if simConfig is not None else None,
+            'attributes': {name: _plain(getattr(networkParams, name))
+                           for name in ['cell_templates', 'pop_keys', 'mech_templates', 'template_report', 'morphology_report']
+                           if hasattr(networkParams, name)}}
+
+    # Populations
+    pop_names = list(networkParams.popParams.keys())
+    pop_ids = {name: p for p, name in enumerate(pop_names)}
+    cell_types = sorted({str(pop.get('cellType')) for pop in networkParams.popParams.values()})
+    cell_type_ids = {cell_type: c for c, cell_type in enumerate(cell_types)}
+    meta['pops'] = {'cell_types': cell_types,
+                    'params': {name: _plain(pop) for name, pop in networkParams.popParams.items()
+                               if set(pop.keys()) != {'cellType', 'numCells'}}}
+    arrays = {'pop_names': np.array(pop_names, dtype=str),
+              'pop_cell_type': np.array([cell_type_ids[str(pop.get('cellType'))] for pop in networkParams.popParams.values()],
+                                        dtype=np.int32),
+              'pop_size': np.array([pop.get('numCells', 0) for pop in networkParams.popParams.values()], dtype=np.int64)}
+
+    # Connectivity rules, with their connection lists concatenated
+    mechs = sorted(networkParams.synMechParams.keys())
+    mech_ids = {name: m for m, name in enumerate(mechs)}
+    names, pre_pop, post_pop, mech, weight, delay, has_list, ptr = [], [], [], [], [], [], [], [0]
+    list_pre, list_post, list_weight, list_delay = [], [], [], []
+    other = []
+    for position, (name, rule) in enumerate(networkParams.connParams.items()):
+        if not _conn_array_rule(rule, pop_ids, mech_ids):
+            other.append([position, name, _plain(rule)])
+            continue
+
+        names.append(name)
+        pre_pop.append(pop_ids[rule['preConds']['pop']])
+        post_pop.append(pop_ids[rule['postConds']['pop']])
+        mech.append(mech_ids[rule['synMech']])
+        has_list.append('connList' in rule)
+        if ('connList' in rule):
+            conns = np.asarray(rule['connList'], dtype=np.int64).reshape(-1, 2)
+            list_pre.append(conns[:, 0])
+            list_post.append(conns[:, 1])
+            list_weight.append(np.broadcast_to(np.asarray(rule.get('weight', np.nan), dtype=np.float64), len(conns)))
+            list_delay.append(np.broadcast_to(np.asarray(rule.get('delay', np.nan), dtype=np.float64), len(conns)))
+            ptr.append(ptr[-1] + len(conns))
+            weight.append(np.nan)
+            delay.append(np.nan)
+        else:
+            ptr.append(ptr[-1])
+            weight.append(rule.get('weight', np.nan))
+            delay.append(rule.get('delay', np.nan))
+    meta['conns'] = {'mechs': mechs, 'other': other}
+
+    empty = [np.zeros(0)]
+    arrays.update({'conn_names': np.array(names, dtype=str),
+                   'conn_pre_pop': np.array(pre_pop, dtype=np.int32),
+                   'conn_post_pop': np.array(post_pop, dtype=np.int32),
+                   'conn_mech': np.array(mech, dtype=np.int32),
+                   'conn_weight': np.array(weight, dtype=np.float64),
+                   'conn_delay': np.array(delay, dtype=np.float64),
+                   'conn_list': np.array(has_list, dtype=bool),
+                   'conn_ptr': np.array(ptr, dtype=np.int64),
+                   'list_pre': np.concatenate(list_pre + empty).astype(np.int32),
+                   'list_post': np.concatenate(list_post + empty).astype(np.int32),
+                   'list_weight': np.concatenate(list_weight + empty).astype(np.float64),
+                   'list_delay': np.concatenate(list_delay + empty).astype(np.float64)})
+
+    arrays.update(_save_neuron_names(networkParams))
+
+    return arrays, meta
+
+def _load_netpyne(arrays: tp.Dict[str, np.ndarray], meta: tp.Dict):
+    from netpyne.specs import SimConfig, netParams
+
+    networkParams = netParams.NetParams()
+    for name, cell in meta['cellParams'].items():
+        networkParams.cellParams[name] = cell
+    for name, mech in meta['synMechParams'].items():
+        networkParams.addSynMechParams(name, mech)
+    for name, source in meta['stimSourceParams'].items():
+        networkParams.addStimSourceParams(name, source)
+    for name, target in meta['stimTargetParams'].items():
+        networkParams.addStimTargetParams(name, target)
+
+    pop_names = arrays['pop_names'].tolist()
+    cell_types = meta['pops']['cell_types']
+    for name, cell_type, size in zip(pop_names, arrays['pop_cell_type'].tolist(), arrays['pop_size'].tolist()):
+        pop = meta['pops']['params'].get(name, {'cellType': cell_types[cell_type], 'numCells': size})
+        networkParams.popParams[name] = pop
+
+    # Rules stored as is go back to their original position
+    mechs = meta['conns']['mechs']
+    other = {position: (name, rule) for position, name, rule in meta['conns']['other']}
+    ptr = arrays['conn_ptr'].tolist()
+    rules = zip(arrays['conn_names'].tolist(), arrays['conn_pre_pop'].tolist(), arrays['conn_post_pop'].tolist(),
+                arrays['conn_mech'].tolist(), arrays['conn_weight'].tolist(), arrays['conn_delay'].tolist(),
+                arrays['conn_list'].tolist())
+    for c, (name, pre_pop, post_pop, mech, weight, delay, conn_list) in enumerate(rules):
+        while (len(networkParams.connParams) in other):
+            networkParams.addConnParams(*other.pop(len(networkParams.connParams)))
+
+        rule = {'preConds': {'pop': pop_names[pre_pop]},
+                'postConds': {'pop': pop_names[post_pop]},
+                'synMech': mechs[mech]}
+        if (conn_list):
+            start, stop = ptr[c], ptr[c + 1]
+            rule['connList'] = np.stack([arrays['list_pre'][start:stop], arrays['list_post'][start:stop]], axis=1).tolist()
+            rule['weight'] = arrays['list_weight'][start:stop].tolist()
+            rule['delay'] = arrays['list_delay'][start:stop].tolist()
+        else:
+            rule['weight'] = weight
+            rule['delay'] = delay
+        networkParams.addConnParams(name, {key: value for key, value in rule.items()
+                                           if not (isinstance(value, float) and np.isnan(value))})
+    for position in sorted(other.keys()):
+        networkParams.addConnParams(*other[position])
+
+    for name, value in meta['attributes'].items():
+        setattr(networkParams, name, value)
+    _load_neuron_names(networkParams, arrays, lambda pop, k: [pop, k])
+
+    simConfig = SimConfig(meta['simConfig']) if meta['simConfig'] is not None else None
+
+    return networkParams, simConfig
+
+def _save_brian2(networkParams) -> tp.Tuple[tp.Dict[str, np.ndarray], tp.Dict]:
+    from brian2 import NeuronGroup, SpikeGeneratorGroup, SpikeMonitor, StateMonitor, Synapses, defaultclock
+    from brian2.core.variables import ArrayVariable
+
+    if (getattr(networkParams, 'standalone', None) is not None):
+        raise ValueError("networks generated with execution='cpp_standalone' can't be saved")
+    if (len(getattr(networkParams, 'recording_monitors', [])) > 0):
+        raise ValueError("networks generated with a Recording can't be saved")
+
+    definitions = getattr(networkParams, 'definitions', {})
+    keys = {}
+    objects = []
+    arrays = {}
+
+    # Groups before the Synapses and monitors that refer to them
+    rank = {NeuronGroup: 0, SpikeGeneratorGroup: 0, Synapses: 1, StateMonitor: 2, SpikeMonitor: 2}
+    for obj in sorted(networkParams.objects, key=lambda obj: (rank.get(type(obj), 3), obj.name)):
+        if (type(obj) not in rank or (type(obj) in [NeuronGroup, Synapses] and obj.name not in definitions)):
+            raise ValueError(obj.name + " wasn't generated by model_gen(), and can't be saved")
+
+        spec = {'type': type(obj).__name__, 'name': obj.name}
+        if (type(obj) in [NeuronGroup, Synapses]):
+            definition = _encode(definitions[obj.name])
+            key = json.dumps(definition, sort_keys=True)
+            if key not in keys:
+                keys[key] = len(keys)
+            spec['definition'] = keys[key]
+
+            states = [name for name, var in obj.variables.items()
+                      if isinstance(var, ArrayVariable) and not var.read_only and not name.startswith('_')
+                      and getattr(var.owner, 'name', None) == obj.name]
+            spec['states'] = states
+            for name, value in obj.get_states(states, units=False).items():
+                arrays[obj.name + '/' + name] = np.asarray(value)
+
+        if (type(obj) == NeuronGroup):
+            spec['N'] = len(obj)
+        elif (type(obj) == SpikeGeneratorGroup):
+            # Surrogate neurons, see network_ir.SURROGATE
+            spec['N'] = len(obj)
+            arrays[obj.name + '/indices'] = np.asarray(obj.neuron_index[:], dtype=np.int32)
+            arrays[obj.name + '/times'] = np.asarray(obj.spike_time_[:])
+        elif (type(obj) == Synapses):
+            spec['source'] = obj.source.name
+            spec['target'] = obj.target.name
+            spec['pathways'] = [pathway.prepost for pathway in obj._pathways]
+            spec['attributes'] = {name: obj.__dict__[name] for name in SYNAPSE_ATTRIBUTES
+                                  if name in obj.__dict__ and name not in obj.variables}
+            arrays[obj.name + '/i'] = np.asarray(obj.i[:], dtype=np.int32)
+            arrays[obj.name + '/j'] = np.asarray(obj.j[:], dtype=np.int32)
+            for pathway in obj._pathways:
+                arrays[obj.name + '/delay_' + pathway.prepost] = np.asarray(pathway.variables['delay'].get_value())
+        elif (type(obj) == StateMonitor):
+            spec['source'] = obj.source.name
+            spec['variables'] = list(obj.record_variables)
+            spec['dt'] = None if obj.clock.name == defaultclock.name else float(obj.clock.dt_)
+            arrays[obj.name + '/record'] = np.asarray(obj.record, dtype=np.int32)
+        else:
+            spec['source'] = obj.source.name
+
+        objects.append(spec)
+
+    meta = {'backend': 'brian2',
+            'objects': objects,
+            'definitions': [json.loads(key) for key in keys.keys()]}
+    arrays.update(_save_neuron_names(networkParams))
+
+    return arrays, meta
+
+def _load_brian2(arrays: tp.Dict[str, np.ndarray], meta: tp.Dict):
+    from brian2 import Network, NeuronGroup, SpikeGeneratorGroup, SpikeMonitor, StateMonitor, Synapses, second
+
+    networkParams = Network()
+    networkParams.definitions = {}
+
+    objects = {}
+    for spec in meta['objects']:
+        name = spec['name']
+        if (spec['type'] in ['NeuronGroup', 'Synapses']):
+            definition = _decode(meta['definitions'][spec['definition']])
+            networkParams.definitions[name] = definition
+
+        if (spec['type'] == 'NeuronGroup'):
+            obj = NeuronGroup(spec['N'], name=name, **definition)
+        elif (spec['type'] == 'SpikeGeneratorGroup'):
+            obj = SpikeGeneratorGroup(spec['N'], np.asarray(arrays[name + '/indices']),
+                                      np.asarray(arrays[name + '/times']) * second, name=name)
+        elif (spec['type'] == 'Synapses'):
+            obj = Synapses(objects[spec['source']], objects[spec['target']], name=name, **definition)
+            obj.connect(i=np.asarray(arrays[name + '/i']), j=np.asarray(arrays[name + '/j']))
+            for prepost in spec['pathways']:
+                getattr(obj, prepost).delay = np.asarray(arrays[name + '/delay_' + prepost]) * second
+            for attribute, value in spec['attributes'].items():
+                obj.add_attribute(attribute)
+                setattr(obj, attribute, value)
+        elif (spec['type'] == 'StateMonitor'):
+            obj = StateMonitor(objects[spec['source']], spec['variables'], record=np.asarray(arrays[name + '/record']),
+                               name=name, **({'dt': spec['dt'] * second} if spec['dt'] is not None else {}))
+        else:
+            obj = SpikeMonitor(objects[spec['source']], name=name)
+
+        if (spec['type'] in ['NeuronGroup', 'Synapses']):
+            obj.set_states({state: np.asarray(arrays[name + '/' + state]) for state in spec['states']}, units=False)
+
+        objects[name] = obj
+        networkParams.add(obj)
+
+    _load_neuron_names(networkParams, arrays, lambda group, k: (group, k))
+
+    return networkParams
+
+def _save_neuron_names(networkParams) -> tp.Dict[str, np.ndarray]:
+    ''' neuron_names of a model as arrays, from which _load_neuron_names() rebuilds neuron_index too '''
+
+    neuron_names = getattr(networkParams, 'neuron_names', {})
+    return {'neuron_groups': np.array(list(neuron_names.keys()), dtype=str),
+            'neuron_group_size': np.array([len(names) for names in neuron_names.values()], dtype=np.int64),
+            'neuron_unames': np.array([uname for names in neuron_names.values() for uname in names], dtype=str)}
+
+def _load_neuron_names(networkParams, arrays: tp.Dict[str, np.ndarray], entry: tp.Callable):
+    networkParams.neuron_names = {}
+    networkParams.neuron_index = {}
+    unames = iter(arrays['neuron_unames'].tolist())
+    for group, size in zip(arrays['neuron_groups'].tolist(), arrays['neuron_group_size'].tolist()):
+        networkParams.neuron_names[group] = [next(unames) for _ in range(size)]
+        for k, uname in enumerate(networkParams.neuron_names[group]):
+            networkParams.neuron_index[uname] = networkParams.neuron_index[sanitize_name(uname)] = entry(group, k)
+
+def _conn_array_rule(rule: tp.Dict, pop_ids: tp.Dict[str, int], mech_ids: tp.Dict[str, int]) -> bool:
+    ''' Whether a connParams rule can be stored as arrays '''
+
+    if not (set(rule.keys()) <= CONN_KEYS and {'preConds', 'postConds', 'synMech'} <= set(rule.keys())):
+        return False
+    if not (set(rule['preConds'].keys()) == {'pop'} and set(rule['postConds'].keys()) == {'pop'}):
+        return False
+    if not (rule['preConds']['pop'] in pop_ids and rule['postConds']['pop'] in pop_ids and rule['synMech'] in mech_ids):
+        return False
+
+    n = len(rule['connList']) if 'connList' in rule else None
+    for key in ['weight', 'delay']:
+        value = rule.get(key, 0)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            continue
+        if (n is None or not isinstance(value, list) or len(value) != n):
+            return False
+
+    return True
+
+def _plain(value):
+    ''' Turn netpyne Dicts and numpy values nested in a value into plain JSON-serializable ones '''
+
+    return json.loads(json.dumps(value, default=lambda v: v.tolist() if isinstance(v, (np.ndarray, np.generic)) else dict(v)))
+
+def _encode(definition: tp.Dict) -> tp.Dict:
+    ''' Turn a brian2 definition into JSON, with Quantities stored as SI values and dimensions,
+    and Equations as their single equations. Their text can't be parsed back, since it writes
+    units as combinations of base units (V for volt). '''
+
+    from brian2 import Equations, Quantity
+
+    encoded = {}
+    for key, value in definition.items():
+        if isinstance(value, Quantity):
+            encoded[key] = {'quantity': np.asarray(value).tolist(), 'dim': list(value.dim._dims)}
+        elif isinstance(value, Equations):
+            # Expressions don't compare to None, their expr has to be checked with is
+            encoded[key] = {'equations': [{'type': eq.type, 'varname': eq.varname, 'dim': list(eq.dim._dims),
+                                           'var_type': eq.var_type,
+                                           'expr': None if eq.expr is None else str(eq.expr),
+                                           'flags': list(eq.flags)} for eq in value.ordered]}
+        else:
+            encoded[key] = value
+
+    return encoded
+
+def _decode(definition: tp.Dict) -> tp.Dict:
+    from brian2 import Equations, Quantity
+    from brian2.equations.codestrings import Expression
+    from brian2.equations.equations import SingleEquation
+    from brian2.units.fundamentalunits import get_or_create_dimension
+
+    decoded = {}
+    for key, value in definition.items():
+        if (isinstance(value, dict) and set(value.keys()) == {'quantity', 'dim'}):
+            decoded[key] = Quantity(value['quantity'], dim=get_or_create_dimension(value['dim']))
+        elif (isinstance(value, dict) and set(value.keys()) == {'equations'}):
+            decoded[key] = Equations([SingleEquation(eq['type'], eq['varname'], get_or_create_dimension(eq['dim']),
+                                                     var_type=eq['var_type'],
+                                                     expr=Expression(eq['expr']) if eq['expr'] != None else None,
+                                                     flags=eq['flags']) for eq in value['equations']])
+        else:
+            decoded[key] = value
+
+    return decoded
@@ -0,0 +1,143 @@
+import itertools
+import typing as tp
+
+from .analysis import SimulationResults
+from .profiling import Profiler
+
+def grid(axes: tp.Dict[str, tp.Sequence]) -> tp.List[tp.Dict]:
+    ''' Every combination of parameter values, as a list of sweep points
+
+    :param axes: dictionary of parameters and the values to sweep each over, e.g.
+                 {'synapses_0.w': [0.5, 1, 2], 'bkg.rate': [5, 10]}
+    '''
+
+    names = list(axes.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(axes[name] for name in names))]
+
+def sweep(networkParams,
+          points: tp.List[tp.Dict],
+          simConfig=None,
+          t: float=None,
+          internal_vars: tp.Dict=None,
+          profiler: Profiler=None) -> tp.Iterator[tp.Tuple[tp.Dict, SimulationResults]]:
+    ''' Simulate a network once per parameter point, building it only once
+
+    .. note::
+
+        Networks of either backend, as generated by their model_gen(), are swept in place, and
+        the results of every point are yielded as soon as it has run, in the order of points.
+
+        Brian2 networks are stored before the first point and restored before every other
+        one, so every point starts from the same initial state. Points are keyed by
+        '<object name>.<variable>' (see nlptoBrian2.simulate()), with a scalar or an array of
+        values per neuron or synapse; keys without a dot replace entries of internal_vars.
+        Networks generated with execution='cpp_standalone' are run with the points as run_args
+        instead, rebuilding nothing.
+
+        NetPyNE networks are created once, and every point changes the NEURON objects in place
+        before running again. Points are keyed by '<label>.<parameter>' with a scalar value,
+        where label is a connParams rule ('weight' or 'delay' of its connections), a stimulation
+        source ('rate' or 'noise' of its NetStims, or 'weight' or 'delay' of their
+        connections), or '*' for every synaptic connection.
+
+    :param networkParams: network to sweep, as generated by either backend's model_gen()
+    :param points: list of parameter points, see grid()
+    :param simConfig: netpyne SimConfig object, for netpyne networks
+    :param t: duration of every simulation in ms, for brian2 networks
+    :param internal_vars: predefined network variables, for brian2 networks
+    :param profiler: Profiler to record the 'create', 'run' and 'analysis' phases of the sweep in
+    '''
+
+    if profiler == None: profiler = Profiler(enabled=False)
+
+    if hasattr(networkParams, 'popParams'):
+        return _sweep_netpyne(networkParams, simConfig, points, profiler)
+    return _sweep_brian2(networkParams, t, internal_vars, points, profiler)
+
+def _sweep_brian2(networkParams, t: float, internal_vars: tp.Dict, points: tp.List[tp.Dict], profiler: Profiler):
+    from brian2 import ms
+    from .nlptoBrian2 import _run_args, simulate, simulation_results
+
+    if internal_vars == None: internal_vars = {}
+
+    if (getattr(networkParams, 'standalone', None) != None):
+        for point in points:
+            yield point, simulate(networkParams, t, internal_vars, profiler=profiler, headless=True, run_args=point)
+        return
+
+    with profiler.phase('create'):
+        networkParams.store('sweep')
+
+    for point in points:
+        namespace = dict(internal_vars)
+        with profiler.phase('run'):
+            networkParams.restore('sweep')
+            variables = {key: value for key, value in point.items() if '.' in key}
+            for variable, value in _run_args(networkParams, variables).items():
+                variable[:] = value
+            namespace.update({key: value for key, value in point.items() if '.' not in key})
+
+            networkParams.run(t*ms, namespace=namespace)
+
+        with profiler.phase('analysis'):
+            results = simulation_results(networkParams)
+
+        yield point, results
+
+def _sweep_netpyne(networkParams, simConfig, points: tp.List[tp.Dict], profiler: Profiler):
+    from netpyne import sim
+    from .nlpToNetpyne import simulation_results
+
+    with profiler.phase('create'):
+        sim.create(netParams=networkParams, simConfig=simConfig)
+
+    for point in points:
+        with profiler.phase('run'):
+            for key, value in point.items():
+                label, parameter = key.rsplit('.', 1)
+                _set_netpyne(sim, label, parameter, value)
+
+            # Spikes are appended to the same vectors by every run, traces are reset by NEURON
+            sim.simData['spkt'].resize(0)
+            sim.simData['spkid'].resize(0)
+            sim.runSim()
+            sim.gatherData()
+
+        with profiler.phase('analysis'):
+            results = simulation_results(networkParams)
+
+        yield point, results
+
+def _set_netpyne(sim, label: str, parameter: str, value: float):
+    ''' Set a parameter of every NEURON object created for a connParams rule or stimulation source '''
+
+    found = False
+    for cell in sim.net.cells:
+        for conn in cell.conns:
+            stim = conn['preGid'] == 'NetStim'
+            if not (conn.get('label') == label or (stim and conn.get('preLabel') == label) or (label == '*' and not stim)):
+                continue
+
+            if (parameter == 'weight'):
+                conn['hObj'].weight[0] = conn['weight'] = value
+            elif (parameter == 'delay'):
+                conn['hObj'].delay = conn['delay'] = value
+            else:
+                continue
+            found = True
+
+        for stim in cell.stims:
+            if (stim.get('source') != label or stim.get('type') != 'NetStim'):
+                continue
+
+            if (parameter == 'rate'):
+                stim['hObj'].interval = 1000.0 / value if value > 0 else 1e9
+                stim['rate'] = value
+            elif (parameter == 'noise'):
+                stim['hObj'].noise = stim['noise'] = value
+            else:
+                continue
+            found = True
+
+    if not found:
+        raise KeyError("nothing in the network has a '" + parameter + "' labelled '" + label + "'")
@@ -0,0 +1,126 @@
+import os.path
+import sys
+
+import numpy as np
+import pytest
+
+# The package and the benchmarks are imported from the root of the repository, like the
+# benchmarks themselves do
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks import models
+from benchmarks.fake_client import FakeQueryResult
+from benchmarks.synthetic import medulla_like
+from src.NeuroNLP_to_Brian_Netpyne.network_ir import network_from_query
+
+# Neurons of column A of the synthetic medulla that the simulator tests stimulate and record
+STIM = ['L1-A', 'L2-A', 'Mi4-A']
+RECORD = ['L1-A', 'Mi4-A', 'T1-A']
+
+# A Brian2 source without random numbers, so that runs are reproducible without seeding
+BRIAN2_STIM_SOURCES = {'bkg': {'model': 'dx/dt = 1/(10*ms) : 1', 'threshold': 'x>1', 'reset': 'x=0'}}
+
+@pytest.fixture(scope='session')
+def medulla():
+    ''' Client and query of a synthetic medulla of 4 columns of 28 neurons '''
+
+    return medulla_like(112, seed=3, synapses_per_neuron=6)
+
+@pytest.fixture
+def network(medulla):
+    client, query = medulla
+    return network_from_query(client, client.executeNLPquery(query),
+                              stims=models.stims('brian2', ['L1-A', 'L2-B', 'Mi4-C']),
+                              record_names=['L1-A', 'Mi4-B', 'L2-C'])
+
+@pytest.fixture
+def columns(medulla):
+    ''' Query result of the neurons of some columns of the synthetic medulla '''
+
+    client, query = medulla
+    G = client.executeNLPquery(query).graph
+
+    def query_columns(names):
+        nodes = [n for n, d in G.nodes(data=True) if d['uname'].split('-')[1] in names]
+        return FakeQueryResult(G.subgraph(nodes).copy(), {}, {})
+
+    return query_columns
+
+@pytest.fixture
+def synapses():
+    ''' Every synapse of a network by unames, independent of neuron and synapse order '''
+
+    return _synapses
+
+def _synapses(network):
+    pre = network.synapse_pre()
+    return sorted(zip(network.unames[pre].tolist(), network.unames[network.syn_post].tolist(),
+                      [network.mechs[m] for m in network.syn_mech.tolist()], network.syn_count.tolist(),
+                      np.round(network.syn_weight, 9).tolist()))
+
+@pytest.fixture
+def column(medulla, columns):
+    ''' Network of column A of the synthetic medulla, stimulated and recorded for a backend '''
+
+    client, _ = medulla
+
+    def column_network(backend, **kwargs):
+        return network_from_query(client, columns(['A']), stims=models.stims(backend, STIM), record_names=RECORD,
+                                  **kwargs)
+
+    return column_network
+
+@pytest.fixture
+def netpyne_model(tmp_path):
+    ''' Build a headless netpyne model of a network, with the cells and synapses of the benchmarks '''
+
+    pytest.importorskip('netpyne')
+    from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+    def model(network, **kwargs):
+        kwargs = {'default_mech': models.NETPYNE_DEFAULT_MECH,
+                  'default_cell': models.NETPYNE_DEFAULT_CELL,
+                  'stim_sources': models.NETPYNE_STIM_SOURCES,
+                  'record_names': RECORD,
+                  'sim_duration': 100,
+                  'vectorized': True,
+                  'headless': True,
+                  **kwargs}
+        return nlpToNetpyne.model_gen(None, None, str(tmp_path / 'netpyne'), network=network, **kwargs)
+
+    return model
+
+@pytest.fixture
+def brian2_model():
+    ''' Build a brian2 model of a network, with the cells and synapses of the benchmarks, using
+    NumPy code generation so nothing has to be compiled '''
+
+    brian2 = pytest.importorskip('brian2')
+    from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+
+    target = brian2.prefs.codegen.target
+    brian2.prefs.codegen.target = 'numpy'
+
+    def model(network, **kwargs):
+        kwargs = {'default_mech': models.BRIAN2_DEFAULT_MECH,
+                  'default_cell': models.BRIAN2_DEFAULT_CELL,
+                  'stim_sources': BRIAN2_STIM_SOURCES,
+                  'record_names': RECORD,
+                  'vectorized': True,
+                  'record_spikes': True,
+                  **kwargs}
+        return nlptoBrian2.model_gen(None, None, network=network, **kwargs)
+
+    yield model
+    brian2.prefs.codegen.target = target
+
+@pytest.fixture
+def spikes():
+    ''' Every spike of some results by uname, independent of neuron order '''
+
+    return _spikes
+
+def _spikes(results):
+    return sorted(zip(results.names[results.spike_neurons].tolist(), np.round(results.spike_times, 6).tolist()))
@@ -0,0 +1,59 @@
+import os
+import signal
+import time
+
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.analysis import SimulationResults
+from src.NeuroNLP_to_Brian_Netpyne.batch import run_batch
+
+class _Client:
+    ''' Client whose queries hang or kill the process asking them, to make batch jobs fail '''
+
+    def executeNLPquery(self, query: str):
+        if (query == 'hang'):
+            time.sleep(3600)
+        os.kill(os.getpid(), signal.SIGKILL)
+
+def _client():
+    return _Client()
+
+def test_run_batch(column, spikes, tmp_path):
+    pytest.importorskip('netpyne')
+    from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+    network = column('netpyne')
+    model = {'default_mech': models.NETPYNE_DEFAULT_MECH,
+             'default_cell': models.NETPYNE_DEFAULT_CELL,
+             'stim_sources': models.NETPYNE_STIM_SOURCES,
+             'sim_duration': 50,
+             'vectorized': True}
+    jobs = [{'backend': 'netpyne', 'network': network, 'model': model, 'label': 'network'},
+            {'backend': 'netpyne', 'query': 'die', 'model': model, 'label': 'killed'},
+            {'backend': 'nest', 'network': network, 'label': 'unknown backend'},
+            {'backend': 'netpyne', 'network': network, 'model': model, 'output': str(tmp_path / 'results.npz'),
+             'label': 'output'}]
+    results = {result['label']: result for result in run_batch(jobs, client_factory=_client, max_workers=2)}
+
+    assert sorted(result['index'] for result in results.values()) == [0, 1, 2, 3]
+    assert results['network']['error'] is None
+    assert len(results['network']['results'].spike_times) > 0
+    assert 'exit code' in results['killed']['error']
+    assert "backend must be 'netpyne' or 'brian2'" in results['unknown backend']['error']
+    assert results['output']['error'] is None and results['output']['results'] is None
+
+    expected = nlpToNetpyne.simulate(*nlpToNetpyne.model_gen(None, None, str(tmp_path / 'netpyne'), network=network,
+                                                             headless=True, **model), headless=True)
+    assert spikes(results['network']['results']) == spikes(expected)
+    assert spikes(SimulationResults.load(str(tmp_path / 'results.npz'))) == spikes(expected)
+
+def test_run_batch_timeout():
+    jobs = [{'backend': 'netpyne', 'query': 'hang', 'label': 'hang'}]
+
+    start = time.perf_counter()
+    results = list(run_batch(jobs, client_factory=_client, timeout=3))
+    assert time.perf_counter() - start < 10
+    assert len(results) == 1
+    assert results[0]['error'] == 'timed out after 3 s'
+    assert results[0]['results'] is None
@@ -0,0 +1,66 @@
+import time
+
+from benchmarks.fake_client import FakeClient
+from src.NeuroNLP_to_Brian_Netpyne.cache import QueryCache, execute_query
+from src.NeuroNLP_to_Brian_Netpyne.network_ir import network_from_query
+
+class CountingClient(FakeClient):
+    ''' FakeClient that also counts the queries it answers '''
+
+    def __init__(self, client: FakeClient):
+        super().__init__(client.queries, client.connectivity)
+        self.queries_run = 0
+
+    def executeNLPquery(self, query: str):
+        self.queries_run += 1
+        return super().executeNLPquery(query)
+
+def _build(client, query, cache):
+    return network_from_query(client, execute_query(client, query, cache), cache=cache)
+
+def test_warm_build(medulla, tmp_path):
+    medulla_client, query = medulla
+    path = str(tmp_path / 'cache.sqlite')
+
+    cold = CountingClient(medulla_client)
+    with QueryCache(path, dataset_version='1') as cache:
+        network = _build(cold, query, cache)
+    assert cold.queries_run == 1 and cold.calls == network.n_neurons
+
+    # A new cache on the same file, as in a new session
+    warm = CountingClient(medulla_client)
+    with QueryCache(path, dataset_version='1') as cache:
+        assert _build(warm, query, cache).digest() == network.digest()
+    assert warm.queries_run == 0 and warm.calls == 0
+
+def test_dataset_version(medulla, tmp_path):
+    client, query = medulla
+    path = str(tmp_path / 'cache.sqlite')
+    with QueryCache(path, dataset_version='1') as cache:
+        _build(client, query, cache)
+        assert cache.get_query(query) is not None
+
+    with QueryCache(path, dataset_version='2') as cache:
+        assert cache.get_query(query) is None
+        assert cache.size() == 0
+
+        counting = CountingClient(client)
+        _build(counting, query, cache)
+        assert counting.queries_run == 1 and counting.calls > 0
+
+def test_lru_eviction(tmp_path):
+    entry = {'pre': {'details': [{'syn_rid': str(i), 'syn_uname': 'a--b'} for i in range(50)]}}
+    with QueryCache(str(tmp_path / 'cache.sqlite'), compression=0) as cache:
+        cache.put_connectivity({'first': entry})
+        cache.max_bytes = 3 * cache.size()
+
+        for rid in ['second', 'third', 'fourth', 'fifth']:
+            time.sleep(0.01)
+            # Keep the first entry in use, so older ones are evicted instead
+            assert 'first' in cache.get_connectivity(['first'])
+            time.sleep(0.01)
+            cache.put_connectivity({rid: entry})
+            assert cache.size() <= cache.max_bytes
+
+        assert sorted(cache.get_connectivity(['first', 'second', 'third', 'fourth', 'fifth']).keys()) == \
+            ['fifth', 'first', 'fourth']
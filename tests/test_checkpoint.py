@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.checkpoint import Checkpoint, resume
+
+def _assert_traces(results, expected):
+    assert len(expected.trace_neurons) > 0
+    assert sorted(results.names[results.trace_neurons].tolist()) == sorted(expected.names[expected.trace_neurons].tolist())
+    rows = np.argsort(results.names[results.trace_neurons])
+    expected_rows = np.argsort(expected.names[expected.trace_neurons])
+    np.testing.assert_allclose(results.t, expected.t)
+    np.testing.assert_allclose(results.traces['v'][rows], expected.traces['v'][expected_rows], atol=1e-6)
+
+def test_brian2_resume(column, brian2_model, spikes, tmp_path):
+    from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+
+    network = column('brian2')
+    namespace = models.brian2_namespace()
+    expected = nlptoBrian2.simulate(brian2_model(network), 40, namespace, headless=True)
+
+    # A run that stops after its second checkpoint, resumed in a network rebuilt from the checkpoint
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'), every=10)
+    nlptoBrian2.simulate(brian2_model(network), 20, namespace, headless=True, checkpoint=checkpoint)
+    assert checkpoint.t == pytest.approx(20)
+    _, results = resume(str(tmp_path / 'checkpoint'), duration=40, internal_vars=namespace)
+
+    assert (expected.spike_times > 20).any()
+    assert checkpoint.t == pytest.approx(40)
+    assert spikes(results) == spikes(expected)
+    _assert_traces(results, expected)
+
+def test_netpyne_resume(column, netpyne_model, spikes, tmp_path):
+    from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+    network = column('netpyne')
+    expected = nlpToNetpyne.simulate(*netpyne_model(network, sim_duration=40), headless=True)
+
+    # The column is silent after its second wave of spikes, so the run is interrupted before it
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'), every=5)
+    nlpToNetpyne.simulate(*netpyne_model(network, sim_duration=10), headless=True, checkpoint=checkpoint)
+    assert checkpoint.t == pytest.approx(10)
+    _, results = resume(str(tmp_path / 'checkpoint'), duration=40)
+
+    assert (expected.spike_times > 10).any()
+    assert checkpoint.t == pytest.approx(40)
+    assert spikes(results) == spikes(expected)
+    _assert_traces(results, expected)
@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+
+from src.NeuroNLP_to_Brian_Netpyne.analysis import SimulationResults
+from src.NeuroNLP_to_Brian_Netpyne.comparison import compare_results, format_comparison, match_spikes, trace_errors
+
+NAMES = np.array(['L1-A', 'L2-A', 'Mi4-A', 'T1-A'])
+
+def _results(names=NAMES, shift=0.0, offset=0.0, dt=0.1):
+    ''' 100 ms of results where L1-A spikes every 10 ms, L2-A every 25 ms, Mi4-A twice and T1-A
+    never, and the first three are recorded '''
+
+    trains = {'L1-A': np.arange(5, 100, 10), 'L2-A': np.arange(12, 100, 25), 'Mi4-A': np.array([30.0, 70.0])}
+    index = {name: i for i, name in enumerate(names.tolist())}
+    spike_neurons = np.concatenate([np.full(len(train), index[name]) for name, train in trains.items()])
+    spike_times = np.concatenate(list(trains.values())) + shift
+
+    t = np.arange(0, 100, dt)
+    recorded = ['L1-A', 'L2-A', 'Mi4-A']
+    traces = np.array([-65 + 10 * np.sin(t / (5 + i)) for i in range(len(recorded))]) + offset
+
+    return SimulationResults(names, spike_times, spike_neurons, t=t, traces={'v': traces},
+                             trace_neurons=np.array([index[name] for name in recorded]), duration=100.0)
+
+def test_identical():
+    spikes = match_spikes(_results(), _results())
+
+    assert spikes['names'].tolist() == sorted(NAMES.tolist())
+    silent = spikes['names'] == 'T1-A'
+    np.testing.assert_allclose(spikes['coincidence'][~silent], 1.0)
+    assert np.isnan(spikes['coincidence'][silent]).all()
+    assert (spikes['matched_a'] == spikes['spikes_a']).all()
+    assert (spikes['matched_b'] == spikes['spikes_b']).all()
+    np.testing.assert_allclose(spikes['mean_offset'][~silent], 0.0)
+
+    errors = trace_errors(_results(), _results())
+    assert errors['names'].tolist() == ['L1-A', 'L2-A', 'Mi4-A']
+    np.testing.assert_allclose(errors['rmse'], 0.0)
+    np.testing.assert_allclose(errors['max_abs'], 0.0)
+    np.testing.assert_allclose(errors['correlation'], 1.0)
+
+def test_neuron_order():
+    # Neurons are matched by uname, whatever their index in either simulation
+    spikes = match_spikes(_results(), _results(names=NAMES[::-1]))
+
+    assert (spikes['spikes_a'] == spikes['spikes_b']).all()
+    assert (spikes['matched_a'] == spikes['spikes_a']).all()
+    assert np.nanmin(spikes['coincidence']) == 1.0
+
+def test_window():
+    within = match_spikes(_results(), _results(shift=0.5), window=1.0)
+    outside = match_spikes(_results(), _results(shift=2.0), window=1.0)
+
+    spiking = within['spikes_a'] > 0
+    assert (within['matched_a'] == within['spikes_a']).all()
+    np.testing.assert_allclose(within['mean_offset'][spiking], 0.5)
+    assert (outside['matched_a'] == 0).all()
+    assert (outside['coincidence'][spiking] < 0).all()
+
+def test_trace_errors():
+    # Traces are compared on the coarser sampling of the two
+    errors = trace_errors(_results(), _results(offset=2.0, dt=0.2))
+
+    np.testing.assert_allclose(errors['rmse'], 2.0)
+    np.testing.assert_allclose(errors['max_abs'], 2.0)
+    np.testing.assert_allclose(errors['correlation'], 1.0)
+
+def test_compare_results():
+    report = compare_results(_results(), _results(shift=0.5), labels=('a', 'b'))
+
+    assert report['neurons'] == len(NAMES)
+    assert report['simulations']['a']['spikes'] == report['simulations']['b']['spikes'] == 16
+    assert report['simulations']['a']['matched'] == 1.0
+    assert report['rates']['max_abs_difference_hz'] == 0.0
+    assert abs(report['spike_matching']['mean_offset_ms'] - 0.5) < 1e-9
+    assert report['traces']['neurons'] == 3
+
+    # Reports are plain numbers that can be written to JSON and printed
+    json.dumps(report)
+    table = format_comparison(report)
+    assert table.splitlines()[0].split() == ['a', 'b']
+    assert 'coincidence' in table
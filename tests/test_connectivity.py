@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.fake_client import FakeClient
+from src.NeuroNLP_to_Brian_Netpyne.connectivity import fetch_connectivity, fetch_synapse_table, morphology_rids
+
+class FlakyClient(FakeClient):
+    ''' FakeClient that fails the first lookups of every rid, like a flaky server '''
+
+    def __init__(self, client: FakeClient, failures: int=0, latency: float=0):
+        super().__init__(client.queries, client.connectivity, latency=latency)
+        self.failures = failures
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def getInfo(self, rid: str):
+        with self.lock:
+            failed = self.failed.get(rid, 0)
+            self.failed[rid] = failed + 1
+        if (failed < self.failures):
+            self.calls += 1
+            raise ConnectionError('lookup of ' + rid + ' failed')
+        return super().getInfo(rid)
+
+@pytest.fixture
+def graph(medulla):
+    client, query = medulla
+    return client.executeNLPquery(query).graph
+
+def test_fetch_synapse_table(medulla, graph):
+    client, _ = medulla
+    rids = list(morphology_rids(graph).keys())
+    serial = fetch_synapse_table(client, graph, connectivity={rid: client.getInfo(rid)['data']['connectivity']
+                                                              for rid in rids})
+
+    flaky = FlakyClient(client, failures=2, latency=0.001)
+    table = fetch_synapse_table(flaky, graph, max_workers=8, retries=2, backoff=0.001)
+
+    assert table == serial
+    assert len(table) > 0
+    assert sorted(flaky.failed.keys()) == sorted(rids)
+    assert all(attempts == 3 for attempts in flaky.failed.values())
+
+def test_fetch_connectivity_retries_exhausted(medulla, graph):
+    client, _ = medulla
+    rids = list(morphology_rids(graph).keys())[:10]
+
+    with pytest.raises(ConnectionError):
+        fetch_connectivity(FlakyClient(client, failures=3), rids, retries=2, backoff=0.001)
+
+def test_fetch_connectivity_timeout(medulla, graph):
+    client, _ = medulla
+    rids = list(morphology_rids(graph).keys())[:16]
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        fetch_connectivity(FlakyClient(client, latency=1.0), rids, max_workers=2, timeout=0.2)
+    assert time.monotonic() - start < 0.6
+
+def test_fetch_connectivity_deadline(medulla, graph):
+    client, _ = medulla
+    rids = list(morphology_rids(graph).keys())[:4]
+
+    # Retrying after the backoff would go past the deadline, so the failure is raised right away
+    start = time.monotonic()
+    with pytest.raises(ConnectionError):
+        fetch_connectivity(FlakyClient(client, failures=1), rids, retries=2, backoff=5.0, timeout=1.0)
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,47 @@
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.incremental import grow_network
+from src.NeuroNLP_to_Brian_Netpyne.network_ir import aggregate_synapses, network_from_query
+
+STIMS = models.stims('brian2', ['L1-A', 'L2-C'])
+RECORD = ['L1-A', 'Mi4-C']
+
+def test_grow_network(medulla, columns, synapses):
+    client, _ = medulla
+    network = network_from_query(client, columns(['C']), stims=STIMS, record_names=RECORD)
+    grown, changes = grow_network(network, client, columns(['A', 'C']), stims=STIMS, record_names=RECORD)
+    rebuilt = network_from_query(client, columns(['A', 'C']), stims=STIMS, record_names=RECORD)
+
+    assert synapses(grown) == synapses(rebuilt)
+    assert grown.unames[:network.n_neurons].tolist() == network.unames.tolist()
+    assert sorted(grown.unames[grown.record].tolist()) == sorted(rebuilt.unames[rebuilt.record].tolist())
+    assert sorted((stim['source'], grown.unames[stim['target']]) for stim in grown.stims) == \
+        sorted((stim['source'], rebuilt.unames[stim['target']]) for stim in rebuilt.stims)
+    assert changes['first_neuron'] == network.n_neurons
+    assert changes['added_synapses'] == grown.n_synapses - network.n_synapses
+    assert changes['added_stims'] == 1 and changes['added_records'] == 1
+
+@pytest.mark.parametrize('weight', ['linear', 'sqrt'])
+def test_grow_aggregated_network(medulla, columns, synapses, weight):
+    client, _ = medulla
+    network = aggregate_synapses(network_from_query(client, columns(['C'])), weight)[0]
+    grown = grow_network(network, client, columns(['A', 'B', 'C']))[0]
+    rebuilt = aggregate_synapses(network_from_query(client, columns(['A', 'B', 'C'])), weight)[0]
+
+    assert synapses(grown) == synapses(rebuilt)
+    assert grown.aggregation == weight
+
+def test_grow_network_aggregate(medulla, columns, synapses):
+    client, _ = medulla
+    network = network_from_query(client, columns(['C']))
+    grown = grow_network(network, client, columns(['A', 'C']), aggregate='log')[0]
+
+    assert synapses(grown) == synapses(aggregate_synapses(network_from_query(client, columns(['A', 'C'])), 'log')[0])
+
+def test_grow_network_removed_neurons(medulla, columns):
+    client, _ = medulla
+    network = network_from_query(client, columns(['A', 'C']))
+
+    with pytest.raises(ValueError):
+        grow_network(network, client, columns(['A']))
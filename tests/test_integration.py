@@ -0,0 +1,37 @@
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.integration import calibrate, format_calibration
+
+def test_netpyne_calibrate(column, netpyne_model):
+    networkParams, simConfig = netpyne_model(column('netpyne'))
+    dt = simConfig.dt
+    # Spikes shifted by a fraction of a step make errors of a few mV at their peaks
+    report = calibrate(networkParams, [{'dt': 0.025}, {'dt': 0.1}, {'dt': 1.0}], 30, tolerance=5.0,
+                       simConfig=simConfig)
+
+    assert report['reference'] == {'dt': 0.025 / 4}
+    fine, coarse, coarsest = report['probes']
+    assert fine['accurate'] and not coarse['accurate'] and not coarsest['accurate']
+    assert fine['comparison']['simulations']['reference']['spikes'] > 0
+    assert report['best'] == {'dt': 0.025}
+    assert simConfig.dt == dt and simConfig.duration == 100
+
+def test_brian2_calibrate(column, brian2_model):
+    from brian2 import defaultclock, ms
+
+    model = brian2_model(column('brian2'))
+    dt = defaultclock.dt
+    # The stimulated neurons spike every 10 ms, so traces differ a lot at the peaks of slightly
+    # shifted spikes: strategies are told apart by their spikes only
+    report = calibrate(model, [{'dt': 0.01}, {'dt': 0.05}, {'method': 'exact'}], 30, tolerance=float('inf'),
+                       internal_vars=models.brian2_namespace())
+
+    fine, coarse, exact = report['probes']
+    assert fine['accurate'] and not coarse['accurate']
+    # The Hodgkin-Huxley equations aren't linear, so they can't be integrated exactly
+    assert 'error' in exact
+    assert report['best'] == {'dt': 0.01}
+    assert 'failed' in format_calibration(report)
+
+    # The network is left as it was
+    assert defaultclock.dt == dt
+    assert float(model.t / ms) == 0
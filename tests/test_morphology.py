@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from src.NeuroNLP_to_Brian_Netpyne.morphology import reduce_morphology
+
+def _swc(points):
+    ''' SWC array of (identifier, x, y, z, parent) rows, samples numbered from 1 '''
+
+    return np.array([[i + 1, identifier, x, y, z, 0.5, parent]
+                     for i, (identifier, x, y, z, parent) in enumerate(points)], dtype=np.float64)
+
+def _segments(arrays):
+    row = {int(sample): i for i, sample in enumerate(arrays[:, 0])}
+    return np.array([np.linalg.norm(arrays[i, 2:5] - arrays[row[int(parent)], 2:5])
+                     for i, parent in enumerate(arrays[:, 6]) if parent >= 0])
+
+def _branched():
+    ''' A soma with a dendrite that turns from basal into apical, forks and has a long last segment '''
+
+    points = [(1, 0, 0, 0, -1)]
+    points += [(3 if k < 6 else 4, 15 * k, 0, 0, k) for k in range(1, 11)]
+    # Two branches off sample 11 (x=150)
+    points += [(4, 150, 15 * k, 0, 11 if k == 1 else 11 + k - 1) for k in range(1, 6)]
+    points += [(4, 150, -15 * k, 0, 11 if k == 1 else 16 + k - 1) for k in range(1, 4)]
+    points += [(4, 150, -125, 0, 19)]
+    return _swc(points)
+
+def test_reduce_straight():
+    straight = _swc([(3, 15 * k, 0, 0, k) for k in range(11)])
+    straight[0, 6] = -1
+
+    assert np.allclose(_segments(reduce_morphology(straight, max_length=20)[0]), 15)
+    assert np.allclose(_segments(reduce_morphology(straight, max_length=45)[0]), [45, 45, 45, 15])
+    assert np.allclose(_segments(reduce_morphology(straight)[0]), [150])
+
+@pytest.mark.parametrize('max_length', [20, 35, 60, 1000])
+def test_reduce_branched(max_length):
+    arrays = _branched()
+    reduced, report = reduce_morphology(arrays, max_length=max_length)
+
+    # Only the last segment, 80 um on its own, may be longer than max_length
+    segments = _segments(reduced)
+    assert np.all((segments <= max_length + 1e-9) | np.isclose(segments, 80))
+    assert np.isclose(segments.sum(), _segments(arrays).sum())
+    assert report['samples_after'] == len(reduced) and report['pruned'] == 0
+
+    # The root, the branch point, the tips and the sample where basal turns into apical survive
+    kept = {tuple(xyz) for xyz in reduced[:, 2:5].tolist()}
+    assert {(0, 0, 0), (150, 0, 0), (150, 75, 0), (150, -125, 0), (75, 0, 0), (90, 0, 0)} <= kept
+    identifiers = {tuple(sample[2:5]): sample[1] for sample in arrays.tolist()}
+    assert all(identifiers[tuple(sample[2:5])] == sample[1] for sample in reduced.tolist())
+
+def test_reduce_electrotonic():
+    arrays = _branched()
+    reduced = reduce_morphology(arrays, max_electrotonic=0.05)[0]
+    # Length constant of the 1 um thick samples, in um, with the default Ra and g_pas
+    lam = np.sqrt((1 / 0.0000357) * 1e-4 / (4 * 35.4)) * 1e4
+
+    segments = _segments(reduced)
+    assert np.all((segments <= 0.05 * lam + 1e-9) | np.isclose(segments, 80))
+    assert len(reduced) < len(arrays)
+
+def test_prune():
+    arrays = _swc([(1, 0, 0, 0, -1), (3, 10, 0, 0, 1), (3, 20, 0, 0, 2), (3, 20, 5, 0, 3), (3, 30, 0, 0, 3),
+                   (3, 40, 0, 0, 5)])
+    reduced, report = reduce_morphology(arrays, min_branch_length=10)
+
+    assert report['pruned'] == 1
+    assert (20, 5, 0) not in {tuple(xyz) for xyz in reduced[:, 2:5].tolist()}
@@ -0,0 +1,78 @@
+import itertools
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+from src.NeuroNLP_to_Brian_Netpyne.mpi import POINT_CELL_COST, balance, cell_loads, simulate_mpi
+from src.NeuroNLP_to_Brian_Netpyne.partition import extract_partition, partition_network
+
+def _placed(placement, loads):
+    ''' Cost of every rank of a placement, checking that every cell is placed exactly once '''
+
+    ranks = len(next(iter(placement.values())))
+    totals = np.zeros(ranks)
+    for pop, cost in loads.items():
+        cells = sorted(cell for rank in placement[pop] for cell in rank)
+        assert cells == list(range(len(cost)))
+        for rank, rank_cells in enumerate(placement[pop]):
+            totals[rank] += cost[rank_cells].sum()
+    return totals
+
+@pytest.mark.parametrize('seed', range(5))
+def test_balance(seed):
+    rng = np.random.default_rng(seed)
+    loads = {'a': rng.uniform(1, 10, 4), 'b': rng.uniform(1, 30, 3), 'c': rng.uniform(1, 5, 2)}
+    ranks = 3
+    placement, totals = balance(loads, ranks)
+
+    assert np.allclose(_placed(placement, loads), totals)
+
+    # Longest processing time first stays within 4/3 of the best placement, found by brute force
+    costs = np.concatenate(list(loads.values()))
+    best = min(np.bincount(assignment, weights=costs, minlength=ranks).max()
+               for assignment in itertools.product(range(ranks), repeat=len(costs)))
+    assert totals.max() <= (4 / 3 - 1 / (3 * ranks)) * best + 1e-9
+
+def test_balance_many_cells():
+    rng = np.random.default_rng(0)
+    loads = {str(p): rng.uniform(1, 20, rng.integers(1, 200)) for p in range(50)}
+    placement, totals = balance(loads, 7)
+
+    costs = np.concatenate(list(loads.values()))
+    assert np.allclose(_placed(placement, loads), totals)
+    assert totals.max() <= costs.sum() / 7 + costs.max()
+    assert totals.max() / totals.mean() < 1.05
+
+def test_cell_loads(column, netpyne_model):
+    network = column('netpyne')
+    vectorized = cell_loads(netpyne_model(network)[0])
+    legacy = cell_loads(netpyne_model(network, vectorized=False)[0])
+
+    # One compartment per cell, and a synapse cost per connection and stimulation either way
+    assert sum(len(cost) for cost in vectorized.values()) == network.n_neurons
+    assert np.isclose(sum(cost.sum() for cost in vectorized.values()), sum(cost.sum() for cost in legacy.values()))
+    assert all(np.all(cost >= 1) for cost in vectorized.values())
+
+    # Surrogates are VecStims, emitted without building a model since NEURON may lack VecStim
+    part = extract_partition(network, partition_network(network, 'cell_type', 2)[0], duration=100.0)
+    networkParams = nlpToNetpyne.netparams_from_network(network=part, default_mech=models.NETPYNE_DEFAULT_MECH,
+                                                        default_cell=models.NETPYNE_DEFAULT_CELL,
+                                                        stim_sources=models.NETPYNE_STIM_SOURCES, vectorized=True)
+    loads = cell_loads(networkParams)
+    surrogates = [cost for pop, cost in loads.items() if 'cellType' not in networkParams.popParams[pop]]
+    assert sum(len(cost) for cost in surrogates) == np.count_nonzero(part.surrogates())
+    assert all(np.all(cost == POINT_CELL_COST) for cost in surrogates)
+
+@pytest.mark.skipif(shutil.which('mpiexec') is None, reason='needs mpiexec')
+def test_simulate_mpi(column, netpyne_model, spikes):
+    network = column('netpyne')
+    expected = nlpToNetpyne.simulate(*netpyne_model(network), headless=True)
+    # Open MPI refuses to run more ranks than cores, or to run as root, unless told to
+    args = ['--oversubscribe'] + (['--allow-run-as-root'] if os.geteuid() == 0 else [])
+    results = simulate_mpi(*netpyne_model(network), ranks=2, mpiexec_args=args, timeout=300)
+
+    assert spikes(results) == spikes(expected)
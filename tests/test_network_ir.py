@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from src.NeuroNLP_to_Brian_Netpyne.analysis import connectivity_matrix
+from src.NeuroNLP_to_Brian_Netpyne.network_ir import WEIGHT_MAPPINGS, NetworkIR, aggregate_synapses
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load(network, tmp_path, mmap):
+    path = str(tmp_path / 'network.nlpir')
+    network.save(path)
+    loaded = NetworkIR.load(path, mmap=mmap)
+
+    assert loaded.digest() == network.digest()
+    assert loaded.stims == network.stims
+    assert loaded.unames.tolist() == network.unames.tolist()
+    assert loaded.record.tolist() == network.record.tolist()
+    assert loaded.aggregation is None
+
+def test_save_load_aggregated(network, tmp_path):
+    aggregated = aggregate_synapses(network, 'sqrt')[0]
+    path = str(tmp_path / 'network.nlpir')
+    aggregated.save(path)
+    loaded = NetworkIR.load(path)
+
+    assert loaded.digest() == aggregated.digest()
+    assert loaded.aggregation == 'sqrt'
+
+@pytest.mark.parametrize('weight', sorted(WEIGHT_MAPPINGS.keys()))
+def test_aggregate_synapses(network, weight):
+    aggregated, report = aggregate_synapses(network, weight)
+
+    pre = aggregated.synapse_pre()
+    keys = set(zip(pre.tolist(), aggregated.syn_post.tolist(), aggregated.syn_mech.tolist()))
+    assert len(keys) == aggregated.n_synapses
+    assert report == {'synapses': network.n_synapses, 'connections': aggregated.n_synapses,
+                      'removed': network.n_synapses - aggregated.n_synapses}
+    assert aggregated.syn_count.sum() == network.syn_count.sum()
+    assert np.allclose(aggregated.syn_weight, WEIGHT_MAPPINGS[weight](aggregated.syn_count))
+    assert aggregated.aggregation == weight
+
+    # The CSR order of the synapses is kept
+    assert np.all(np.diff(pre) >= 0)
+
+def test_aggregate_synapses_twice(network, synapses):
+    aggregated = aggregate_synapses(network, 'log')[0]
+
+    assert synapses(aggregate_synapses(aggregated, 'log')[0]) == synapses(aggregated)
+
+def test_aggregate_synapses_unknown_mapping(network):
+    with pytest.raises(ValueError):
+        aggregate_synapses(network, 'cubic')
+
+def test_connectivity_matrix(network):
+    populations, matrix = connectivity_matrix(network)
+
+    expected = np.zeros_like(matrix)
+    labels = [populations.index(uname.split('-')[0]) for uname in network.unames.tolist()]
+    for pre, post, count in zip(network.synapse_pre().tolist(), network.syn_post.tolist(), network.syn_count.tolist()):
+        expected[labels[pre], labels[post]] += count
+    assert np.array_equal(matrix, expected)
+    assert matrix.sum() == network.syn_count.sum() > network.n_synapses
+
+@pytest.mark.parametrize('weight', sorted(WEIGHT_MAPPINGS.keys()))
+def test_connectivity_matrix_aggregated(network, weight):
+    aggregated = aggregate_synapses(network, weight)[0]
+    populations, matrix = connectivity_matrix(network)
+
+    assert connectivity_matrix(aggregated)[0] == populations
+    assert np.array_equal(connectivity_matrix(aggregated)[1], matrix)
+    assert connectivity_matrix(aggregated, weight=True)[1].sum() == \
+        pytest.approx(WEIGHT_MAPPINGS[weight](aggregated.syn_count).sum())
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.network_ir import aggregate_synapses, network_from_query
+from src.NeuroNLP_to_Brian_Netpyne.neuroml import _nml_id, read_neuroml, write_neuroml
+from src.NeuroNLP_to_Brian_Netpyne.partition import extract_partition, partition_network
+
+@pytest.fixture
+def custom_network(medulla):
+    ''' The synthetic medulla with custom cells for two neurons '''
+
+    client, query = medulla
+    return network_from_query(client, client.executeNLPquery(query), custom_cells=['Mi4-A', 'Mi4-B'],
+                              stims=models.stims('brian2', ['L1-A', 'Mi4-B']))
+
+def _roundtrip(network, tmp_path, hdf5):
+    if hdf5:
+        pytest.importorskip('h5py')
+    path = str(tmp_path / 'network.net.nml')
+    write_neuroml(path, network, hdf5=hdf5, chunk_size=100)
+    return read_neuroml(path)
+
+def _cells(network):
+    return {uname: _nml_id(network.cell_models[model]) if network.cell_models[model] != 'surrogate' else 'surrogate'
+            for uname, model in zip(network.unames.tolist(), network.cell_model.tolist())}
+
+@pytest.mark.parametrize('hdf5', [False, True])
+def test_neuroml_roundtrip(custom_network, tmp_path, synapses, hdf5):
+    read = _roundtrip(custom_network, tmp_path, hdf5)
+
+    # Neurons come back grouped by cell model, in the order of the network within every group
+    order = np.argsort(custom_network.cell_model, kind='stable')
+    assert read.unames.tolist() == custom_network.unames[order].tolist()
+    assert read.rids.tolist() == custom_network.rids[order].tolist()
+    assert _cells(read) == _cells(custom_network)
+
+    assert synapses(read) == synapses(custom_network)
+    assert sorted((stim['source'], read.unames[stim['target']]) for stim in read.stims) == \
+        sorted((stim['source'], custom_network.unames[stim['target']]) for stim in custom_network.stims)
+    assert read.aggregation is None
+
+@pytest.mark.parametrize('hdf5', [False, True])
+def test_neuroml_aggregated(network, tmp_path, synapses, hdf5):
+    aggregated = aggregate_synapses(network, 'sqrt')[0]
+    read = _roundtrip(aggregated, tmp_path, hdf5)
+
+    assert synapses(read) == synapses(aggregated)
+    assert read.aggregation == 'sqrt'
+
+@pytest.mark.parametrize('hdf5', [False, True])
+def test_neuroml_surrogates(custom_network, tmp_path, synapses, hdf5):
+    members = partition_network(custom_network, 'column')[0]
+    part = extract_partition(custom_network, members, rate=50.0, duration=100.0)
+    read = _roundtrip(part, tmp_path, hdf5)
+
+    # Surrogates are written as a population each, after the neurons of the partition
+    assert read.unames[:len(members)].tolist() == part.unames[np.argsort(part.cell_model[:len(members)],
+                                                                         kind='stable')].tolist()
+    assert read.unames[len(members):].tolist() == part.unames[len(members):].tolist()
+    assert read.surrogates().tolist() == part.surrogates().tolist()
+    assert synapses(read) == synapses(part)
+
+    trains = {str(part.unames[i]): part.spike_train(i) for i in np.flatnonzero(part.surrogates()).tolist()}
+    assert any(len(train) > 0 for train in trains.values())
+    for i in np.flatnonzero(read.surrogates()).tolist():
+        assert np.allclose(read.spike_train(i), trains[str(read.unames[i])])
@@ -0,0 +1,58 @@
+import copy
+
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+def test_vectorized_legacy(column, netpyne_model, spikes):
+    network = column('netpyne')
+    vectorized = nlpToNetpyne.simulate(*netpyne_model(network), headless=True)
+    legacy = nlpToNetpyne.simulate(*netpyne_model(network, vectorized=False), headless=True)
+
+    assert len(vectorized.spike_times) > 0
+    assert spikes(vectorized) == spikes(legacy)
+
+def test_conn_lists(column, netpyne_model):
+    network = column('netpyne')
+    networkParams, _ = netpyne_model(network)
+
+    # Every pair of connected neurons is an entry of the connection list of its mechanism and
+    # populations, instead of a rule of its own, with parallel synapses merged
+    connections = set(zip(network.synapse_pre().tolist(), network.syn_post.tolist(), network.syn_mech.tolist()))
+    rules = list(networkParams.connParams.values())
+    assert all('connList' in rule for rule in rules)
+    assert len(rules) < len(connections)
+    assert sum(len(rule['connList']) for rule in rules) == len(connections)
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_template_report(column, netpyne_model, spikes, vectorized):
+    # L1-A and Mi4-A are defined like the default cell and T1-A isn't, and two synapses have the
+    # same custom mechanism, which isn't the default one
+    leaky = copy.deepcopy(models.NETPYNE_DEFAULT_CELL)
+    leaky['secs']['soma']['mechs']['hh']['gl'] = 0.004
+    custom_cells = {'L1-A': copy.deepcopy(models.NETPYNE_DEFAULT_CELL),
+                    'Mi4-A': copy.deepcopy(models.NETPYNE_DEFAULT_CELL),
+                    'T1-A': leaky}
+    plain = column('netpyne')
+    pre = plain.synapse_pre()
+    mechs = sorted({str(plain.unames[a]) + '--' + str(plain.unames[b]) for a, b in zip(pre, plain.syn_post)})[:2]
+    custom_mechs = {name: {**models.NETPYNE_DEFAULT_MECH, 'tau2': 6.0} for name in mechs}
+
+    network = column('netpyne', custom_cells=list(custom_cells), custom_mechs=mechs)
+    networkParams, simConfig = netpyne_model(network, custom_cells=custom_cells, custom_mechs=custom_mechs,
+                                             vectorized=vectorized)
+
+    # The mechanisms are 'exc' and 'default', which every model has, and the custom one
+    assert networkParams.template_report == {'cell_rules': 2, 'cell_rules_saved': network.n_neurons - 2,
+                                             'syn_mechs': 3, 'syn_mechs_saved': 1}
+    cell_type = {uname: networkParams.popParams[networkParams.neuron_index[uname][0]]['cellType'] for uname in custom_cells}
+    assert cell_type['L1-A'] == cell_type['Mi4-A']
+    assert cell_type['L1-A'] != cell_type['T1-A']
+    assert networkParams.mech_templates[mechs[0]] == networkParams.mech_templates[mechs[1]] == mechs[0]
+
+    # Sharing templates doesn't change what is simulated
+    expected = column('netpyne', custom_cells=['T1-A'], custom_mechs=mechs)
+    expected_model = netpyne_model(expected, custom_cells={'T1-A': leaky}, custom_mechs=custom_mechs)
+    assert spikes(nlpToNetpyne.simulate(networkParams, simConfig, headless=True)) == \
+        spikes(nlpToNetpyne.simulate(*expected_model, headless=True))
@@ -0,0 +1,31 @@
+import numpy as np
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+
+def test_vectorized_legacy(column, brian2_model, spikes):
+    network = column('brian2')
+    vectorized = nlptoBrian2.simulate(brian2_model(network), 50, models.brian2_namespace(), headless=True)
+    legacy = nlptoBrian2.simulate(brian2_model(network, vectorized=False), 50, models.brian2_namespace(),
+                                  headless=True)
+
+    assert len(vectorized.spike_times) > 0
+    assert spikes(vectorized) == spikes(legacy)
+
+    # Traces come back in whatever order the groups were recorded in
+    order = np.argsort(vectorized.names[vectorized.trace_neurons])
+    legacy_order = np.argsort(legacy.names[legacy.trace_neurons])
+    assert vectorized.names[vectorized.trace_neurons][order].tolist() == sorted(['L1-A', 'Mi4-A', 'T1-A'])
+    assert legacy.names[legacy.trace_neurons][legacy_order].tolist() == sorted(['L1-A', 'Mi4-A', 'T1-A'])
+    assert np.allclose(vectorized.traces['v'][order], legacy.traces['v'][legacy_order])
+
+def test_vectorized_objects(column, brian2_model):
+    network = column('brian2')
+    model = brian2_model(network)
+
+    # One group for the neurons and one Synapses object for the default mechanism, besides the
+    # stimulation source and its synapses
+    groups = [obj for obj in model.objects if type(obj).__name__ == 'NeuronGroup' and obj.name != 'bkg']
+    synapses = [obj for obj in model.objects if type(obj).__name__ == 'Synapses' and obj.source.name != 'bkg']
+    assert [len(group) for group in groups] == [network.n_neurons]
+    assert [len(synapse) for synapse in synapses] == [network.n_synapses]
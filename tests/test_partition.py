@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from src.NeuroNLP_to_Brian_Netpyne.analysis import SimulationResults
+from src.NeuroNLP_to_Brian_Netpyne.network_ir import aggregate_synapses
+from src.NeuroNLP_to_Brian_Netpyne.partition import (extract_partition, partition_network, partition_report,
+                                                     run_partitions, stitch_results)
+
+@pytest.mark.parametrize('by, parts', [('column', None), ('column', 2), ('cell_type', 3), ('community', 3)])
+def test_partition_network(network, by, parts):
+    partitions = partition_network(network, by, parts)
+
+    assert np.array_equal(np.sort(np.concatenate(partitions)), np.arange(network.n_neurons))
+    assert len(partitions) == (parts if parts != None else 4)
+    assert partition_report(network, partitions)['sizes'] == [len(members) for members in partitions]
+
+@pytest.mark.parametrize('aggregated', [False, True])
+def test_extract_partition(network, synapses, aggregated):
+    if aggregated:
+        network = aggregate_synapses(network, 'sqrt')[0]
+    partitions = partition_network(network, 'column')
+    report = partition_report(network, partitions)
+
+    surrogates = 0
+    for members in partitions:
+        part = extract_partition(network, members, duration=100.0)
+        inside = set(network.unames[members].tolist())
+        expected = [synapse for synapse in synapses(network) if synapse[1] in inside]
+
+        assert part.unames[:len(members)].tolist() == network.unames[members].tolist()
+        assert synapses(part) == expected
+        assert not part.surrogates()[:len(members)].any()
+        assert part.surrogates()[len(members):].all()
+        assert sorted(part.unames[part.n_neurons - np.count_nonzero(part.surrogates()):].tolist()) == \
+            sorted({synapse[0] for synapse in expected} - inside)
+        assert sorted(part.unames[part.record].tolist()) == sorted(inside & set(network.unames[network.record].tolist()))
+        assert part.aggregation == network.aggregation
+        surrogates += np.count_nonzero(part.surrogates())
+    assert surrogates == report['surrogates']
+
+def test_poisson_surrogates(network):
+    partitions = partition_network(network, 'column')
+    trains = {}
+    for members in partitions:
+        part = extract_partition(network, members, rate=50.0, duration=200.0, seed=7)
+        for i in np.flatnonzero(part.surrogates()).tolist():
+            train = part.spike_train(i)
+            assert np.all(np.diff(train) >= 0) and np.all((train >= 0) & (train < 200.0))
+            trains.setdefault(str(part.unames[i]), []).append(train)
+
+    assert len(trains) > 0 and any(len(train) > 0 for train in sum(trains.values(), []))
+    for train in trains.values():
+        assert all(np.array_equal(train[0], other) for other in train[1:])
+
+    again = extract_partition(network, partitions[0], rate=50.0, duration=200.0, seed=7)
+    assert np.array_equal(again.spike_times, extract_partition(network, partitions[0], rate=50.0, duration=200.0,
+                                                               seed=7).spike_times)
+    with pytest.raises(ValueError):
+        extract_partition(network, partitions[0])
+
+def test_replayed_surrogates(network):
+    partitions = partition_network(network, 'column')
+    spikes = SimulationResults(network.unames, np.arange(network.n_neurons, dtype=np.float64),
+                               np.arange(network.n_neurons))
+    part = extract_partition(network, partitions[0], surrogate=spikes)
+
+    for i in np.flatnonzero(part.surrogates()).tolist():
+        k = network.unames.tolist().index(part.unames[i])
+        assert part.spike_train(i).tolist() == [float(k)]
+
+def test_stitch_results(network):
+    partitions = partition_network(network, 'column', 2)
+    t = np.arange(0, 10.5, 0.5)
+
+    results = []
+    for p, members in enumerate(partitions):
+        part = extract_partition(network, members, duration=10.0)
+        ids = network.unames.tolist()
+        ids = np.array([ids.index(name) for name in part.unames.tolist()])
+        # Every neuron spikes at its id in the network, surrogates at a time stitching must drop
+        times = np.where(part.surrogates(), -1.0, ids)
+        step = t if p == 0 else t[::2]
+        results.append(SimulationResults(part.unames, times, np.arange(part.n_neurons), t=step,
+                                         traces={'v': ids[:, None] + step[None, :]},
+                                         trace_neurons=np.arange(part.n_neurons), duration=10.0 + p))
+
+    stitched = stitch_results(network, partitions, results)
+
+    assert stitched.names.tolist() == network.unames.tolist()
+    assert np.array_equal(stitched.spike_times, np.arange(network.n_neurons))
+    assert np.array_equal(stitched.spike_neurons, np.arange(network.n_neurons))
+    assert np.array_equal(stitched.t, t)
+    assert np.allclose(stitched.traces['v'], stitched.trace_neurons[:, None] + t[None, :])
+    assert np.array_equal(np.sort(stitched.trace_neurons), np.arange(network.n_neurons))
+    assert stitched.duration == 10.0
+
+def test_run_partitions_iterations(network):
+    with pytest.raises(ValueError):
+        run_partitions(network, partition_network(network, 'column'), 'brian2', 10.0, iterations=0)
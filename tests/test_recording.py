@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.recording import Recording, read_recording
+
+def _chunks():
+    ''' What a simulation of 3 neurons recorded in each of two flushes, for a trace
+    specification of neurons 0 and 2 '''
+
+    t = np.arange(0, 20, 0.5)
+    v = np.stack([np.sin(t), np.cos(t)])
+    return [([(t[:20], {'v': v[:, :20]})], np.array([1.5, 4.0]), np.array([2, 0])),
+            ([(t[20:], {'v': v[:, 20:]})], np.array([12.5]), np.array([1]))], t, v
+
+def test_read_recording(tmp_path):
+    chunks, t, v = _chunks()
+    recording = Recording(str(tmp_path / 'recording'), traces=[{'variables': ['v'], 'neurons': ['a', 'c'], 'stride': 5}])
+    recording.attach(['a', 'b', 'c'], recording.resolve(['a', 'b', 'c']), 0.1, lambda: chunks.pop(0))
+    recording.flush()
+    recording.close(20.0)
+
+    results = read_recording(str(tmp_path / 'recording'))
+    assert results.names.tolist() == ['a', 'b', 'c']
+    assert results.spike_times.tolist() == [1.5, 4.0, 12.5]
+    assert results.spike_neurons.tolist() == [2, 0, 1]
+    assert np.array_equal(results.t, t)
+    assert np.array_equal(results.traces['v'], v)
+    assert results.trace_neurons.tolist() == [0, 2]
+    assert results.duration == 20.0
+
+def _decimated(recorded, results):
+    ''' Traces of results at the sample times of recorded, in the row order of recorded '''
+
+    rows = [results.names[results.trace_neurons].tolist().index(name) for name in recorded.names[recorded.trace_neurons]]
+    samples = np.searchsorted(results.t, recorded.t - 1e-6)
+    assert np.allclose(results.t[samples], recorded.t)
+    return results.traces['v'][rows][:, samples]
+
+def test_netpyne_recording(tmp_path, column, netpyne_model, spikes):
+    from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+    network = column('netpyne')
+    # Sample the traces of the headless run at every step, like the recording before decimating
+    networkParams, simConfig = netpyne_model(network)
+    simConfig.recordStep = simConfig.dt
+    results = nlpToNetpyne.simulate(networkParams, simConfig, headless=True)
+
+    recording = Recording(str(tmp_path / 'recording'), traces=[{'neurons': ['L1-A', 'Mi4-A'], 'stride': 4}],
+                          flush_every=30)
+    assert nlpToNetpyne.simulate(*netpyne_model(network, recording=recording), recording=recording) is None
+    recorded = read_recording(str(tmp_path / 'recording'))
+
+    assert spikes(recorded) == spikes(results)
+    assert sorted(recorded.names[recorded.trace_neurons].tolist()) == ['L1-A', 'Mi4-A']
+    assert np.allclose(recorded.traces['v'], _decimated(recorded, results))
+    assert recorded.duration == 100
+
+def test_brian2_recording(tmp_path, column, brian2_model, spikes):
+    from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+
+    network = column('brian2')
+    results = nlptoBrian2.simulate(brian2_model(network), 50, models.brian2_namespace(), headless=True)
+
+    recording = Recording(str(tmp_path / 'recording'), traces=[{'neurons': ['L1-A', 'Mi4-A'], 'stride': 4}],
+                          flush_every=20)
+    nlptoBrian2.simulate(brian2_model(network, recording=recording), 50, models.brian2_namespace(),
+                         recording=recording)
+    recorded = read_recording(str(tmp_path / 'recording'))
+
+    assert spikes(recorded) == spikes(results)
+    assert sorted(recorded.names[recorded.trace_neurons].tolist()) == ['L1-A', 'Mi4-A']
+    assert np.allclose(recorded.traces['v'], _decimated(recorded, results))
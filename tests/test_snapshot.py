@@ -0,0 +1,54 @@
+import collections
+
+import numpy as np
+import pytest
+
+brian2 = pytest.importorskip('brian2')
+
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+from src.NeuroNLP_to_Brian_Netpyne.partition import extract_partition, partition_network
+from src.NeuroNLP_to_Brian_Netpyne.snapshot import load_model, save_model
+
+# A deterministic source, so both runs get the same input without seeding brian2
+STIM_SOURCES = {'bkg': {'model': 'dx/dt = 1/(10*ms) : 1', 'threshold': 'x>1', 'reset': 'x=0'}}
+
+@pytest.fixture(autouse=True)
+def numpy_target():
+    target = brian2.prefs.codegen.target
+    brian2.prefs.codegen.target = 'numpy'
+    yield
+    brian2.prefs.codegen.target = target
+
+def _spikes(results):
+    return collections.Counter(zip(results.names[results.spike_neurons].tolist(),
+                                   np.round(results.spike_times, 6).tolist()))
+
+@pytest.mark.parametrize('vectorized', [True, False])
+@pytest.mark.parametrize('equations', [False, True])
+def test_brian2_snapshot(network, tmp_path, vectorized, equations):
+    # The partition replays its inputs from outside with a SpikeGeneratorGroup
+    part = extract_partition(network, partition_network(network, 'column')[2], rate=100.0, duration=20.0)
+    cell = dict(models.BRIAN2_DEFAULT_CELL)
+    if equations:
+        cell['model'] = brian2.Equations(cell['model'])
+
+    model = nlptoBrian2.model_gen(None, None, network=part, default_mech=models.BRIAN2_DEFAULT_MECH,
+                                  default_cell=cell, stim_sources=STIM_SOURCES, vectorized=vectorized,
+                                  record_spikes=True)
+    save_model(str(tmp_path / 'model.npz'), model)
+    loaded = load_model(str(tmp_path / 'model.npz'))
+
+    expected = nlptoBrian2.simulate(model, 20, models.brian2_namespace(), headless=True)
+    results = nlptoBrian2.simulate(loaded, 20, models.brian2_namespace(), headless=True)
+
+    assert len(expected.spike_times) > 0
+    assert _spikes(results) == _spikes(expected)
+    assert sorted(results.names[results.trace_neurons].tolist()) == \
+        sorted(expected.names[expected.trace_neurons].tolist())
+
+def test_snapshot_version(network, tmp_path):
+    model = nlptoBrian2.model_gen(None, None, network=network, default_mech=models.BRIAN2_DEFAULT_MECH,
+                                  default_cell=models.BRIAN2_DEFAULT_CELL, stim_sources=STIM_SOURCES)
+    save_model(str(tmp_path / 'model.npz'), model)
+    assert isinstance(load_model(str(tmp_path / 'model.npz'), mmap=False), brian2.Network)
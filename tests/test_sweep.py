@@ -0,0 +1,52 @@
+from benchmarks import models
+from src.NeuroNLP_to_Brian_Netpyne.sweep import grid, sweep
+
+def test_grid():
+    assert grid({'a.w': [1, 2], 'b': [3]}) == [{'a.w': 1, 'b': 3}, {'a.w': 2, 'b': 3}]
+
+def test_netpyne_sweep(column, netpyne_model, spikes):
+    from src.NeuroNLP_to_Brian_Netpyne import nlpToNetpyne
+
+    network = column('netpyne')
+    points = [{'bkg.rate': 40, 'bkg.weight': 0.02}, {'bkg.rate': 10, 'bkg.weight': 0.02},
+              {'bkg.rate': 40, 'bkg.weight': 0.5, '*.weight': 0.05}]
+    networkParams, simConfig = netpyne_model(network)
+    swept = list(sweep(networkParams, points, simConfig=simConfig))
+
+    assert [point for point, _ in swept] == points
+    for point, results in swept:
+        # The same point, generated from scratch
+        networkParams, simConfig = netpyne_model(network, stim_sources={'bkg': {**models.NETPYNE_STIM_SOURCES['bkg'],
+                                                                                'rate': point['bkg.rate']}})
+        for rule in networkParams.stimTargetParams.values():
+            rule['weight'] = point['bkg.weight']
+        for rule in networkParams.connParams.values():
+            rule['weight'] = point.get('*.weight', rule['weight'])
+        expected = nlpToNetpyne.simulate(networkParams, simConfig, headless=True)
+
+        assert len(expected.spike_times) > 0
+        assert spikes(results) == spikes(expected)
+    assert spikes(swept[0][1]) != spikes(swept[1][1]) != spikes(swept[2][1])
+
+def test_brian2_sweep(column, brian2_model, spikes):
+    from brian2 import ms
+    from src.NeuroNLP_to_Brian_Netpyne import nlptoBrian2
+
+    network = column('brian2')
+    sources = {'bkg': {'model': 'dx/dt = 1/tau_bkg : 1', 'threshold': 'x>1', 'reset': 'x=0'}}
+    internal_vars = {**models.brian2_namespace(), 'tau_bkg': 10*ms}
+
+    model = brian2_model(network, stim_sources=sources)
+    synapses = [obj.name for obj in model.objects if type(obj).__name__ == 'Synapses' and obj.source.name != 'bkg'][0]
+    points = [{'tau_bkg': 5*ms}, {'tau_bkg': 10*ms}, {'tau_bkg': 5*ms, synapses + '.w': 2}]
+    swept = list(sweep(model, points, t=30, internal_vars=internal_vars))
+
+    assert [point for point, _ in swept] == points
+    for point, results in swept:
+        expected = nlptoBrian2.simulate(brian2_model(network, stim_sources=sources), 30,
+                                        {**internal_vars, 'tau_bkg': point['tau_bkg']}, headless=True,
+                                        run_args={key: value for key, value in point.items() if '.' in key})
+
+        assert len(expected.spike_times) > 0
+        assert spikes(results) == spikes(expected)
+    assert spikes(swept[0][1]) != spikes(swept[1][1])